@@ -5,6 +5,7 @@ from main.models import (
     Transaction,
     BlockHeight,
     Subscription,
+    Notification,
     Recipient,
     Project,
     Wallet,
@@ -13,16 +14,14 @@ from main.models import (
 )
 from django.contrib.auth.models import User, Group
 from main.tasks import (
-    client_acknowledgement,
-    send_telegram_message,
     get_token_meta_data,
     get_bch_utxos,
     get_slp_utxos
 )
+from main.utils import block_scanner, outbox
 from dynamic_raw_id.admin import DynamicRawIDMixin
 from django.utils.html import format_html
 from django.conf import settings
-import json
 
 
 admin.site.site_header = 'WatchTower.Cash Admin'
@@ -71,12 +70,7 @@ class BlockHeightAdmin(admin.ModelAdmin):
 
     
     def process(self, request, queryset):
-        for trans in queryset:
-            pending_blocks = json.loads(REDIS_STORAGE.get('PENDING-BLOCKS'))
-            pending_blocks.append(trans.number)
-            pending_blocks = list(set(pending_blocks))
-            BlockHeight.objects.filter(number=trans.number).update(processed=False)
-            REDIS_STORAGE.set('PENDING-BLOCKS', json.dumps(pending_blocks))
+        block_scanner.requeue_blocks(queryset.values_list('number', flat=True))
 
     def get_actions(self, request):
         actions = super().get_actions(request)
@@ -126,13 +120,7 @@ class TransactionAdmin(DynamicRawIDMixin, admin.ModelAdmin):
         return actions
 
     def resend_unacknowledged_transactions(self, request, queryset):
-        for tr in queryset:
-            third_parties = client_acknowledgement(tr.id)
-            for platform in third_parties:
-                if 'telegram' in platform:
-                    message = platform[1]
-                    chat_id = platform[2]
-                    send_telegram_message(message, chat_id)
+        outbox.replay_notifications(queryset.values_list('id', flat=True))
 
 
 class RecipientAdmin(admin.ModelAdmin):
@@ -263,6 +251,33 @@ class WalletNftTokenAdmin(DynamicRawIDMixin, admin.ModelAdmin):
     ]
 
 
+class NotificationAdmin(DynamicRawIDMixin, admin.ModelAdmin):
+    list_display = [
+        'transaction',
+        'subscription',
+        'channel',
+        'status',
+        'attempts',
+        'next_attempt_at',
+        'sent_at'
+    ]
+
+    list_filter = [
+        'channel',
+        'status'
+    ]
+
+    dynamic_raw_id_fields = [
+        'transaction',
+        'subscription'
+    ]
+
+    actions = ['replay_notifications']
+
+    def replay_notifications(self, request, queryset):
+        outbox.replay_notifications(queryset.values_list('transaction_id', flat=True).distinct())
+
+
 admin.site.unregister(User)
 admin.site.unregister(Group)
 
@@ -271,6 +286,7 @@ admin.site.register(Transaction, TransactionAdmin)
 admin.site.register(BlockHeight, BlockHeightAdmin)
 admin.site.register(Subscription, SubscriptionAdmin)
 admin.site.register(Recipient, RecipientAdmin)
+admin.site.register(Notification, NotificationAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Wallet, WalletAdmin)
 admin.site.register(Project, ProjectAdmin)
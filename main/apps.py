@@ -7,9 +7,4 @@ class MainConfig(AppConfig):
         import main.signals
         from main.tasks import REDIS_STORAGE
 
-        # Restart block scanning upon re-deployment
-        REDIS_STORAGE.delete('PENDING-BLOCKS')
-        REDIS_STORAGE.delete('ACTIVE-BLOCK')
         REDIS_STORAGE.delete('BITDBQUERY_COUNT')
-        REDIS_STORAGE.delete('BITDBQUERY_COUNT')
-        REDIS_STORAGE.set('READY', 1)
@@ -1,10 +1,8 @@
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
+from channels.generic.websocket import AsyncWebsocketConsumer
+from asgiref.sync import sync_to_async
 
-from django.conf import settings
-
-from main.utils.events import EventHandler
-from main.models import Address, Subscription
+from main.utils.presence import PRESENCE, HEARTBEAT_INTERVAL, get_room_name
+import asyncio
 import json
 import logging
 
@@ -12,40 +10,53 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class Consumer(WebsocketConsumer):
+class Consumer(AsyncWebsocketConsumer):
+    """
+        Pushes the updates of an address (and token) to the client.
+        Connections are only tracked in redis (see `main.utils.presence`),
+        connecting and disconnecting doesn't touch the database.
+    """
 
-    def connect(self):
+    async def connect(self):
         self.address = self.scope['url_route']['kwargs']['address']
         self.tokenid = ''
         if 'tokenid' in self.scope['url_route']['kwargs'].keys():
             self.tokenid = self.scope['url_route']['kwargs']['tokenid']
 
-        logger.info(self.address)
-        Subscription.objects.filter(address__address=self.address).update(websocket=True)
-
-        self.room_name = self.address.replace(':', '_')
-        self.room_name += f'_{self.tokenid}'
+        self.room_name = get_room_name(self.address, self.tokenid)
 
         logger.info(f"ADDRESS {self.room_name} CONNECTED!")
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.room_name,
             self.channel_name
         )
-        self.accept()
+        await sync_to_async(PRESENCE.join, thread_sensitive=False)(self.room_name, self.channel_name)
+        self.heartbeat = asyncio.ensure_future(self.send_heartbeats())
+        await self.accept()
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await sync_to_async(PRESENCE.heartbeat, thread_sensitive=False)(self.room_name, self.channel_name)
+            except Exception as exc:
+                logger.error(f"Unable to refresh presence of {self.room_name}: {exc}")
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'heartbeat'):
+            # Dropped before it was fully connected
+            return
 
-    def disconnect(self, close_code):
         logger.info(f"ADDRESS {self.room_name} DISCONNECTED!")
-        async_to_sync(self.channel_layer.group_discard)(
+        self.heartbeat.cancel()
+        await self.channel_layer.group_discard(
             self.room_name,
             self.channel_name
         )
-        room_name = self.room_name.split('_')
-        address = ':'.join(room_name[:2])
-        addr = Address.objects.get(address=address)
-        Subscription.objects.filter(address=addr).update(websocket=False)
-        
-    def send_update(self, data):
+        await sync_to_async(PRESENCE.leave, thread_sensitive=False)(self.room_name, self.channel_name)
+
+    async def send_update(self, data):
         logging.info(f'FOUND {data}')
         del data["type"]
         data = data['data']
-        self.send(text_data=json.dumps(data))
+        await self.send(text_data=json.dumps(data))
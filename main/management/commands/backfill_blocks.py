@@ -0,0 +1,124 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from main.models import BlockHeight
+from main.tasks import _get_block_outputs, save_block_outputs
+from main.utils import block_scanner
+from main.utils.queries.bchd import BCHDQuery
+from multiprocessing import Pool
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+WORKERS = 4
+# Blocks handed to a worker at a time, neighbouring blocks tend to share addresses
+CHUNK_SIZE = 10
+REPORT_INTERVAL = 10
+
+
+def scan_block(number):
+    """
+        Saves the tracked outputs of a block and checkpoints it as processed.
+        Runs in the pool's worker processes, each with its own database
+        connection and gRPC channels.
+
+        The block is leased from the block scanner's queue first, so that it's not
+        scanned by both at once; blocks the scanner is working on are skipped.
+        Returns None as the transactions count of skipped blocks.
+    """
+    close_old_connections()
+    # Rows created here are not queued for the block scanner
+    block, _ = BlockHeight.objects.get_or_create(number=number, defaults={'requires_full_scan': False})
+    if not block_scanner.lease_blocks([number]):
+        return number, None, 0, None
+
+    try:
+        bchd = BCHDQuery()
+        transactions = bchd.get_block(number, full_transactions=True)
+        outputs = _get_block_outputs(transactions)
+        created_ids = save_block_outputs(block, outputs, source='bchd-backfill')
+        block_scanner.complete_block(number, len(transactions), block_hash=bchd.get_block_hash(number))
+        return number, len(transactions), len(created_ids), None
+    except Exception as exc:
+        LOGGER.exception(f'ERROR in backfilling block {number}: {exc}')
+        # Hand it over to the block scanner
+        block_scanner.BLOCK_QUEUE.complete(number)
+        block_scanner.requeue_blocks([number])
+        return number, 0, 0, str(exc)
+
+
+class Command(BaseCommand):
+    help = "Rescan a range of BCH blocks in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', type=int, required=True)
+        parser.add_argument('--to', dest='end', type=int, required=True)
+        parser.add_argument('--workers', type=int, default=WORKERS)
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Rescan blocks that were already processed'
+        )
+
+    def handle(self, *args, **options):
+        start, end = options['start'], options['end']
+        if start > end:
+            raise CommandError('--from must not be greater than --to')
+
+        numbers = range(start, end + 1)
+        if not options['force']:
+            processed = set(
+                BlockHeight.objects.filter(
+                    number__gte=start,
+                    number__lte=end,
+                    processed=True
+                ).values_list('number', flat=True)
+            )
+            numbers = [x for x in numbers if x not in processed]
+        numbers = list(numbers)
+        if not numbers:
+            self.stdout.write(self.style.SUCCESS('Nothing to backfill'))
+            return
+
+        self.stdout.write(f"Backfilling {len(numbers)} blocks with {options['workers']} workers")
+
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+
+        started_at = time.monotonic()
+        reported_at = started_at
+        scanned = transactions = created = skipped = 0
+        failed = []
+        with Pool(processes=options['workers']) as pool:
+            for number, txs_count, created_count, error in pool.imap_unordered(scan_block, numbers, CHUNK_SIZE):
+                if error:
+                    failed.append(number)
+                    continue
+                if txs_count is None:
+                    skipped += 1
+                    continue
+                scanned += 1
+                transactions += txs_count
+                created += created_count
+
+                now = time.monotonic()
+                if now - reported_at >= REPORT_INTERVAL:
+                    reported_at = now
+                    rate = scanned / (now - started_at)
+                    self.stdout.write(
+                        f'{scanned}/{len(numbers)} blocks | {rate:.2f} blocks/s | '
+                        f'{transactions} transactions | {created} new records'
+                    )
+
+        elapsed = time.monotonic() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f'Backfilled {scanned} blocks in {elapsed:.1f}s ({scanned / max(elapsed, 1e-6):.2f} blocks/s), '
+            f'{created} new records from {transactions} transactions'
+        ))
+        if skipped:
+            self.stdout.write(f'{skipped} blocks were skipped as the block scanner was already scanning them')
+        if failed:
+            failed.sort()
+            self.stdout.write(self.style.ERROR(
+                f'{len(failed)} blocks failed and were left for the block scanner: {failed}'
+            ))
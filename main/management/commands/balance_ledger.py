@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from main.utils import balance_ledger
+
+
+class Command(BaseCommand):
+    help = "Verify the balance ledger against the transactions table, or rebuild it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="Recompute the whole ledger")
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            count = balance_ledger.rebuild()
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt the balance ledger with {count} rows'))
+            return
+
+        mismatches = balance_ledger.verify()
+        for wallet_id, address_id, token_id, expected, actual in mismatches:
+            scope = f'wallet {wallet_id}' if wallet_id else f'address {address_id}'
+            self.stdout.write(
+                self.style.WARNING(f'{scope} | token {token_id}: expected {expected}, found {actual}')
+            )
+
+        if mismatches:
+            self.stdout.write(self.style.ERROR(f'{len(mismatches)} mismatched balances, run with --rebuild to fix'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Balance ledger is consistent'))
@@ -1,35 +1,251 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import close_old_connections
 from main.utils.bchd import bchrpc_pb2 as pb
 from main.utils.bchd import bchrpc_pb2_grpc as bchrpc
-from main.models import Token, Transaction
+from main.utils.queries.bchd import BCHD_NODES, CHANNEL_POOL, CHANNEL_OPTIONS
+from main.models import Transaction
+from main.tasks import save_records
+from main.utils.converter import convert_slp_to_bch_address
+from main.utils.watched_addresses import WATCHED_ADDRESSES
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import grpc
 import time
 import random
 import logging
-import ssl
-from main.tasks import save_record, client_acknowledgement, send_telegram_message
 
 LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
 
+SOURCE = 'bchd-grpc-stream'
 
+# Transactions waiting to be saved; once full the stream stops reading and
+# gRPC flow control pushes back on the node instead of growing memory
+QUEUE_SIZE = 5000
+WORKERS = 4
+# Outputs saved per `save_records` call and how long a worker waits to fill a batch
+BATCH_SIZE = 200
+BATCH_WAIT = 0.25
 
-def run():
-    source = 'bchd-grpc-stream'
-    nodes = [
-        'bchd.imaginary.cash:8335',
-        # 'bchd.greyh.at:8335',
-        # 'bchd.fountainhead.cash:443'
-    ]
-    bchd_node = random.choice(nodes)
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
 
-    cert = ssl.get_server_certificate(bchd_node.split(':'))
-    creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
+# How often the server-side filter picks up new addresses and tracked outputs
+FILTER_REFRESH = 5
+# How often the tracked outputs are fully reloaded from the database
+OUTPOINTS_REFRESH = 300
+# Beyond these sizes the stream falls back to receiving every transaction
+MAX_FILTER_ADDRESSES = 200000
+MAX_FILTER_OUTPOINTS = 200000
+# Filter entries sent per stream message
+FILTER_CHUNK_SIZE = 5000
 
-    with grpc.secure_channel(bchd_node, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-        stub = bchrpc.bchrpcStub(channel)
+METRICS_INTERVAL = 30
+_REDIS_NAME__METRICS = 'bchd-grpc-stream:metrics'
 
-        req = pb.GetBlockchainInfoRequest()
-        resp = stub.GetBlockchainInfo(req)
+
+def get_records(tx):
+    """
+        Outputs of a BCHD transaction in the format expected by `save_records`
+    """
+    tx_hash = bytearray(tx.hash[::-1]).hex()
+    records = []
+    for output in tx.outputs:
+        if output.address:
+            records.append({
+                'token': 'bch',
+                'address': 'bitcoincash:' + output.address,
+                'txid': tx_hash,
+                'amount': output.value / (10 ** 8),
+                'value': output.value,
+                'index': output.index
+            })
+
+        if output.slp_token.token_id:
+            records.append({
+                'token': bytearray(output.slp_token.token_id).hex(),
+                'address': 'simpleledger:' + output.slp_token.address,
+                'txid': tx_hash,
+                'amount': output.slp_token.amount / (10 ** output.slp_token.decimals),
+                'value': output.slp_token.amount,
+                'index': output.index
+            })
+    return records
+
+
+def to_filter_address(address):
+    """
+        BCHD only understands cash addresses, SLP outputs are sent to the same script
+    """
+    try:
+        if address.startswith('simpleledger:'):
+            return convert_slp_to_bch_address(address)
+        if address.startswith('bitcoincash:'):
+            return address
+    except Exception:
+        LOGGER.warning(f"{SOURCE}: skipping invalid address {address} in the stream filter")
+    return None
+
+
+def get_watched_addresses():
+    version, addresses = WATCHED_ADDRESSES.members()
+    filter_addresses = {to_filter_address(x) for x in addresses}
+    filter_addresses.discard(None)
+    return version, filter_addresses
+
+
+def get_tracked_outpoints():
+    close_old_connections()
+    try:
+        qs = Transaction.objects.filter(spent=False).exclude(txid='').values_list('txid', 'index').distinct()
+        return set(qs[:MAX_FILTER_OUTPOINTS + 1])
+    finally:
+        close_old_connections()
+
+
+def build_filter_requests(subscribe_addresses=(), subscribe_outpoints=(), unsubscribe_addresses=(), unsubscribe_outpoints=()):
+    """
+        Splits a filter change into `SubscribeTransactionsRequest` messages of bounded size
+    """
+    entries = [('subscribe', 'addresses', x) for x in subscribe_addresses]
+    entries += [('subscribe', 'outpoints', x) for x in subscribe_outpoints]
+    entries += [('unsubscribe', 'addresses', x) for x in unsubscribe_addresses]
+    entries += [('unsubscribe', 'outpoints', x) for x in unsubscribe_outpoints]
+
+    requests = []
+    # An empty change still makes one message, e.g. to open a stream with nothing to watch yet
+    for start in range(0, max(len(entries), 1), FILTER_CHUNK_SIZE):
+        req = pb.SubscribeTransactionsRequest()
+        # BCHD reads the mempool flags from every message of the stream
+        req.include_mempool = True
+        req.include_in_block = False
+        for action, kind, value in entries[start:start + FILTER_CHUNK_SIZE]:
+            tx_filter = getattr(req, action)
+            if kind == 'addresses':
+                tx_filter.addresses.append(value)
+            else:
+                txid, index = value
+                outpoint = tx_filter.outpoints.add()
+                outpoint.hash = bytes.fromhex(txid)[::-1]
+                outpoint.index = index
+        requests.append(req)
+    return requests
+
+
+def save_batch(records):
+    close_old_connections()
+    try:
+        # The notifications of the created records go to the outbox in the same transaction
+        return save_records(records, SOURCE, notify=True)
+    finally:
+        close_old_connections()
+
+
+class StreamMetrics(object):
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.received = 0
+        self.saved = 0
+        self.outputs = 0
+        self.created = 0
+        self.errors = 0
+        self.max_lag = 0
+        self._last_report = (self.started_at, 0)
+
+    def observe_lag(self, received_at):
+        self.max_lag = max(self.max_lag, time.monotonic() - received_at)
+
+    def report(self, queue):
+        now = time.monotonic()
+        last_time, last_saved = self._last_report
+        throughput = (self.saved - last_saved) / max(now - last_time, 1e-6)
+        self._last_report = (now, self.saved)
+
+        data = {
+            'received': self.received,
+            'saved': self.saved,
+            'outputs': self.outputs,
+            'created': self.created,
+            'errors': self.errors,
+            'queue': queue.qsize(),
+            'max_lag': round(self.max_lag, 3),
+            'throughput': round(throughput, 2),
+            'uptime': int(now - self.started_at)
+        }
+        # Lag is reported over the interval, not since startup
+        self.max_lag = 0
+
+        LOGGER.info(f"{SOURCE} metrics: {data}")
+        try:
+            pipe = REDIS_STORAGE.pipeline(transaction=False)
+            pipe.hmset(_REDIS_NAME__METRICS, data)
+            pipe.expire(_REDIS_NAME__METRICS, METRICS_INTERVAL * 10)
+            pipe.execute()
+        except Exception as exc:
+            LOGGER.error(f"Unable to store {SOURCE} metrics: {exc}")
+
+
+class MempoolStreamer(object):
+    """
+        Mempool tracker on top of the `grpc.aio` BCHD client.
+
+        The stream only parses notifications and pushes them to a bounded queue.
+        Workers drain the queue in batches of outputs that are saved with a single
+        `save_records` call in a thread, so a slow database doesn't hold up the
+        stream. Notifications are written to the outbox along with the records and
+        delivered by the notification dispatchers.
+
+        Unless `all_transactions` is set, BCHD is sent the watched addresses and
+        the outpoints of the unspent tracked outputs over `SubscribeTransactionStream`,
+        and the filter is updated incrementally as addresses and outputs come and go.
+        The stream falls back to all transactions if the filter gets too large or
+        the node doesn't support the bidirectional stream.
+    """
+
+    def __init__(self, workers=WORKERS, batch_size=BATCH_SIZE, queue_size=QUEUE_SIZE, all_transactions=False):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.all_transactions = all_transactions
+        self.metrics = StreamMetrics()
+
+        self.addresses_version = None
+        self.addresses = set()
+        self.outpoints = set()
+        # Filter changes not yet sent to the node
+        self.new_outpoints = set()
+        self.spent_outpoints = set()
+
+    def _get_records(self, tx):
+        records = get_records(tx)
+        spent = set()
+        for _input in tx.inputs:
+            outpoint = (_input.outpoint.hash[::-1].hex(), _input.outpoint.index)
+            if outpoint in self.outpoints:
+                spent.add(outpoint)
+
+        if spent:
+            # Lets `save_records` track the outputs of transactions spending tracked outputs
+            spent_txids = list({txid for txid, _ in spent})
+            for record in records:
+                record['spent_txids'] = spent_txids
+            self.outpoints -= spent
+            self.new_outpoints -= spent
+            self.spent_outpoints |= spent
+        return records
+
+    async def _read(self, notifications):
+        async for notification in notifications:
+            records = self._get_records(notification.unconfirmed_transaction.transaction)
+            self.metrics.received += 1
+            if records:
+                # Blocks while the workers are behind
+                await self.queue.put((time.monotonic(), records))
+
+    async def _subscribe_all(self, stub):
         tx_filter = pb.TransactionFilter()
         tx_filter.all_transactions = True
 
@@ -37,68 +253,211 @@ def run():
         req.include_mempool = True
         req.include_in_block = False
         req.subscribe.CopyFrom(tx_filter)
+        await self._read(stub.SubscribeTransactions(req))
 
-        for notification in stub.SubscribeTransactions(req):
-            tx = notification.unconfirmed_transaction.transaction
-            tx_hash = bytearray(tx.hash[::-1]).hex()
-
-            for _input in tx.inputs:
-                
-                txid = _input.outpoint.hash.hex()
-                index = _input.outpoint.index
-
-            for output in tx.outputs:
-                if output.address:
-                    bchaddress = 'bitcoincash:' + output.address
-                    amount = output.value / (10 ** 8)
-                    args = (
-                        'bch',
-                        bchaddress,
-                        tx_hash,
-                        amount,
-                        source,
-                        None,
-                        output.index
-                    )
-                    obj_id, created = save_record(*args)
-                    if created:
-                        third_parties = client_acknowledgement(obj_id)
-                        for platform in third_parties:
-                            if 'telegram' in platform:
-                                message = platform[1]
-                                chat_id = platform[2]
-                                send_telegram_message(message, chat_id)
-                    msg = f"{source}: {tx_hash} | {bchaddress} | {amount} "
-                    LOGGER.info(msg)
-
-                if output.slp_token.token_id:
-                    token_id = bytearray(output.slp_token.token_id).hex() 
-                    amount = output.slp_token.amount / (10 ** output.slp_token.decimals)
-                    slp_address = 'simpleledger:' + output.slp_token.address
-                    args = (
-                        token_id,
-                        slp_address,
-                        tx_hash,
-                        amount,
-                        source,
-                        None,
-                        output.index
+    async def _load_filter(self):
+        self.addresses_version, self.addresses = await sync_to_async(get_watched_addresses, thread_sensitive=False)()
+        self.outpoints = await sync_to_async(get_tracked_outpoints, thread_sensitive=False)()
+        self.new_outpoints = set()
+        self.spent_outpoints = set()
+        return len(self.addresses) <= MAX_FILTER_ADDRESSES and len(self.outpoints) <= MAX_FILTER_OUTPOINTS
+
+    async def _update_filter(self, call):
+        self.outpoints_loaded_at = time.monotonic()
+        while True:
+            await asyncio.sleep(FILTER_REFRESH)
+            try:
+                if not await self._refresh_filter(call):
+                    return
+            except (grpc.aio.AioRpcError, asyncio.CancelledError):
+                raise
+            except Exception as exc:
+                LOGGER.exception(f"{SOURCE}: unable to update the stream filter: {exc}")
+                self.metrics.errors += 1
+
+    async def _refresh_filter(self, call):
+        subscribe_addresses = set()
+        unsubscribe_addresses = set()
+        version = await sync_to_async(WATCHED_ADDRESSES.get_version, thread_sensitive=False)()
+        if version != self.addresses_version:
+            self.addresses_version, addresses = await sync_to_async(get_watched_addresses, thread_sensitive=False)()
+            subscribe_addresses = addresses - self.addresses
+            unsubscribe_addresses = self.addresses - addresses
+            self.addresses = addresses
+
+        if time.monotonic() - self.outpoints_loaded_at > OUTPOINTS_REFRESH:
+            # Catches outputs saved by other processes, e.g. block scans
+            self.outpoints_loaded_at = time.monotonic()
+            outpoints = await sync_to_async(get_tracked_outpoints, thread_sensitive=False)()
+            self.new_outpoints |= outpoints - self.outpoints
+            self.spent_outpoints |= self.outpoints - outpoints
+
+        subscribe_outpoints, self.new_outpoints = self.new_outpoints, set()
+        unsubscribe_outpoints, self.spent_outpoints = self.spent_outpoints, set()
+        self.outpoints |= subscribe_outpoints
+        self.outpoints -= unsubscribe_outpoints
+
+        if len(self.addresses) > MAX_FILTER_ADDRESSES or len(self.outpoints) > MAX_FILTER_OUTPOINTS:
+            LOGGER.warning(f"{SOURCE}: the stream filter outgrew its limits, resubscribing to all transactions")
+            call.cancel()
+            return False
+
+        changes = (subscribe_addresses, unsubscribe_addresses, subscribe_outpoints, unsubscribe_outpoints)
+        if any(changes):
+            requests = build_filter_requests(
+                subscribe_addresses=subscribe_addresses,
+                subscribe_outpoints=subscribe_outpoints,
+                unsubscribe_addresses=unsubscribe_addresses,
+                unsubscribe_outpoints=unsubscribe_outpoints
+            )
+            for req in requests:
+                await call.write(req)
+            LOGGER.info(
+                f"{SOURCE}: filter updated, +{len(subscribe_addresses)}/-{len(unsubscribe_addresses)} addresses, "
+                f"+{len(subscribe_outpoints)}/-{len(unsubscribe_outpoints)} outpoints"
+            )
+        return True
+
+    async def _subscribe_filtered(self, stub):
+        call = stub.SubscribeTransactionStream()
+        for req in build_filter_requests(subscribe_addresses=self.addresses, subscribe_outpoints=self.outpoints):
+            await call.write(req)
+
+        updater = asyncio.ensure_future(self._update_filter(call))
+        try:
+            await self._read(call)
+        except asyncio.CancelledError:
+            if not updater.done():
+                raise
+        finally:
+            updater.cancel()
+
+    async def _subscribe(self, node):
+        credentials = CHANNEL_POOL.get_credentials(node)
+        async with grpc.aio.secure_channel(node, credentials, options=CHANNEL_OPTIONS) as channel:
+            stub = bchrpc.bchrpcStub(channel)
+
+            if not self.all_transactions:
+                if await self._load_filter():
+                    LOGGER.info(
+                        f"{SOURCE}: subscribed to {node} with {len(self.addresses)} addresses "
+                        f"and {len(self.outpoints)} outpoints"
                     )
-                    obj_id, created = save_record(*args)
+                    try:
+                        return await self._subscribe_filtered(stub)
+                    except grpc.aio.AioRpcError as exc:
+                        if exc.code() != grpc.StatusCode.UNIMPLEMENTED:
+                            raise
+                        LOGGER.warning(f"{SOURCE}: {node} has no filtered stream, using all transactions from now on")
+                        self.all_transactions = True
+                else:
+                    LOGGER.warning(f"{SOURCE}: the stream filter is too large, subscribing to all transactions")
+
+            # Spends are still detected against the tracked outputs loaded above, if any
+            LOGGER.info(f"{SOURCE}: subscribed to {node} for all transactions")
+            await self._subscribe_all(stub)
+
+    async def produce(self):
+        delay = RECONNECT_DELAY
+        while True:
+            node = random.choice(BCHD_NODES)
+            started_at = time.monotonic()
+            try:
+                await self._subscribe(node)
+                LOGGER.warning(f"{SOURCE}: stream from {node} ended")
+            except grpc.aio.AioRpcError as exc:
+                LOGGER.error(f"{SOURCE}: stream from {node} failed: {exc.code()} {exc.details()}")
+                self.metrics.errors += 1
+
+            # Only back off if the stream keeps dropping right away
+            if time.monotonic() - started_at > MAX_RECONNECT_DELAY:
+                delay = RECONNECT_DELAY
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def _get_batch(self):
+        received_at, records = await self.queue.get()
+        batch = [(received_at, records)]
+        size = len(records)
+        deadline = time.monotonic() + BATCH_WAIT
+        while size < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                received_at, records = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append((received_at, records))
+            size += len(records)
+        return batch
+
+    async def consume(self):
+        while True:
+            batch = await self._get_batch()
+            records = [record for _, items in batch for record in items]
+            try:
+                results = await sync_to_async(save_batch, thread_sensitive=False)(records)
+            except Exception as exc:
+                LOGGER.exception(f"{SOURCE}: unable to save {len(records)} outputs: {exc}")
+                self.metrics.errors += 1
+                results = []
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
 
-                    if created:
-                        third_parties = client_acknowledgement(obj_id)
-                        for platform in third_parties:
-                            if 'telegram' in platform:
-                                message = platform[1]
-                                chat_id = platform[2]
-                                send_telegram_message(message, chat_id)
-                    msg = f"{source}: {tx_hash} | {slp_address} | {amount} | {token_id}"
-                    LOGGER.info(msg)
+            for record, (obj_id, created) in zip(records, results):
+                if obj_id is None:
+                    continue
+                if created:
+                    self.metrics.created += 1
+                    self.new_outpoints.add((record['txid'], int(record['index'])))
+                msg = f"{SOURCE}: {record['txid']} | {record['address']} | {record['amount']} | {record['token']}"
+                LOGGER.info(msg)
+
+            self.metrics.saved += len(batch)
+            self.metrics.outputs += len(records)
+            self.metrics.observe_lag(batch[0][0])
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            self.metrics.report(self.queue)
+
+    async def run(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+
+        # The default executor backs `sync_to_async`, one thread per worker
+        loop = asyncio.get_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.workers))
+
+        tasks = [asyncio.ensure_future(self.produce()), asyncio.ensure_future(self.report())]
+        tasks += [asyncio.ensure_future(self.consume()) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
 
 
 class Command(BaseCommand):
     help = "Run the mempool tracker using BCHD GRPC stream"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=WORKERS)
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+        parser.add_argument(
+            '--all-transactions',
+            action='store_true',
+            help='Receive every mempool transaction instead of filtering on the node'
+        )
+
     def handle(self, *args, **options):
-        run()
+        streamer = MempoolStreamer(
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            queue_size=options['queue_size'],
+            all_transactions=options['all_transactions']
+        )
+        asyncio.get_event_loop().run_until_complete(streamer.run())
@@ -2,11 +2,8 @@
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from main.models import Token, Transaction, Subscription
-from main.tasks import (
-    save_record,
-    client_acknowledgement,
-    send_telegram_message
-)
+from main.tasks import save_record
+from main.utils.watched_addresses import WATCHED_ADDRESSES
 from django.conf import settings
 import logging
 import traceback
@@ -66,7 +63,7 @@ def run():
                                 address__address=bchaddress       
                             )
                             # Disregard bch address that are not subscribed.
-                            if subscription.exists():
+                            if WATCHED_ADDRESSES.contains(bchaddress) and subscription.exists():
                             
                                 txn_qs = Transaction.objects.filter(
                                     address__address=bchaddress,
@@ -83,14 +80,7 @@ def run():
                                         None,
                                         index
                                     )
-                                    obj_id, created = save_record(*args)
-                                    if created:
-                                        third_parties = client_acknowledgement(obj_id)
-                                        for platform in third_parties:
-                                            if 'telegram' in platform:
-                                                message = platform[1]
-                                                chat_id = platform[2]
-                                                send_telegram_message(message, chat_id)
+                                    save_record(*args, notify=True)
 
                                 msg = f"{source}: {txn_id} | {bchaddress} | {amount} "
                                 LOGGER.info(msg)
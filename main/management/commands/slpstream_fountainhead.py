@@ -1,7 +1,8 @@
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from main.models import Token, Transaction, Subscription
-from main.tasks import save_record, client_acknowledgement, send_telegram_message
+from main.tasks import save_record
+from main.utils.watched_addresses import WATCHED_ADDRESSES
 from django.conf import settings
 import logging
 import requests
@@ -59,7 +60,7 @@ def run():
                                 )
 
                                 # Disregard bch address that are not subscribed.
-                                if subscription.exists():
+                                if WATCHED_ADDRESSES.contains(slp_address) and subscription.exists():
                                     token, _ = Token.objects.get_or_create(tokenid=token_id)
                                     
                                     amount = float(output['amount'])
@@ -82,14 +83,7 @@ def run():
                                             None,
                                             index
                                         )
-                                        obj_id, created = save_record(*args)
-                                        if created:
-                                            third_parties = client_acknowledgement(obj_id)
-                                            for platform in third_parties:
-                                                if 'telegram' in platform:
-                                                    message = platform[1]
-                                                    chat_id = platform[2]
-                                                    send_telegram_message(message, chat_id)
+                                        save_record(*args, notify=True)
 
                                     msg = f"{source}: {txn_id} | {slp_address} | {amount} | {token_id}"
                                     LOGGER.info(msg)
@@ -0,0 +1,161 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+# Outputs count towards a balance while unspent, BCH ones only above the 546 sats dust limit
+CREATE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION main_balanceledger_counts(p_token_id integer, p_amount double precision)
+RETURNS boolean AS $$
+    SELECT tokenid <> '' OR p_amount > 0.00000546 FROM main_token WHERE id = p_token_id;
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION main_balanceledger_apply(
+    p_wallet_id integer,
+    p_address_id integer,
+    p_token_id integer,
+    p_amount double precision,
+    p_count integer,
+    p_block integer
+) RETURNS void AS $$
+BEGIN
+    IF p_count > 0 THEN
+        IF p_address_id IS NOT NULL THEN
+            INSERT INTO main_balanceledger (wallet_id, address_id, token_id, balance, utxo_count, last_updated_block, date_updated)
+            VALUES (NULL, p_address_id, p_token_id, p_amount, p_count, p_block, now())
+            ON CONFLICT (address_id, token_id) WHERE wallet_id IS NULL DO UPDATE SET
+                balance = main_balanceledger.balance + EXCLUDED.balance,
+                utxo_count = main_balanceledger.utxo_count + EXCLUDED.utxo_count,
+                last_updated_block = GREATEST(main_balanceledger.last_updated_block, EXCLUDED.last_updated_block),
+                date_updated = EXCLUDED.date_updated;
+        END IF;
+        IF p_wallet_id IS NOT NULL THEN
+            INSERT INTO main_balanceledger (wallet_id, address_id, token_id, balance, utxo_count, last_updated_block, date_updated)
+            VALUES (p_wallet_id, NULL, p_token_id, p_amount, p_count, p_block, now())
+            ON CONFLICT (wallet_id, token_id) WHERE address_id IS NULL DO UPDATE SET
+                balance = main_balanceledger.balance + EXCLUDED.balance,
+                utxo_count = main_balanceledger.utxo_count + EXCLUDED.utxo_count,
+                last_updated_block = GREATEST(main_balanceledger.last_updated_block, EXCLUDED.last_updated_block),
+                date_updated = EXCLUDED.date_updated;
+        END IF;
+    ELSE
+        -- Removals never create rows, the owner may be deleted in this same transaction
+        UPDATE main_balanceledger SET
+            balance = balance + p_amount,
+            utxo_count = utxo_count + p_count,
+            last_updated_block = GREATEST(last_updated_block, p_block),
+            date_updated = now()
+        WHERE address_id = p_address_id AND wallet_id IS NULL AND token_id = p_token_id;
+        UPDATE main_balanceledger SET
+            balance = balance + p_amount,
+            utxo_count = utxo_count + p_count,
+            last_updated_block = GREATEST(last_updated_block, p_block),
+            date_updated = now()
+        WHERE wallet_id = p_wallet_id AND address_id IS NULL AND token_id = p_token_id;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION main_transaction_balanceledger() RETURNS trigger AS $$
+DECLARE
+    old_counts boolean := false;
+    new_counts boolean := false;
+    new_block integer;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        old_counts := NOT OLD.spent AND COALESCE(main_balanceledger_counts(OLD.token_id, OLD.amount), false);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        new_counts := NOT NEW.spent AND COALESCE(main_balanceledger_counts(NEW.token_id, NEW.amount), false);
+        SELECT number INTO new_block FROM main_blockheight WHERE id = NEW.blockheight_id;
+    END IF;
+
+    IF TG_OP = 'UPDATE' AND old_counts AND new_counts
+        AND OLD.wallet_id IS NOT DISTINCT FROM NEW.wallet_id
+        AND OLD.address_id IS NOT DISTINCT FROM NEW.address_id
+        AND OLD.token_id = NEW.token_id
+        AND OLD.amount = NEW.amount THEN
+        -- Same output, at most its block changed
+        IF OLD.blockheight_id IS DISTINCT FROM NEW.blockheight_id THEN
+            PERFORM main_balanceledger_apply(NEW.wallet_id, NEW.address_id, NEW.token_id, 0, 0, new_block);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF old_counts THEN
+        PERFORM main_balanceledger_apply(OLD.wallet_id, OLD.address_id, OLD.token_id, -OLD.amount, -1, new_block);
+    END IF;
+    IF new_counts THEN
+        PERFORM main_balanceledger_apply(NEW.wallet_id, NEW.address_id, NEW.token_id, NEW.amount, 1, new_block);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER main_transaction_balanceledger
+AFTER INSERT OR DELETE OR UPDATE OF spent, amount, wallet_id, address_id, token_id, blockheight_id
+ON main_transaction
+FOR EACH ROW EXECUTE PROCEDURE main_transaction_balanceledger();
+"""
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS main_transaction_balanceledger ON main_transaction;
+DROP FUNCTION IF EXISTS main_transaction_balanceledger();
+DROP FUNCTION IF EXISTS main_balanceledger_apply(integer, integer, integer, double precision, integer, integer);
+DROP FUNCTION IF EXISTS main_balanceledger_counts(integer, double precision);
+"""
+
+FILL_LEDGER_SQL = """
+LOCK TABLE main_transaction IN SHARE ROW EXCLUSIVE MODE;
+INSERT INTO main_balanceledger (wallet_id, address_id, token_id, balance, utxo_count, last_updated_block, date_updated)
+SELECT t.wallet_id, NULL, t.token_id, SUM(t.amount), COUNT(*), MAX(b.number), now()
+FROM main_transaction t
+JOIN main_token tk ON tk.id = t.token_id
+LEFT JOIN main_blockheight b ON b.id = t.blockheight_id
+WHERE NOT t.spent AND t.wallet_id IS NOT NULL AND (tk.tokenid <> '' OR t.amount > 0.00000546)
+GROUP BY t.wallet_id, t.token_id;
+INSERT INTO main_balanceledger (wallet_id, address_id, token_id, balance, utxo_count, last_updated_block, date_updated)
+SELECT NULL, t.address_id, t.token_id, SUM(t.amount), COUNT(*), MAX(b.number), now()
+FROM main_transaction t
+JOIN main_token tk ON tk.id = t.token_id
+LEFT JOIN main_blockheight b ON b.id = t.blockheight_id
+WHERE NOT t.spent AND t.address_id IS NOT NULL AND (tk.tokenid <> '' OR t.amount > 0.00000546)
+GROUP BY t.address_id, t.token_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0051_auto_20220330_0419'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.FloatField(default=0)),
+                ('utxo_count', models.IntegerField(default=0)),
+                ('last_updated_block', models.IntegerField(blank=True, null=True)),
+                ('date_updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('address', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='main.Address')),
+                ('token', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='main.Token')),
+                ('wallet', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='main.Wallet')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='balanceledger',
+            constraint=models.CheckConstraint(check=models.Q(models.Q(('address__isnull', True), ('wallet__isnull', False)), models.Q(('address__isnull', False), ('wallet__isnull', True)), _connector='OR'), name='balanceledger_wallet_or_address'),
+        ),
+        migrations.AddConstraint(
+            model_name='balanceledger',
+            constraint=models.UniqueConstraint(condition=models.Q(address__isnull=True), fields=('wallet', 'token'), name='balanceledger_unique_wallet_token'),
+        ),
+        migrations.AddConstraint(
+            model_name='balanceledger',
+            constraint=models.UniqueConstraint(condition=models.Q(wallet__isnull=True), fields=('address', 'token'), name='balanceledger_unique_address_token'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER_SQL, DROP_TRIGGER_SQL),
+        migrations.RunSQL(FILL_LEDGER_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,168 @@
+from django.db import migrations, models
+
+
+BACKFILL_VALUES_SQL = """
+UPDATE main_transaction t
+SET value = ROUND(t.amount::numeric * power(10::numeric, CASE WHEN tk.tokenid = '' THEN 8 ELSE tk.decimals END))
+FROM main_token tk
+WHERE tk.id = t.token_id AND t.value IS NULL AND (tk.tokenid = '' OR tk.decimals IS NOT NULL);
+
+UPDATE main_wallethistory h
+SET value = ROUND(h.amount::numeric * power(10::numeric, CASE WHEN tk.tokenid = '' THEN 8 ELSE tk.decimals END))
+FROM main_token tk
+WHERE tk.id = h.token_id AND h.value IS NULL AND (tk.tokenid = '' OR tk.decimals IS NOT NULL);
+"""
+
+# Same as in 0052, with the base units kept next to the float balance
+CREATE_TRIGGER_SQL = """
+DROP FUNCTION IF EXISTS main_balanceledger_apply(integer, integer, integer, double precision, integer, integer);
+
+CREATE OR REPLACE FUNCTION main_balanceledger_apply(
+    p_wallet_id integer,
+    p_address_id integer,
+    p_token_id integer,
+    p_amount double precision,
+    p_value bigint,
+    p_count integer,
+    p_block integer
+) RETURNS void AS $$
+BEGIN
+    IF p_count > 0 THEN
+        IF p_address_id IS NOT NULL THEN
+            INSERT INTO main_balanceledger (wallet_id, address_id, token_id, balance, value, utxo_count, last_updated_block, date_updated)
+            VALUES (NULL, p_address_id, p_token_id, p_amount, p_value, p_count, p_block, now())
+            ON CONFLICT (address_id, token_id) WHERE wallet_id IS NULL DO UPDATE SET
+                balance = main_balanceledger.balance + EXCLUDED.balance,
+                value = main_balanceledger.value + EXCLUDED.value,
+                utxo_count = main_balanceledger.utxo_count + EXCLUDED.utxo_count,
+                last_updated_block = GREATEST(main_balanceledger.last_updated_block, EXCLUDED.last_updated_block),
+                date_updated = EXCLUDED.date_updated;
+        END IF;
+        IF p_wallet_id IS NOT NULL THEN
+            INSERT INTO main_balanceledger (wallet_id, address_id, token_id, balance, value, utxo_count, last_updated_block, date_updated)
+            VALUES (p_wallet_id, NULL, p_token_id, p_amount, p_value, p_count, p_block, now())
+            ON CONFLICT (wallet_id, token_id) WHERE address_id IS NULL DO UPDATE SET
+                balance = main_balanceledger.balance + EXCLUDED.balance,
+                value = main_balanceledger.value + EXCLUDED.value,
+                utxo_count = main_balanceledger.utxo_count + EXCLUDED.utxo_count,
+                last_updated_block = GREATEST(main_balanceledger.last_updated_block, EXCLUDED.last_updated_block),
+                date_updated = EXCLUDED.date_updated;
+        END IF;
+    ELSE
+        -- Removals never create rows, the owner may be deleted in this same transaction
+        UPDATE main_balanceledger SET
+            balance = balance + p_amount,
+            value = value + p_value,
+            utxo_count = utxo_count + p_count,
+            last_updated_block = GREATEST(last_updated_block, p_block),
+            date_updated = now()
+        WHERE address_id = p_address_id AND wallet_id IS NULL AND token_id = p_token_id;
+        UPDATE main_balanceledger SET
+            balance = balance + p_amount,
+            value = value + p_value,
+            utxo_count = utxo_count + p_count,
+            last_updated_block = GREATEST(last_updated_block, p_block),
+            date_updated = now()
+        WHERE wallet_id = p_wallet_id AND address_id IS NULL AND token_id = p_token_id;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION main_transaction_balanceledger() RETURNS trigger AS $$
+DECLARE
+    old_counts boolean := false;
+    new_counts boolean := false;
+    new_block integer;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        old_counts := NOT OLD.spent AND COALESCE(main_balanceledger_counts(OLD.token_id, OLD.amount), false);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        new_counts := NOT NEW.spent AND COALESCE(main_balanceledger_counts(NEW.token_id, NEW.amount), false);
+        SELECT number INTO new_block FROM main_blockheight WHERE id = NEW.blockheight_id;
+    END IF;
+
+    IF TG_OP = 'UPDATE' AND old_counts AND new_counts
+        AND OLD.wallet_id IS NOT DISTINCT FROM NEW.wallet_id
+        AND OLD.address_id IS NOT DISTINCT FROM NEW.address_id
+        AND OLD.token_id = NEW.token_id
+        AND OLD.amount = NEW.amount
+        AND OLD.value IS NOT DISTINCT FROM NEW.value THEN
+        -- Same output, at most its block changed
+        IF OLD.blockheight_id IS DISTINCT FROM NEW.blockheight_id THEN
+            PERFORM main_balanceledger_apply(NEW.wallet_id, NEW.address_id, NEW.token_id, 0, 0, 0, new_block);
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    IF old_counts THEN
+        PERFORM main_balanceledger_apply(
+            OLD.wallet_id, OLD.address_id, OLD.token_id, -OLD.amount, -COALESCE(OLD.value, 0), -1, new_block
+        );
+    END IF;
+    IF new_counts THEN
+        PERFORM main_balanceledger_apply(
+            NEW.wallet_id, NEW.address_id, NEW.token_id, NEW.amount, COALESCE(NEW.value, 0), 1, new_block
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS main_transaction_balanceledger ON main_transaction;
+CREATE TRIGGER main_transaction_balanceledger
+AFTER INSERT OR DELETE OR UPDATE OF spent, amount, value, wallet_id, address_id, token_id, blockheight_id
+ON main_transaction
+FOR EACH ROW EXECUTE PROCEDURE main_transaction_balanceledger();
+"""
+
+FILL_LEDGER_VALUES_SQL = """
+LOCK TABLE main_transaction IN SHARE ROW EXCLUSIVE MODE;
+UPDATE main_balanceledger l SET value = x.value
+FROM (
+    SELECT t.wallet_id, t.token_id, SUM(t.value) AS value
+    FROM main_transaction t
+    JOIN main_token tk ON tk.id = t.token_id
+    WHERE NOT t.spent AND t.wallet_id IS NOT NULL AND (tk.tokenid <> '' OR t.amount > 0.00000546)
+    GROUP BY t.wallet_id, t.token_id
+) x
+WHERE l.wallet_id = x.wallet_id AND l.address_id IS NULL AND l.token_id = x.token_id AND x.value IS NOT NULL;
+UPDATE main_balanceledger l SET value = x.value
+FROM (
+    SELECT t.address_id, t.token_id, SUM(t.value) AS value
+    FROM main_transaction t
+    JOIN main_token tk ON tk.id = t.token_id
+    WHERE NOT t.spent AND t.address_id IS NOT NULL AND (tk.tokenid <> '' OR t.amount > 0.00000546)
+    GROUP BY t.address_id, t.token_id
+) x
+WHERE l.address_id = x.address_id AND l.wallet_id IS NULL AND l.token_id = x.token_id AND x.value IS NOT NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0052_balanceledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='value',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='wallethistory',
+            name='value',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='balanceledger',
+            name='value',
+            field=models.BigIntegerField(default=0),
+        ),
+        # Backfill before the trigger learns about `value`, the ledger values are filled in one go below
+        migrations.RunSQL(BACKFILL_VALUES_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(CREATE_TRIGGER_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(FILL_LEDGER_VALUES_SQL, migrations.RunSQL.noop),
+    ]
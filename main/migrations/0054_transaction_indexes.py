@@ -0,0 +1,42 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently so that the transactions table stays writable
+    atomic = False
+
+    dependencies = [
+        ('main', '0053_transaction_value'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(spent=False), fields=['address', 'token'], name='transaction_unspent_addr_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(spent=False), fields=['wallet', 'token'], name='transaction_unspent_wallet_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='transaction',
+            index=models.Index(fields=['txid', 'index'], name='transaction_outpoint_idx'),
+        ),
+        # Superseded by the indexes above
+        migrations.AlterField(
+            model_name='transaction',
+            name='amount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='index',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='spent',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('main', '0054_transaction_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='wallethistory',
+            index=models.Index(fields=['wallet', '-date_created', '-id'], name='wallethistory_wallet_date_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0055_wallethistory_wallet_date_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blockheight',
+            name='scan_started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='blockheight',
+            name='scan_attempts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0056_blockheight_scan_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blockheight',
+            name='block_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
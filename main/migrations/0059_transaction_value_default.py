@@ -0,0 +1,59 @@
+from django.db import migrations
+
+
+# Outputs saved without a value (by workers predating 0053, or before their token's
+# decimals were known) get it from their amount as soon as the decimals are known,
+# so the balance ledger never leaves them out
+CREATE_TRIGGER_SQL = """
+CREATE OR REPLACE FUNCTION main_transaction_fill_value() RETURNS trigger AS $$
+DECLARE
+    v_tokenid varchar;
+    v_decimals integer;
+BEGIN
+    IF NEW.value IS NULL AND NEW.amount IS NOT NULL THEN
+        -- The token is share-locked until this output commits, so once its decimals are
+        -- saved every output left without a value is visible to the backfill that follows
+        -- (see `main.tasks.get_token_meta_data`)
+        SELECT tokenid, decimals INTO v_tokenid, v_decimals FROM main_token WHERE id = NEW.token_id FOR SHARE;
+        IF v_tokenid = '' THEN
+            v_decimals := 8;
+        END IF;
+        IF v_decimals IS NOT NULL THEN
+            NEW.value := ROUND(NEW.amount::numeric * power(10::numeric, v_decimals));
+        END IF;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS main_transaction_fill_value ON main_transaction;
+CREATE TRIGGER main_transaction_fill_value
+BEFORE INSERT OR UPDATE OF value, amount, token_id
+ON main_transaction
+FOR EACH ROW EXECUTE PROCEDURE main_transaction_fill_value();
+"""
+
+DROP_TRIGGER_SQL = """
+DROP TRIGGER IF EXISTS main_transaction_fill_value ON main_transaction;
+DROP FUNCTION IF EXISTS main_transaction_fill_value();
+"""
+
+# Those saved since 0053, the ledger trigger adds their values
+BACKFILL_VALUES_SQL = """
+UPDATE main_transaction t
+SET value = ROUND(t.amount::numeric * power(10::numeric, CASE WHEN tk.tokenid = '' THEN 8 ELSE tk.decimals END))
+FROM main_token tk
+WHERE tk.id = t.token_id AND t.value IS NULL AND (tk.tokenid = '' OR tk.decimals IS NOT NULL);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0058_notification'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGER_SQL, DROP_TRIGGER_SQL),
+        migrations.RunSQL(BACKFILL_VALUES_SQL, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0059_transaction_value_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='channel',
+            field=models.CharField(choices=[('webhook', 'Webhook'), ('telegram', 'Telegram')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0060_notification_channel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='claim_token',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+    ]
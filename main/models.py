@@ -88,6 +88,11 @@ class BlockHeight(PostgresModel):
     problematic = JSONField(default=list, blank=True)
     unparsed = JSONField(default=list, blank=True)
     requires_full_scan = models.BooleanField(default=True)
+    # Hash of the block at this height when it was scanned, used to detect reorgs
+    block_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    # Scan checkpoint, set while the block is being scanned
+    scan_started = models.DateTimeField(null=True, blank=True)
+    scan_attempts = models.IntegerField(default=0)
 
     def save(self, *args, **kwargs):
         if not self.id:
@@ -204,7 +209,9 @@ class Transaction(PostgresModel):
         null=True,
         blank=True
     )
-    amount = models.FloatField(default=0, db_index=True)
+    amount = models.FloatField(default=0)
+    # Amount in base units (satoshis / raw SLP amount), written along with `amount`
+    value = models.BigIntegerField(null=True, blank=True)
     acknowledged = models.BooleanField(null=True, default=None)
     blockheight = models.ForeignKey(
         BlockHeight,
@@ -218,8 +225,8 @@ class Transaction(PostgresModel):
         Token,
         on_delete=models.CASCADE
     )
-    index = models.IntegerField(default=0, db_index=True)
-    spent = models.BooleanField(default=False, db_index=True)
+    index = models.IntegerField(default=0)
+    spent = models.BooleanField(default=False)
     spending_txid = models.CharField(max_length=70, blank=True, db_index=True)
     wallet = models.ForeignKey(
         Wallet,
@@ -237,6 +244,24 @@ class Transaction(PostgresModel):
             'index'
         ]
         ordering = ['-date_created']
+        indexes = [
+            # Balance and UTXO lookups only ever look at unspent outputs
+            models.Index(
+                fields=['address', 'token'],
+                condition=models.Q(spent=False),
+                name='transaction_unspent_addr_idx'
+            ),
+            models.Index(
+                fields=['wallet', 'token'],
+                condition=models.Q(spent=False),
+                name='transaction_unspent_wallet_idx'
+            ),
+            # Outpoint lookups when marking inputs as spent
+            models.Index(
+                fields=['txid', 'index'],
+                name='transaction_outpoint_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.txid
@@ -275,6 +300,65 @@ class Subscription(PostgresModel):
     date_created = models.DateTimeField(default=timezone.now)
 
 
+class Notification(PostgresModel):
+    """
+        Outbox of the notifications of new outputs, one per output, subscription and channel.
+        Written in the same database transaction as the output, and drained by
+        `main.tasks.dispatch_notifications` which keeps track of each delivery.
+    """
+    WEBHOOK = 'webhook'
+    TELEGRAM = 'telegram'
+    # Websocket updates are only sent while someone is connected, they skip the outbox
+    CHANNEL_OPTIONS = [
+        (WEBHOOK, 'Webhook'),
+        (TELEGRAM, 'Telegram')
+    ]
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_OPTIONS = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed')
+    ]
+
+    transaction = models.ForeignKey(
+        Transaction,
+        on_delete=models.CASCADE,
+        related_name='notifications'
+    )
+    subscription = models.ForeignKey(
+        Subscription,
+        on_delete=models.CASCADE,
+        related_name='notifications'
+    )
+    channel = models.CharField(max_length=20, choices=CHANNEL_OPTIONS)
+    status = models.CharField(max_length=20, choices=STATUS_OPTIONS, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # Also pushed forward while a dispatcher holds the notification
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # Set when claimed, only its holder may complete the notification
+    claim_token = models.UUIDField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    date_created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [
+            'transaction',
+            'subscription',
+            'channel'
+        ]
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(status='pending'),
+                name='notification_pending_idx'
+            ),
+        ]
+
+
 class WalletHistory(PostgresModel):
     INCOMING = 'incoming'
     OUTGOING = 'outgoing'
@@ -308,6 +392,7 @@ class WalletHistory(PostgresModel):
         choices=RECORD_TYPE_OPTIONS
     )
     amount = models.FloatField(default=0)
+    value = models.BigIntegerField(null=True, blank=True)
     token = models.ForeignKey(
         Token,
         related_name='wallet_history_records',
@@ -326,6 +411,10 @@ class WalletHistory(PostgresModel):
             'wallet',
             'txid'
         ]
+        indexes = [
+            # Keyset pagination of a wallet's history
+            models.Index(fields=['wallet', '-date_created', '-id'], name='wallethistory_wallet_date_idx'),
+        ]
 
     def __str__(self):
         return self.txid
@@ -361,3 +450,60 @@ class WalletNftToken(PostgresModel):
 
     class Meta:
        ordering = ['-date_acquired']
+
+
+class BalanceLedger(PostgresModel):
+    """
+        Running balance of the unspent outputs of a wallet or an address for a token.
+        Rows are maintained by a trigger on the transaction table (see migration 0052)
+        so they change in the same database transaction as the outputs themselves.
+        BCH outputs at or below the dust limit are not counted, like in the balance views.
+    """
+    wallet = models.ForeignKey(
+        Wallet,
+        related_name='balances',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True
+    )
+    address = models.ForeignKey(
+        Address,
+        related_name='balances',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True
+    )
+    token = models.ForeignKey(
+        Token,
+        related_name='balances',
+        on_delete=models.CASCADE
+    )
+    balance = models.FloatField(default=0)
+    value = models.BigIntegerField(default=0)
+    utxo_count = models.IntegerField(default=0)
+    last_updated_block = models.IntegerField(null=True, blank=True)
+    date_updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=(
+                    models.Q(wallet__isnull=False, address__isnull=True) |
+                    models.Q(wallet__isnull=True, address__isnull=False)
+                ),
+                name='balanceledger_wallet_or_address'
+            ),
+            models.UniqueConstraint(
+                fields=['wallet', 'token'],
+                condition=models.Q(address__isnull=True),
+                name='balanceledger_unique_wallet_token'
+            ),
+            models.UniqueConstraint(
+                fields=['address', 'token'],
+                condition=models.Q(wallet__isnull=True),
+                name='balanceledger_unique_address_token'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet or self.address} | {self.token}"
@@ -1,16 +1,19 @@
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db import transaction as trans
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from django.utils import timezone
-from main.utils import block_setter
+from main.utils.watched_addresses import WATCHED_ADDRESSES
+from main.utils.block_scanner import BLOCK_QUEUE
 from main.models import (
+    Address,
     BlockHeight,
     Transaction,
     Token
 )
 from main.tasks import (
-    transaction_post_save_task
+    queue_transaction_post_save
 )
 
 
@@ -27,26 +30,24 @@ def blockheight_post_save(sender, instance=None, created=False, **kwargs):
             if instance.currentcount == instance.transactions_count:
                 BlockHeight.objects.filter(id=instance.id).update(processed=True, updated_datetime=timezone.now())
 
-    if created:
-        
-        # Make sure there are no missed blocks
-        # last_processed_block = BlockHeight.objects.filter(processed=True).last().number
-        # latest_block = BlockHeight.objects.last().number
-        
-        # for i in range(last_processed_block, latest_block):
-        #     obj, created = BlockHeight.objects.get_or_create(number=i)
-
-        # Queue to "PENDING-BLOCKS"
-        if instance.requires_full_scan:                
-            block_setter(instance.number)
-        
+    if created and instance.requires_full_scan:
+        BLOCK_QUEUE.add(instance.number)
+
 
 @receiver(post_save, sender=Transaction)
 def transaction_post_save(sender, instance=None, created=False, **kwargs):
-    address = instance.address.address
-    blockheight_id = None
-    if instance.blockheight:
-        blockheight_id = instance.blockheight.id
+    # Queue the transaction for post-processing, saves of its other outputs are coalesced
+    queue_transaction_post_save(instance.txid, instance.blockheight_id)
+
+
+@receiver(post_save, sender=Address)
+def address_post_save(sender, instance=None, created=False, **kwargs):
+    if created:
+        # A rebuild reading the table before the commit replays it (see `WatchedAddressIndex.rebuild`)
+        address = instance.address
+        trans.on_commit(lambda: WATCHED_ADDRESSES.add(address))
+
 
-    # Trigger the transaction post-save task
-    transaction_post_save_task.delay(address, instance.id, blockheight_id)
+@receiver(post_delete, sender=Address)
+def address_post_delete(sender, instance=None, **kwargs):
+    WATCHED_ADDRESSES.remove(instance.address)
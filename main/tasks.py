@@ -1,4 +1,4 @@
-import logging, json, requests
+import logging, requests
 from urllib.parse import urlparse
 from watchtower.settings import MAX_RESTB_RETRIES
 from bitcash.transaction import calc_txid
@@ -7,6 +7,7 @@ from main.models import (
     BlockHeight, 
     Token, 
     Transaction,
+    Notification,
     Recipient,
     Subscription,
     Address,
@@ -19,163 +20,280 @@ from main.utils.wallet import HistoryParser
 from django.db.utils import IntegrityError
 from django.conf import settings
 from django.utils import timezone, dateparse
+from django.db import connection
 from django.db import transaction as trans
+from django.db.models import F, Q
 from celery import Celery
 from main.utils.chunk import chunks
+from main.utils import block_scanner, outbox, reorg, telegram_sender, webhooks
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from main.utils.queries.bchd import BCHDQuery
+from main.utils.watched_addresses import WATCHED_ADDRESSES
+from main.utils.presence import PRESENCE, get_address_rooms
+from main.utils.response_cache import RESPONSE_CACHE
+from main.utils.telegram_sender import TELEGRAM_SENDER
+from main.utils.money import Round, get_token_decimals, to_base_units
+from psqlextra.query import ConflictAction
 from PIL import Image, ImageFile
 from io import BytesIO 
 import pytz
-from celery import chord
 
 LOGGER = logging.getLogger(__name__)
 REDIS_STORAGE = settings.REDISKV
 
 
 # NOTIFICATIONS
-@shared_task(rate_limit='20/s', queue='send_telegram_message')
-def send_telegram_message(message, chat_id):
-    data = {
-        "chat_id": chat_id,
-        "text": message,
-        "parse_mode": "HTML",
-        "disable_web_page_preview": True
+@shared_task(queue='send_telegram_message')
+def send_telegram_message(message, chat_id, claim=None):
+    """
+        Queues a message for `flush_telegram_messages`, cheap enough to call inline.
+        The outbox notification `claim` (see `outbox.get_claim`) is completed once the message is sent.
+    """
+    delay = telegram_sender.AGGREGATION_WINDOW
+    if TELEGRAM_SENDER.queue(chat_id, message, claim=claim) and TELEGRAM_SENDER.claim_flush(delay):
+        flush_telegram_messages.apply_async(countdown=delay, kwargs={'scheduled': True})
+    return f"send notification to {chat_id}"
+
+
+@shared_task(queue='send_telegram_message')
+def flush_telegram_messages(scheduled=False):
+    """
+        Sends the queued telegram messages. At most one flush is `scheduled` at a time,
+        it reschedules itself while messages are left, the periodic ones only start it.
+    """
+    next_due = TELEGRAM_SENDER.flush(on_sent=outbox.confirm_notifications)
+    if scheduled:
+        if next_due is not None:
+            TELEGRAM_SENDER.claim_flush(next_due, extend=True)
+            flush_telegram_messages.apply_async(countdown=next_due, kwargs={'scheduled': True})
+            return 'OK'
+        next_due = TELEGRAM_SENDER.release_flush()
+
+    if next_due is not None and TELEGRAM_SENDER.claim_flush(next_due):
+        flush_telegram_messages.apply_async(countdown=next_due, kwargs={'scheduled': True})
+    return 'OK'
+
+
+@shared_task(queue='webhooks')
+def send_webhook(recipient_id, data, transaction_id=None, attempt=1, log_id=None):
+    """
+        Delivers a webhook to a recipient, retrying this delivery alone with
+        exponential backoff while the call fails or the recipient's circuit is open.
+        The transaction is marked as acknowledged once delivered, and so is the
+        SmartBCH notification log `log_id` if given.
+    """
+    recipient = Recipient.objects.filter(id=recipient_id, valid=True).first()
+    if not recipient or not recipient.web_url:
+        return f"recipient {recipient_id} is no longer valid"
+
+    result = webhooks.WEBHOOK_DISPATCHER.post(recipient, data)
+    if result == webhooks.DELIVERED:
+        if transaction_id:
+            Transaction.objects.filter(id=transaction_id).update(acknowledged=True)
+        if log_id:
+            # Deferred import, the SmartBCH notifications depend on the tasks
+            from smartbch.models import TransactionTransferReceipientLog
+            TransactionTransferReceipientLog.objects.filter(id=log_id).update(sent_at=timezone.now())
+        LOGGER.info(f'ACKNOWLEDGEMENT SENT TO: {recipient.web_url} DATA: {str(data)}')
+    elif result in (webhooks.FAILED, webhooks.CIRCUIT_OPEN):
+        if attempt < webhooks.MAX_ATTEMPTS:
+            send_webhook.apply_async(
+                (recipient_id, data, transaction_id, attempt + 1),
+                kwargs={'log_id': log_id},
+                countdown=webhooks.get_retry_countdown(attempt)
+            )
+        else:
+            LOGGER.error(f'Giving up on webhook to {recipient.web_url} after {attempt} attempts: {str(data)}')
+    return f"{result} webhook to {recipient.web_url} (attempt {attempt})"
+
+
+
+def get_notification_data(transaction):
+    """
+        Webhook and websocket payload of an output, in the format of the wallet version
+    """
+    address = transaction.address
+    block = None
+    if transaction.blockheight:
+        block = transaction.blockheight.number
+
+    wallet_version = 1
+    if address.wallet:
+        wallet_version = address.wallet.version
+    else:
+        # Hardcoded date-based check for addresses that are not associated with wallets
+        v2_rollout_date_str = dateparse.parse_datetime('2021-09-11 00:00:00')
+        v2_rollout_date = pytz.UTC.localize(v2_rollout_date_str)
+        if address.date_created >= v2_rollout_date:
+            wallet_version = 2
+
+    if wallet_version == 2:
+        return {
+            'token_name': transaction.token.name,
+            'token_id':  'slp/' + transaction.token.tokenid if  transaction.token.tokenid  else 'bch',
+            'token_symbol': transaction.token.token_ticker.lower(),
+            'amount': transaction.amount,
+            'address': address.address,
+            'source': 'WatchTower',
+            'txid': transaction.txid,
+            'block': block,
+            'index': transaction.index,
+            'address_path' : address.address_path
+        }
+    return {
+        'amount': transaction.amount,
+        'address': address.address,
+        'source': 'WatchTower',
+        'token': transaction.token.tokenid or transaction.token.token_ticker.lower(),
+        'txid': transaction.txid,
+        'block': block,
+        'index': transaction.index,
+        'address_path' : address.address_path
     }
 
-    url = 'https://api.telegram.org/bot'
-    response = requests.post(
-        f"{url}{settings.TELEGRAM_BOT_TOKEN}/sendMessage", data=data
-    )
-    return f"send notification to {chat_id}"
-  
-
-@shared_task(bind=True, queue='client_acknowledgement', max_retries=3)
-def client_acknowledgement(self, txid):
-    this_transaction = Transaction.objects.filter(id=txid)
-    third_parties = []
-    if this_transaction.exists():
-        transaction = this_transaction.first()
-        block = None
-        if transaction.blockheight:
-            block = transaction.blockheight.number
-        
-        address = transaction.address
 
-            
-        subscriptions = Subscription.objects.filter(
-            address=address             
+def get_telegram_message(transaction):
+    if transaction.token.name != 'bch':
+        return f"""<b>WatchTower Notification</b> ℹ️
+            \n Address: {transaction.address.address}
+            \n Token: {transaction.token.name}
+            \n Token ID: {transaction.token.tokenid}
+            \n Amount: {transaction.amount}
+            \nhttps://explorer.bitcoin.com/bch/tx/{transaction.txid}
+        """
+    return f"""<b>WatchTower Notification</b> ℹ️
+        \n Address: {transaction.address.address}
+        \n Amount: {transaction.amount} BCH
+        \nhttps://explorer.bitcoin.com/bch/tx/{transaction.txid}
+    """
+
+
+def send_websocket_notification(transaction, data, rooms):
+    """
+        Pushes an output to its rooms with connections
+    """
+    channel_layer = get_channel_layer()
+    for room in rooms:
+        async_to_sync(channel_layer.group_send)(
+            room,
+            {
+                "type": "send_update",
+                "data": data
+            }
         )
 
-        if subscriptions.exists():
-            
-            for subscription in subscriptions:
 
-                recipient = subscription.recipient
-                websocket = subscription.websocket
+@shared_task(queue='client_acknowledgement')
+def send_websocket_updates(transaction_ids):
+    transactions = Transaction.objects.filter(id__in=transaction_ids).select_related(
+        'address__wallet',
+        'token',
+        'blockheight'
+    )
+    sent = 0
+    for transaction in transactions:
+        rooms = PRESENCE.filter(get_address_rooms(transaction.address.address, transaction.token.tokenid))
+        if rooms:
+            send_websocket_notification(transaction, get_notification_data(transaction), rooms)
+            sent += 1
+    return f'{sent} WEBSOCKET UPDATES'
 
-                wallet_version = 1
-                if address.wallet:
-                    wallet_version = address.wallet.version
-                else:
-                    # Hardcoded date-based check for addresses that are not associated with wallets
-                    v2_rollout_date_str = dateparse.parse_datetime('2021-09-11 00:00:00')
-                    v2_rollout_date = pytz.UTC.localize(v2_rollout_date_str)
-                    if address.date_created >= v2_rollout_date:
-                        wallet_version = 2
-
-                if wallet_version == 2:
-                    data = {
-                        'token_name': transaction.token.name,
-                        'token_id':  'slp/' + transaction.token.tokenid if  transaction.token.tokenid  else 'bch',
-                        'token_symbol': transaction.token.token_ticker.lower(),
-                        'amount': transaction.amount,
-                        'address': transaction.address.address,
-                        'source': 'WatchTower',
-                        'txid': transaction.txid,
-                        'block': block,
-                        'index': transaction.index,
-                        'address_path' : transaction.address.address_path
-                    }
-                elif wallet_version == 1:
-                    data = {
-                        'amount': transaction.amount,
-                        'address': transaction.address.address,
-                        'source': 'WatchTower',
-                        'token': transaction.token.tokenid or transaction.token.token_ticker.lower(),
-                        'txid': transaction.txid,
-                        'block': block,
-                        'index': transaction.index,
-                        'address_path' : transaction.address.address_path
-                    }
-
-                if recipient:
-                    if recipient.valid:
-                        if recipient.web_url:
-                            LOGGER.info(f"Webhook call to be sent to: {recipient.web_url}")
-                            LOGGER.info(f"Data: {str(data)}")
-                            resp = requests.post(recipient.web_url,data=data)
-                            if resp.status_code == 200:
-                                this_transaction.update(acknowledged=True)
-                                LOGGER.info(f'ACKNOWLEDGEMENT SENT TX INFO : {transaction.txid} TO: {recipient.web_url} DATA: {str(data)}')
-                            elif resp.status_code == 404 or resp.status_code == 522 or resp.status_code == 502:
-                                Recipient.objects.filter(id=recipient.id).update(valid=False)
-                                LOGGER.info(f"!!! ATTENTION !!! THIS IS AN INVALID DESTINATION URL: {recipient.web_url}")
-                            else:
-                                LOGGER.error(resp)
-                                self.retry(countdown=3)
-
-                        if recipient.telegram_id:
-
-                            if transaction.token.name != 'bch':
-                                message=f"""<b>WatchTower Notification</b> ℹ️
-                                    \n Address: {transaction.address.address}
-                                    \n Token: {transaction.token.name}
-                                    \n Token ID: {transaction.token.tokenid}
-                                    \n Amount: {transaction.amount}
-                                    \nhttps://explorer.bitcoin.com/bch/tx/{transaction.txid}
-                                """
-                            else:
-                                message=f"""<b>WatchTower Notification</b> ℹ️
-                                    \n Address: {transaction.address.address}
-                                    \n Amount: {transaction.amount} BCH
-                                    \nhttps://explorer.bitcoin.com/bch/tx/{transaction.txid}
-                                """
-
-                            args = ('telegram' , message, recipient.telegram_id)
-                            third_parties.append(args)
-                            this_transaction.update(acknowledged=True)
-
-                if websocket:
-                    
-                    tokenid = ''
-                    room_name = transaction.address.address.replace(':','_')
-                    room_name += f'_{tokenid}'
-                    channel_layer = get_channel_layer()
-                    async_to_sync(channel_layer.group_send)(
-                        f"{room_name}", 
-                        {
-                            "type": "send_update",
-                            "data": data
-                        }
-                    )
-                    if transaction.address.address.startswith('simpleledger:'):
-                        tokenid = transaction.token.tokenid
-                        room_name += f'_{tokenid}'
-                        channel_layer = get_channel_layer()
-                        async_to_sync(channel_layer.group_send)(
-                            f"{room_name}", 
-                            {
-                                "type": "send_update",
-                                "data": data
-                            }
-                        )
-    return third_parties
+
+def deliver_notification(notification):
+    """
+        Hands a claimed outbox notification to the queue of its channel, which
+        completes it once sent (see `outbox.get_claim`).
+        Returns (queued, error, retry).
+    """
+    transaction = notification.transaction
+    recipient = notification.subscription.recipient
+    if not recipient or not recipient.valid:
+        return False, 'invalid recipient', False
+
+    claim = outbox.get_claim(notification)
+    if notification.channel == Notification.TELEGRAM:
+        send_telegram_message(get_telegram_message(transaction), recipient.telegram_id, claim=claim)
+    else:
+        send_webhook_notification.delay(claim)
+    return True, None, False
+
+
+@shared_task(queue='webhooks')
+def send_webhook_notification(claim):
+    """
+        Makes a single delivery attempt of a webhook notification handed over by
+        `dispatch_notifications`, unless it's no longer held under `claim`
+        (e.g. its lease ran out and it was handed out again, or it was replayed).
+        Failed deliveries are retried by the outbox.
+    """
+    notification = outbox.get_claimed_notification(claim)
+    if notification is None:
+        return f'notification {claim} is no longer held'
+
+    transaction = notification.transaction
+    recipient = notification.subscription.recipient
+    if not recipient or not recipient.valid:
+        outbox.complete_notifications([], [(notification, 'invalid recipient', False)])
+        return f'notification {notification.id}: invalid recipient'
+
+    data = get_notification_data(transaction)
+    LOGGER.info(f"Webhook call to be sent to: {recipient.web_url}")
+    result = webhooks.WEBHOOK_DISPATCHER.post(recipient, data)
+    if result == webhooks.DELIVERED:
+        LOGGER.info(f'ACKNOWLEDGEMENT SENT TX INFO : {transaction.txid} TO: {recipient.web_url} DATA: {str(data)}')
+        outbox.complete_notifications([notification], [])
+    elif result == webhooks.INVALID:
+        outbox.complete_notifications([], [(notification, 'invalid destination url', False)])
+    else:
+        outbox.complete_notifications([], [(notification, result, True)])
+    return f'{result} webhook notification {notification.id} to {recipient.web_url}'
+
+
+@shared_task(queue='client_acknowledgement', time_limit=600)
+def dispatch_notifications(max_batches=50):
+    """
+        Drains the notification outbox. Any number of these can run at once,
+        each claims its own rows (see `outbox.claim_notifications`) and hands
+        them to the queue of their channel, so no delivery happens in here.
+    """
+    queued_count = failed_count = 0
+    for _ in range(max_batches):
+        notifications = outbox.claim_notifications()
+        if not notifications:
+            break
+
+        failed = []
+        queued = []
+        for notification in notifications:
+            try:
+                handed_over, error, retry = deliver_notification(notification)
+            except Exception as exc:
+                LOGGER.exception(f'ERROR in delivering notification {notification.id}: {exc}')
+                handed_over, error, retry = False, str(exc), True
+
+            if handed_over:
+                queued.append(notification)
+            else:
+                failed.append((notification, error, retry))
+
+        outbox.complete_notifications([], failed, queued=queued)
+        queued_count += len(queued)
+        failed_count += len(failed)
+
+    return f'QUEUED {queued_count} NOTIFICATIONS, {failed_count} FAILED'
+
+
+@shared_task(queue='client_acknowledgement')
+def client_acknowledgement(txid):
+    """
+        Sends the notifications of an output (again)
+    """
+    return outbox.replay_notifications([txid])
 
 
 @shared_task(queue='save_record')
-def save_record(token, transaction_address, transactionid, amount, source, blockheightid=None, index=0, new_subscription=False, spent_txids=[]):
+def save_record(token, transaction_address, transactionid, amount, source, blockheightid=None, index=0, new_subscription=False, spent_txids=[], value=None, notify=False):
     """
         token                : can be tokenid (slp token) or token name (bch)
         transaction_address  : the destination address where token had been deposited.
@@ -184,7 +302,13 @@ def save_record(token, transaction_address, transactionid, amount, source, block
         source               : the layer that summoned this function (e.g SLPDB, Bitsocket, BitDB, SLPFountainhead etc.)
         blockheight          : an optional argument indicating the block height number of a transaction.
         index          : used to make sure that each record is unique based on slp/bch address in a given transaction_id
+        value                : the amount in base units (satoshis / raw SLP amount), derived from `amount` if not given
+        notify               : queues the notifications of a newly created record to the outbox
     """
+    # Most outputs belong to addresses we don't know about, reject those without hitting the database
+    if not spent_txids and not WATCHED_ADDRESSES.contains(transaction_address):
+        return None, None
+
     subscription = Subscription.objects.filter(
         address__address=transaction_address             
     )
@@ -214,6 +338,9 @@ def save_record(token, transaction_address, transactionid, amount, source, block
             if created:
                 get_token_meta_data.delay(token)
 
+        if value is None:
+            value = to_base_units(amount, get_token_decimals(token_obj))
+
         # try:
 
         #     #  USE FILTER AND BULK CREATE AS A REPLACEMENT FOR GET_OR_CREATE        
@@ -239,41 +366,252 @@ def save_record(token, transaction_address, transactionid, amount, source, block
         # except IntegrityError:
         #     return None, None
 
-        try:
-            transaction_obj, transaction_created = Transaction.objects.get_or_create(
-                txid=transactionid,
-                address=address_obj,
-                token=token_obj,
-                amount=amount,
-                index=index
-            )
+        with trans.atomic():
+            try:
+                transaction_obj, transaction_created = Transaction.objects.get_or_create(
+                    txid=transactionid,
+                    address=address_obj,
+                    token=token_obj,
+                    amount=amount,
+                    index=index,
+                    defaults={'value': value}
+                )
 
-            if transaction_obj.source != source:
-                transaction_obj.source = source
+                if transaction_obj.value is None:
+                    transaction_obj.value = value
 
-        except IntegrityError as exc:
-            LOGGER.error('ERROR in saving txid: ' + transactionid)
-            LOGGER.error(str(exc))
-            return None, None
+                if transaction_obj.source != source:
+                    transaction_obj.source = source
 
-        if blockheightid is not None:
-            transaction_obj.blockheight_id = blockheightid
-            if new_subscription:
-                transaction_obj.acknowledged = True
+            except IntegrityError as exc:
+                LOGGER.error('ERROR in saving txid: ' + transactionid)
+                LOGGER.error(str(exc))
+                return None, None
 
-            # Automatically update all transactions with block height.
-            Transaction.objects.filter(txid=transactionid).update(blockheight_id=blockheightid)
+            if blockheightid is not None:
+                transaction_obj.blockheight_id = blockheightid
+                if new_subscription:
+                    transaction_obj.acknowledged = True
 
-        # Check if address belongs to a wallet
-        if address_obj.wallet:
-            transaction_obj.wallet = address_obj.wallet
+                # Automatically update all transactions with block height.
+                unconfirmed = Transaction.objects.filter(txid=transactionid).exclude(blockheight_id=blockheightid)
+                RESPONSE_CACHE.invalidate_outputs(unconfirmed)
+                unconfirmed.update(blockheight_id=blockheightid)
+
+            # Check if address belongs to a wallet
+            if address_obj.wallet:
+                transaction_obj.wallet = address_obj.wallet
+
+            # Save updates and trigger post-save signals
+            transaction_obj.save()
+
+            if notify and transaction_created and not new_subscription:
+                outbox.queue_notifications([transaction_obj.id])
+
+        wallet_hashes = [address_obj.wallet.wallet_hash] if address_obj.wallet else []
+        RESPONSE_CACHE.invalidate(wallet_hashes=wallet_hashes, addresses=[address_obj.address])
 
-        # Save updates and trigger post-save signals
-        transaction_obj.save()
-        
         return transaction_obj.id, transaction_created
 
 
+def _get_subscribed_addresses(addresses):
+    subscribed = set()
+    watched = WATCHED_ADDRESSES.filter(addresses)
+    for chunk in chunks(list(watched), 1000):
+        subscribed.update(
+            Subscription.objects.filter(
+                address__address__in=chunk
+            ).values_list('address__address', flat=True)
+        )
+    return subscribed
+
+
+def _get_or_create_addresses(addresses):
+    address_objs = {
+        x.address: x for x in Address.objects.filter(address__in=addresses).select_related('wallet')
+    }
+    missing = [x for x in addresses if x not in address_objs]
+    if missing:
+        rows = [{'address': x, 'address_path': ''} for x in missing]
+        Address.objects.on_conflict(['address'], ConflictAction.NOTHING).bulk_insert(rows)
+        address_objs.update({
+            x.address: x for x in Address.objects.filter(address__in=missing)
+        })
+        # Bulk inserts skip the post_save signal that keeps the index current
+        trans.on_commit(lambda: WATCHED_ADDRESSES.add(*missing))
+    return address_objs
+
+
+def _get_or_create_tokens(tokens):
+    token_objs = {}
+    for token in tokens:
+        if token.lower() == 'bch':
+            token_objs[token], _ = Token.objects.get_or_create(name=token)
+
+    tokenids = [x for x in tokens if x.lower() != 'bch']
+    for token_obj in Token.objects.filter(tokenid__in=tokenids):
+        token_objs[token_obj.tokenid] = token_obj
+
+    missing = [x for x in tokenids if x not in token_objs]
+    if missing:
+        rows = [{'tokenid': x, 'name': '', 'token_ticker': ''} for x in missing]
+        Token.objects.on_conflict(['tokenid'], ConflictAction.NOTHING).bulk_insert(rows)
+        for token_obj in Token.objects.filter(tokenid__in=missing):
+            token_objs[token_obj.tokenid] = token_obj
+            get_token_meta_data.delay(token_obj.tokenid)
+    return token_objs
+
+
+def save_records(records, source, blockheight_id=None, new_subscription=False, post_save=True, notify=False):
+    """
+        Batched version of `save_record`.
+
+        records              : list of dicts with the keys `token`, `address`, `txid`, `amount`, `index`
+                               and optionally `value` and `spent_txids` (see `save_record`).
+        source               : the layer that summoned this function.
+        blockheight_id       : an optional block height id shared by all records.
+        new_subscription     : marks records saved with a block height as acknowledged.
+        post_save            : queues the created records for post-processing.
+        notify               : queues the notifications of the created records to the outbox.
+
+        Returns a list of (transaction_id, created) tuples in the same order as `records`,
+        (None, None) for records that are not tracked.
+    """
+    results = [(None, None)] * len(records)
+    if not records:
+        return results
+
+    # We are only tracking outputs of either subscribed addresses or those of transactions
+    # that spend previous transactions with outputs involving tracked addresses
+    subscribed = _get_subscribed_addresses({x['address'] for x in records})
+    spent_txids = set()
+    for record in records:
+        spent_txids.update(record.get('spent_txids') or [])
+    tracked_spent_txids = set()
+    for chunk in chunks(list(spent_txids), 1000):
+        tracked_spent_txids.update(
+            Transaction.objects.filter(txid__in=chunk).values_list('txid', flat=True).distinct()
+        )
+
+    tracked = []
+    for position, record in enumerate(records):
+        if record['address'] in subscribed or tracked_spent_txids.intersection(record.get('spent_txids') or []):
+            tracked.append((position, record))
+    if not tracked:
+        return results
+
+    with trans.atomic():
+        addresses = _get_or_create_addresses({x['address'] for _, x in tracked})
+        tokens = _get_or_create_tokens({x['token'] for _, x in tracked})
+        txids = {x['txid'] for _, x in tracked}
+
+        existing = {}
+        existing_qs = Transaction.objects.filter(txid__in=txids).values_list(
+            'id', 'txid', 'address_id', 'index', 'wallet_id'
+        )
+        for obj_id, txid, address_id, index, wallet_id in existing_qs:
+            existing[(txid, address_id, index)] = (obj_id, wallet_id)
+
+        rows = []
+        # Positions of the records of each output to insert, by (txid, address_id, index)
+        pending = {}
+        wallet_updates = {}
+        for position, record in tracked:
+            address_obj = addresses[record['address']]
+            try:
+                index = int(record['index'])
+            except TypeError:
+                index = 0
+
+            key = (record['txid'], address_obj.id, index)
+            if key in existing:
+                obj_id, wallet_id = existing[key]
+                results[position] = (obj_id, False)
+                if address_obj.wallet_id and address_obj.wallet_id != wallet_id:
+                    wallet_updates.setdefault(address_obj.wallet_id, []).append(obj_id)
+                continue
+            if key in pending:
+                # Guard against the same output being listed twice in one batch
+                pending[key].append(position)
+                continue
+
+            value = record.get('value')
+            if value is None:
+                value = to_base_units(record['amount'], get_token_decimals(tokens[record['token']]))
+
+            row = {
+                'txid': record['txid'],
+                'address_id': address_obj.id,
+                'token_id': tokens[record['token']].id,
+                'amount': record['amount'],
+                'value': value,
+                'index': index,
+                'source': source,
+                'blockheight_id': blockheight_id,
+                'acknowledged': True if blockheight_id is not None and new_subscription else None,
+                'wallet_id': address_obj.wallet_id
+            }
+            pending[key] = [position]
+            rows.append(row)
+
+        inserted = {}
+        if rows:
+            # Only the rows actually inserted are returned, not those that conflicted
+            created = Transaction.objects.on_conflict(
+                ['txid', 'address', 'index'],
+                ConflictAction.NOTHING
+            ).bulk_insert(rows)
+            inserted = {(x['txid'], x['address_id'], x['index']): x['id'] for x in created}
+
+            # The rest were saved in the meantime by someone else (e.g. the mempool stream and a block scan)
+            concurrent = {}
+            conflicted = [key for key in pending if key not in inserted]
+            if conflicted:
+                concurrent_qs = Transaction.objects.filter(
+                    txid__in={txid for txid, _, _ in conflicted}
+                ).values_list('id', 'txid', 'address_id', 'index')
+                for obj_id, txid, address_id, index in concurrent_qs:
+                    concurrent[(txid, address_id, index)] = obj_id
+
+            for key, positions in pending.items():
+                if key in inserted:
+                    results[positions[0]] = (inserted[key], True)
+                    positions = positions[1:]
+                obj_id = inserted.get(key) or concurrent.get(key)
+                for position in positions:
+                    results[position] = (obj_id, False)
+
+            if notify and not new_subscription and inserted:
+                outbox.queue_notifications(inserted.values())
+
+        existing_ids = [x for x, created in results if x and not created]
+        if existing_ids:
+            Transaction.objects.filter(id__in=existing_ids).exclude(source=source).update(source=source)
+        for wallet_id, obj_ids in wallet_updates.items():
+            Transaction.objects.filter(id__in=obj_ids).update(wallet_id=wallet_id)
+
+        if blockheight_id is not None:
+            # Automatically update all transactions with block height, including
+            # outputs of other addresses whose cached responses change as well
+            unconfirmed = Transaction.objects.filter(txid__in=txids).exclude(blockheight_id=blockheight_id)
+            RESPONSE_CACHE.invalidate_outputs(unconfirmed)
+            unconfirmed.update(blockheight_id=blockheight_id)
+            if new_subscription and existing_ids:
+                Transaction.objects.filter(id__in=existing_ids).update(acknowledged=True)
+
+        RESPONSE_CACHE.invalidate(
+            wallet_hashes={x.wallet.wallet_hash for x in addresses.values() if x.wallet},
+            addresses=addresses.keys()
+        )
+
+    # Bulk inserts skip the post_save signal, queue the post-processing explicitly
+    if post_save:
+        for txid in {txid for txid, _, _ in inserted}:
+            queue_transaction_post_save(txid, blockheight_id)
+
+    return results
+
+
 @shared_task(queue='bchdquery_transaction')
 def bchdquery_transaction(txid, block_id, alert=True):
     source ='bchd'
@@ -292,15 +630,10 @@ def bchdquery_transaction(txid, block_id, alert=True):
                 amount,
                 source,
                 blockheightid=block_id,
-                index=index
+                index=index,
+                value=output.value,
+                notify=alert
             )
-            if created and alert:
-                third_parties = client_acknowledgement(obj_id)
-                for platform in third_parties:
-                    if 'telegram' in platform:
-                        message = platform[1]
-                        chat_id = platform[2]
-                        send_telegram_message(message, chat_id)
 
         if output.slp_token.token_id:
             token_id = bytearray(output.slp_token.token_id).hex()
@@ -313,84 +646,95 @@ def bchdquery_transaction(txid, block_id, alert=True):
                 amount,
                 source,
                 blockheightid=block_id,
-                index=index
-            )            
-            if created and alert:
-                third_parties = client_acknowledgement(obj_id)
-                for platform in third_parties:
-                    if 'telegram' in platform:
-                        message = platform[1]
-                        chat_id = platform[2]
-                        send_telegram_message(message, chat_id)
+                index=index,
+                value=output.slp_token.amount,
+                notify=alert
+            )
 
         index += 1
 
 
+def _get_block_outputs(transactions):
+    """
+        Flatten the full transactions of a block into the BCH and SLP outputs
+        that would otherwise be passed one by one to `save_record`.
+    """
+    outputs = []
+    for tr in transactions:
+        txn = tr.transaction
+        txid = bytearray(txn.hash[::-1]).hex()
+        for index, output in enumerate(txn.outputs):
+            if output.address:
+                outputs.append({
+                    'token': 'bch',
+                    'address': 'bitcoincash:%s' % output.address,
+                    'txid': txid,
+                    'amount': output.value / (10 ** 8),
+                    'value': output.value,
+                    'index': index
+                })
+            if output.slp_token.token_id:
+                outputs.append({
+                    'token': bytearray(output.slp_token.token_id).hex(),
+                    'address': 'simpleledger:%s' % output.slp_token.address,
+                    'txid': txid,
+                    'amount': output.slp_token.amount / (10 ** output.slp_token.decimals),
+                    'value': output.slp_token.amount,
+                    'index': index
+                })
+    return outputs
+
+
+def save_block_outputs(block, outputs, source='bchd', notify=False):
+    """
+        Persist the outputs of a block that pay to subscribed addresses and tag
+        the tracked records of the block's transactions with its height.
+        Returns the ids of the newly created Transaction records.
+    """
+    results = save_records(outputs, source, blockheight_id=block.id, notify=notify)
+    return [obj_id for obj_id, created in results if created]
+
+
+@shared_task(bind=True, queue='bchdquery_block')
+def bchdquery_block(self, block_number, alert=True):
+    block = BlockHeight.objects.filter(number=block_number).first()
+    if block is None:
+        # Dropped in a reorg that shortened the chain
+        block_scanner.BLOCK_QUEUE.complete(block_number)
+        return f'BLOCK {block_number} IS NO LONGER IN THE CHAIN'
+    try:
+        bchd = BCHDQuery()
+        transactions = bchd.get_block(block.number, full_transactions=True)
+        outputs = _get_block_outputs(transactions)
+        created_ids = save_block_outputs(block, outputs, notify=alert)
+        block_hash = bchd.get_block_hash(block.number)
+    except Exception as exc:
+        LOGGER.error(f'ERROR in processing block {block_number}: {str(exc)}')
+        # Leave the block unprocessed so it gets picked up again
+        block_scanner.release_block(block_number)
+        raise
+
+    ready_to_accept(block.number, len(transactions), block_hash)
+    return f'BLOCK {block.number}: {len(created_ids)} NEW RECORDS FROM {len(transactions)} TRANSACTIONS'
+
+
 @shared_task(bind=True, queue='manage_blocks')
-def ready_to_accept(self, block_number, txs_count):
-    BlockHeight.objects.filter(number=block_number).update(
-        processed=True,
-        transactions_count=txs_count,
-        updated_datetime=timezone.now()
-    )
-    REDIS_STORAGE.set('READY', 1)
-    REDIS_STORAGE.set('ACTIVE-BLOCK', '')
+def ready_to_accept(self, block_number, txs_count, block_hash=None):
+    block_scanner.complete_block(block_number, txs_count, block_hash=block_hash)
     return 'OK'
 
 
 @shared_task(bind=True, queue='manage_blocks')
 def manage_blocks(self):
-    if b'READY' not in REDIS_STORAGE.keys(): REDIS_STORAGE.set('READY', 1)
-    if b'ACTIVE-BLOCK' not in REDIS_STORAGE.keys(): REDIS_STORAGE.set('ACTIVE-BLOCK', '')
-    if b'PENDING-BLOCKS' not in REDIS_STORAGE.keys(): REDIS_STORAGE.set('PENDING-BLOCKS', json.dumps([]))
-    
-    pending_blocks = REDIS_STORAGE.get('PENDING-BLOCKS').decode()
-    blocks = json.loads(pending_blocks)
-    blocks.sort()
+    # Progress is checkpointed on each BlockHeight, so any number of blocks
+    # (up to the scan window) can be in flight and lost tasks are retried
+    block_scanner.fill_gaps()
+    numbers = block_scanner.claim_blocks()
+    for number in numbers:
+        bchdquery_block.delay(number)
 
-    if len(blocks) == 0:
-        unscanned_blocks = BlockHeight.objects.filter(
-            processed=False,
-            requires_full_scan=True
-        ).values_list('number', flat=True)
-        REDIS_STORAGE.set('PENDING-BLOCKS', json.dumps(list(unscanned_blocks)))
-
-
-    if int(REDIS_STORAGE.get('READY').decode()): LOGGER.info('READY TO PROCESS ANOTHER BLOCK')
-    if not blocks: return 'NO PENDING BLOCKS'
-    
-    discard_block = False
-    if int(REDIS_STORAGE.get('READY').decode()):
-        try:
-            active_block = blocks[0]
-            block = BlockHeight.objects.get(number=active_block)
-        except BlockHeight.DoesNotExist:
-            discard_block = True   
-    
-        if active_block in blocks:
-            blocks.remove(active_block)
-            blocks = list(set(blocks))  # Uniquify the list
-            blocks.sort()  # Then sort, ascending
-            pending_blocks = json.dumps(blocks)
-            REDIS_STORAGE.set('PENDING-BLOCKS', pending_blocks)
-
-        if not discard_block:
-            REDIS_STORAGE.set('ACTIVE-BLOCK', active_block)
-            REDIS_STORAGE.set('READY', 0)
-            bchd = BCHDQuery()
-            transactions = bchd.get_block(block.number, full_transactions=False)
-            subtasks = []
-            for tr in transactions:
-                txid = bytearray(tr.transaction_hash[::-1]).hex()
-                subtasks.append(bchdquery_transaction.si(txid, block.id))
-            callback = ready_to_accept.si(block.number, len(subtasks))
-            # Execute the workflow
-            if subtasks:
-                workflow = chord(subtasks)(callback)
-                workflow.apply_async()
-
-    active_block = str(REDIS_STORAGE.get('ACTIVE-BLOCK').decode())
-    if active_block: return f'CURRENTLY PROCESSING BLOCK {str(active_block)}.'
+    if not numbers: return 'NO PENDING BLOCKS'
+    return f'SCANNING BLOCKS {", ".join(str(x) for x in numbers)}'
 
 
 @shared_task(bind=True, queue='get_latest_block')
@@ -398,67 +742,208 @@ def get_latest_block(self):
     # This task is intended to check new blockheight every 5 seconds through BCHD @ fountainhead.cash
     LOGGER.info('CHECKING THE LATEST BLOCK')
     bchd = BCHDQuery()
-    number = bchd.get_latest_block()
+    number, block_hash = bchd.get_chain_tip()
+
+    reorged = reorg.find_reorged_blocks(bchd, number)
+    if reorged:
+        reorg.rollback_blocks(reorged, tip_number=number)
+
     obj, created = BlockHeight.objects.get_or_create(number=number)
+    if created or reorged:
+        send_confirmation_updates.delay(number)
     if created: return f'*** NEW BLOCK { obj.number } ***'
 
 
+@shared_task(queue='client_acknowledgement')
+def send_confirmation_updates(tip_number):
+    """
+        Notifies the websocket subscribers of the outputs that reach the confirmation
+        limit of their token with block `tip_number`. Confirmations are otherwise
+        derived from the block height on read, nothing is stored per block.
+    """
+    transactions = Transaction.objects.filter(
+        token__confirmation_limit__gt=0,
+        blockheight__number=tip_number + 1 - F('token__confirmation_limit')
+    ).select_related('address', 'token', 'blockheight')
+
+    channel_layer = get_channel_layer()
+    sent = 0
+    for transaction in transactions:
+        rooms = PRESENCE.filter(get_address_rooms(transaction.address.address, transaction.token.tokenid))
+        if not rooms:
+            continue
+
+        data = {
+            'txid': transaction.txid,
+            'index': transaction.index,
+            'address': transaction.address.address,
+            'token_id': 'slp/' + transaction.token.tokenid if transaction.token.tokenid else 'bch',
+            'block': transaction.blockheight.number,
+            'confirmations': tip_number - transaction.blockheight.number + 1
+        }
+        for room in rooms:
+            async_to_sync(channel_layer.group_send)(
+                room,
+                {
+                    "type": "send_update",
+                    "data": data
+                }
+            )
+        sent += 1
+    return f'{sent} CONFIRMATION UPDATES FOR BLOCK {tip_number}'
+
+
+def _get_or_create_blocks(numbers):
+    """
+        Bulk version of `BlockHeight.objects.get_or_create` for a set of block numbers.
+        Returns a dict of block number to `BlockHeight`.
+    """
+    block_objs = {x.number: x for x in BlockHeight.objects.filter(number__in=numbers)}
+    missing = [x for x in numbers if x not in block_objs]
+    if missing:
+        now = timezone.now()
+        # Bulk inserts skip `BlockHeight.save` and its post_save signal, mirror both here
+        rows = [
+            {
+                'number': x,
+                'created_datetime': now,
+                'requires_full_scan': x >= settings.START_BLOCK
+            }
+            for x in missing
+        ]
+        created = BlockHeight.objects.on_conflict(['number'], ConflictAction.NOTHING).bulk_insert(rows)
+        created_ids = {x['id'] for x in created}
+        for block_obj in BlockHeight.objects.filter(number__in=missing):
+            block_objs[block_obj.number] = block_obj
+            if block_obj.id in created_ids and block_obj.requires_full_scan:
+                block_scanner.BLOCK_QUEUE.add(block_obj.number)
+    return block_objs
+
+
+def reconcile_utxos(address, utxos, source='bchd-query'):
+    """
+        Makes the unspent outputs of `address` in the database match its UTXO set.
+
+        utxos                : list of dicts with the keys `token`, `txid`, `index`, `amount`, `value`
+                               and `block` (the block height number), e.g. as reported by BCHD.
+        source               : the layer that summoned this function.
+
+        Both sets are loaded at once and diffed in memory, then the missing outputs are
+        inserted, the known ones marked unspent and the rest of the address's unspent
+        outputs marked spent, each as a single statement instead of a few queries per output.
+        Outputs are matched on their outpoint (txid, index).
+
+        Returns a tuple of the number of outputs created, marked unspent and marked spent.
+    """
+    utxos = {(x['txid'], int(x['index'])): x for x in utxos}
+    txids = {txid for txid, _ in utxos.keys()}
+
+    with trans.atomic():
+        existing = {}
+        outputs = Transaction.objects.filter(
+            address__address=address
+        ).filter(
+            Q(spent=False) | Q(txid__in=txids)
+        ).values_list('id', 'txid', 'index', 'spent')
+        for obj_id, txid, index, spent in outputs:
+            existing[(txid, index)] = (obj_id, spent)
+
+        unspend_ids = [obj_id for key, (obj_id, spent) in existing.items() if key in utxos and spent]
+        spend_ids = [obj_id for key, (obj_id, spent) in existing.items() if key not in utxos and not spent]
+        missing = [x for key, x in utxos.items() if key not in existing]
+
+        created = []
+        # Outputs of addresses we don't track are left alone, same as `save_record` does
+        if missing and _get_subscribed_addresses({address}):
+            address_obj = _get_or_create_addresses({address})[address]
+            tokens = _get_or_create_tokens({x['token'] for x in missing})
+            blocks = _get_or_create_blocks({x['block'] for x in missing})
+            rows = [
+                {
+                    'txid': x['txid'],
+                    'address_id': address_obj.id,
+                    'token_id': tokens[x['token']].id,
+                    'amount': x['amount'],
+                    'value': x['value'],
+                    'index': int(x['index']),
+                    'source': source,
+                    'blockheight_id': blocks[x['block']].id,
+                    'acknowledged': True,
+                    'wallet_id': address_obj.wallet_id
+                }
+                for x in missing
+            ]
+            created = Transaction.objects.on_conflict(
+                ['txid', 'address', 'index'],
+                ConflictAction.NOTHING
+            ).bulk_insert(rows)
+
+        if unspend_ids:
+            Transaction.objects.filter(id__in=unspend_ids).update(spent=False)
+        if spend_ids:
+            Transaction.objects.filter(id__in=spend_ids).update(spent=True)
+
+        if created:
+            created_ids = [x['id'] for x in created]
+            RESPONSE_CACHE.invalidate_outputs(
+                Transaction.objects.filter(txid__in={x['txid'] for x in created})
+            )
+            with connection.cursor() as cursor:
+                # Tag the other outputs of the new records' transactions with their block height
+                cursor.execute(
+                    """
+                        UPDATE main_transaction t
+                        SET blockheight_id = n.blockheight_id
+                        FROM main_transaction n
+                        WHERE n.id = ANY(%s)
+                            AND t.txid = n.txid
+                            AND t.blockheight_id IS DISTINCT FROM n.blockheight_id
+                    """,
+                    [created_ids]
+                )
+                # Blocks that won't be scanned are complete with what we know of them
+                cursor.execute(
+                    """
+                        UPDATE main_blockheight b
+                        SET processed = TRUE, transactions_count = (
+                            SELECT COUNT(*) FROM main_transaction t WHERE t.blockheight_id = b.id
+                        )
+                        WHERE b.requires_full_scan = FALSE
+                            AND b.id IN (SELECT blockheight_id FROM main_transaction WHERE id = ANY(%s))
+                    """,
+                    [created_ids]
+                )
+
+    # Bulk inserts skip the post_save signal, queue the post-processing explicitly
+    blockheights = {x['txid']: x['blockheight_id'] for x in created}
+    for txid, blockheight_id in blockheights.items():
+        queue_transaction_post_save(txid, blockheight_id)
+
+    RESPONSE_CACHE.invalidate(
+        wallet_hashes=Address.objects.filter(address=address).values_list('wallet__wallet_hash', flat=True),
+        addresses=[address]
+    )
+    return len(created), len(unspend_ids), len(spend_ids)
+
+
 @shared_task(bind=True, queue='get_utxos', max_retries=10)
 def get_bch_utxos(self, address):
     try:
         obj = BCHDQuery()
         outputs = obj.get_utxos(address)
-        source = 'bchd-query'
-        saved_utxo_ids = []
-        for output in outputs:
-            hash = output.outpoint.hash 
-            index = output.outpoint.index
-            block = output.block_height
-            tx_hash = bytearray(hash[::-1]).hex()
-            amount = output.value / (10 ** 8)
-            
-            block, created = BlockHeight.objects.get_or_create(number=block)
-            transaction_obj = Transaction.objects.filter(
-                txid=tx_hash,
-                address__address=address,
-                amount=amount,
-                index=index
-            )
-            if not transaction_obj.exists():
-                args = (
-                    'bch',
-                    address,
-                    tx_hash,
-                    amount,
-                    source,
-                    block.id,
-                    index,
-                    True
-                )
-                txn_id, created = save_record(*args)
-                transaction_obj = Transaction.objects.filter(id=txn_id)
-
-                if created:
-                    if not block.requires_full_scan:
-                        qs = BlockHeight.objects.filter(id=block.id)
-                        count = qs.first().transactions.count()
-                        qs.update(processed=True, transactions_count=count)
-            
-            if transaction_obj.exists():
-                # Mark as unspent, just in case it's already marked spent
-                transaction_obj.update(spent=False)
-                for obj in transaction_obj:
-                    saved_utxo_ids.append(obj.id)
-
-        # Mark other transactions of the same address as spent
-        txn_check = Transaction.objects.filter(
-            address__address=address,
-            spent=False
-        ).exclude(
-            id__in=saved_utxo_ids
-        ).update(
-            spent=True
-        )
+        utxos = [
+            {
+                'token': 'bch',
+                'txid': bytearray(output.outpoint.hash[::-1]).hex(),
+                'index': output.outpoint.index,
+                'amount': output.value / (10 ** 8),
+                'value': output.value,
+                'block': output.block_height
+            }
+            for output in outputs
+        ]
+        created, unspent, spent = reconcile_utxos(address, utxos)
+        return f'{address}: {len(utxos)} UTXOS, {created} NEW, {unspent} UNSPENT, {spent} SPENT'
 
     except Exception as exc:
         try:
@@ -473,63 +958,20 @@ def get_slp_utxos(self, address):
     try:
         obj = BCHDQuery()
         outputs = obj.get_utxos(address)
-        source = 'bchd-query'
-        saved_utxo_ids = []
-        for output in outputs:
-            if output.slp_token.token_id:
-                hash = output.outpoint.hash 
-                tx_hash = bytearray(hash[::-1]).hex()
-                index = output.outpoint.index
-                token_id = bytearray(output.slp_token.token_id).hex() 
-                amount = output.slp_token.amount / (10 ** output.slp_token.decimals)
-                block = output.block_height
-                
-                block, _ = BlockHeight.objects.get_or_create(number=block)
-
-                token_obj, _ = Token.objects.get_or_create(tokenid=token_id)
-
-                transaction_obj = Transaction.objects.filter(
-                    txid=tx_hash,
-                    address__address=address,
-                    token=token_obj,
-                    amount=amount,
-                    index=index
-                )
-                if not transaction_obj.exists():
-                    args = (
-                        token_id,
-                        address,
-                        tx_hash,
-                        amount,
-                        source,
-                        block.id,
-                        index,
-                        True
-                    )
-                    txn_id, created = save_record(*args)
-                    transaction_obj = Transaction.objects.filter(id=txn_id)
-                    
-                    if created:
-                        if not block.requires_full_scan:
-                            qs = BlockHeight.objects.filter(id=block.id)
-                            count = qs.first().transactions.count()
-                            qs.update(processed=True, transactions_count=count)
-                
-                if transaction_obj.exists():
-                    # Mark as unspent, just in case it's already marked spent
-                    transaction_obj.update(spent=False)
-                    for obj in transaction_obj:
-                        saved_utxo_ids.append(obj.id)
-        
-        # Mark other transactions of the same address as spent
-        txn_check = Transaction.objects.filter(
-            address__address=address,
-            spent=False
-        ).exclude(
-            id__in=saved_utxo_ids
-        ).update(
-            spent=True
-        )
+        utxos = [
+            {
+                'token': bytearray(output.slp_token.token_id).hex(),
+                'txid': bytearray(output.outpoint.hash[::-1]).hex(),
+                'index': output.outpoint.index,
+                'amount': output.slp_token.amount / (10 ** output.slp_token.decimals),
+                'value': output.slp_token.amount,
+                'block': output.block_height
+            }
+            for output in outputs
+            if output.slp_token.token_id
+        ]
+        created, unspent, spent = reconcile_utxos(address, utxos)
+        return f'{address}: {len(utxos)} UTXOS, {created} NEW, {unspent} UNSPENT, {spent} SPENT'
 
     except Exception as exc:
         try:
@@ -613,6 +1055,23 @@ def get_token_meta_data(self, token_id):
 
             token_obj.save()
 
+            # Fill in the base unit amounts saved before the decimals were known. Outputs
+            # saved from now on get theirs from a trigger, and those still being saved
+            # without one hold the token until they commit (see migration 0059)
+            if token_obj.decimals is not None:
+                multiplier = 10 ** token_obj.decimals
+                # The cached responses are dropped once the values are committed
+                with trans.atomic():
+                    missing_values = Transaction.objects.filter(token=token_obj, value__isnull=True)
+                    RESPONSE_CACHE.invalidate_outputs(missing_values)
+                    missing_values.update(value=Round(F('amount') * multiplier))
+
+                    missing_values = WalletHistory.objects.filter(token=token_obj, value__isnull=True)
+                    RESPONSE_CACHE.invalidate(
+                        wallet_hashes=set(missing_values.values_list('wallet__wallet_hash', flat=True).distinct())
+                    )
+                    missing_values.update(value=Round(F('amount') * multiplier))
+
             # Get image / logo URL
             image_file_name = None
             image_url = None
@@ -723,7 +1182,7 @@ def broadcast_transaction(self, transaction):
 def parse_wallet_history(self, txid, wallet_handle, tx_fee=None, senders=[], recipients=[]):
     wallet_hash = wallet_handle.split('|')[1]
     parser = HistoryParser(txid, wallet_hash)
-    record_type, amount, change_address = parser.parse()
+    record_type, amount, change_address, value = parser.parse()
     wallet = Wallet.objects.get(wallet_hash=wallet_hash)
     if wallet.wallet_type == 'bch':
         txns = Transaction.objects.filter(
@@ -748,6 +1207,7 @@ def parse_wallet_history(self, txid, wallet_handle, tx_fee=None, senders=[], rec
             history_check.update(
                 record_type=record_type,
                 amount=amount,
+                value=value,
                 token=txn.token
             )
             if tx_fee and senders and recipients:
@@ -762,6 +1222,7 @@ def parse_wallet_history(self, txid, wallet_handle, tx_fee=None, senders=[], rec
                 txid=txid,
                 record_type=record_type,
                 amount=amount,
+                value=value,
                 token=txn.token,
                 tx_fee=tx_fee,
                 senders=senders,
@@ -792,25 +1253,100 @@ def parse_wallet_history(self, txid, wallet_handle, tx_fee=None, senders=[], rec
                         wallet_nft_token.dispensation_transaction = txn
                         wallet_nft_token.save()
 
+        RESPONSE_CACHE.invalidate(wallet_hashes=[wallet_hash])
 
-@shared_task(bind=True, queue='post_save_record', max_retries=10)
-def transaction_post_save_task(self, address, transaction_id, blockheight_id=None):
-    transaction = Transaction.objects.get(id=transaction_id)
-    txid = transaction.txid
-    blockheight = None
+
+_REDIS_NAME__POST_SAVE_PENDING = 'post-save:pending-txids'
+_REDIS_NAME__POST_SAVE_BLOCKHEIGHTS = 'post-save:blockheights'
+_REDIS_NAME__POST_SAVE_ATTEMPTS = 'post-save:attempts'
+_REDIS_NAME__POST_SAVE_SCHEDULED = 'post-save:flush-scheduled'
+
+# Saves of the same txid within this many seconds are post-processed once
+POST_SAVE_WINDOW = 2
+POST_SAVE_BATCH_SIZE = 100
+POST_SAVE_MAX_ATTEMPTS = 10
+
+
+def _schedule_post_save_flush(countdown=POST_SAVE_WINDOW):
+    # Only one flush is scheduled per window, the flag expires in case the task gets lost
+    scheduled = REDIS_STORAGE.set(_REDIS_NAME__POST_SAVE_SCHEDULED, 1, nx=True, ex=POST_SAVE_WINDOW * 10)
+    if scheduled:
+        process_pending_transactions.apply_async(countdown=countdown)
+
+
+def queue_transaction_post_save(txid, blockheight_id=None):
+    """
+        Queues a saved transaction for post-processing. Repeated calls for the
+        same txid before the next flush are coalesced into a single unit of work.
+    """
+    pipe = REDIS_STORAGE.pipeline()
+    pipe.sadd(_REDIS_NAME__POST_SAVE_PENDING, txid)
     if blockheight_id:
-        blockheight = BlockHeight.objects.get(id=blockheight_id)
+        pipe.hset(_REDIS_NAME__POST_SAVE_BLOCKHEIGHTS, txid, blockheight_id)
+    pipe.execute()
+    _schedule_post_save_flush()
+
+
+def _mark_inputs_spent(spending_txid, inputs):
+    """
+        Marks the outputs consumed by `inputs` as spent and returns them
+    """
+    outpoints = {(x['txid'], x['spent_index']) for x in inputs}
+    if not outpoints:
+        return []
+
+    spent = []
+    prev_txids = {x for x, _ in outpoints}
+    for chunk in chunks(list(prev_txids), 1000):
+        candidates = Transaction.objects.filter(txid__in=chunk).select_related('token', 'address', 'wallet')
+        spent += [x for x in candidates if (x.txid, x.index) in outpoints]
+
+    if spent:
+        Transaction.objects.filter(id__in=[x.id for x in spent]).update(
+            spent=True,
+            spending_txid=spending_txid
+        )
+        RESPONSE_CACHE.invalidate_transactions(spent)
+    return spent
+
+
+def process_transaction(txid, blockheight_id=None):
+    """
+        Post-processing of a saved transaction: marks the outputs it spends,
+        saves its remaining tracked outputs and queues the history parsing of
+        every wallet involved. The transaction is fetched from BCHD only once
+        and parsed locally for both BCH and SLP.
+
+        Returns False if the transaction can't be fetched from BCHD yet.
+    """
+    records = list(
+        Transaction.objects.filter(txid=txid).select_related('address__wallet')
+    )
+    if not records:
+        return True
 
     wallets = []
-    txn_address = Address.objects.get(address=address)
-    if txn_address.wallet:
-        wallets.append(txn_address.wallet.wallet_type + '|' + txn_address.wallet.wallet_hash)
+    record_wallet_types = set()
+    slp_record = None
+    for record in records:
+        wallet = record.address.wallet
+        if wallet:
+            wallets.append(wallet.wallet_type + '|' + wallet.wallet_hash)
+            record_wallet_types.add(wallet.wallet_type)
+        if slp_record is None and record.address.address.startswith('simpleledger'):
+            slp_record = record
 
+    bchd = BCHDQuery()
+    txn = bchd._get_raw_transaction(txid)
+    if txn is None:
+        return False
+    bch_tx = bchd._parse_transaction(txn)
     slp_tx = None
-    bch_tx = None
+    if slp_record:
+        slp_tx = bchd._parse_transaction(txn, parse_slp=True)
 
     # Extract tx_fee, senders, and recipients
-    tx_fee = 0
+    tx_fee = bch_tx['tx_fee']
     senders = {
         'bch': [],
         'slp': []
@@ -819,172 +1355,76 @@ def transaction_post_save_task(self, address, transaction_id, blockheight_id=Non
         'bch': [],
         'slp': []
     }
+    if slp_tx and slp_tx['valid']:
+        if 'slp' in record_wallet_types:
+            senders['slp'] = [(i['address'], i['amount']) for i in slp_tx['inputs'] if 'amount' in i.keys()]
+        recipients['slp'] = [(i['address'], i['amount']) for i in slp_tx['outputs']]
+    if 'bch' in record_wallet_types:
+        senders['bch'] = [(i['address'], i['value']) for i in bch_tx['inputs']]
+        recipients['bch'] = [(i['address'], i['value']) for i in bch_tx['outputs']]
+
+    slp_inputs = slp_tx['inputs'] if slp_tx else []
+    slp_outputs = slp_tx['outputs'] if slp_tx and slp_tx['valid'] else []
+
+    # Look up every address involved in one go
+    tx_addresses = set()
+    for entry in bch_tx['inputs'] + bch_tx['outputs'] + slp_inputs + slp_outputs:
+        tx_addresses.add(entry['address'])
+    known_addresses = {
+        x.address: x for x in Address.objects.filter(
+            address__in=WATCHED_ADDRESSES.filter(tx_addresses)
+        ).select_related('wallet')
+    }
 
-    bchd = BCHDQuery()
-    parse_slp = address.startswith('simpleledger')
-
-    if parse_slp:
-        # Parse SLP senders and recipients
-        slp_tx = bchd.get_transaction(txid, parse_slp=True)
-        if not slp_tx:
-            self.retry(countdown=5)
-            return
-        tx_fee = slp_tx['tx_fee']
-        if slp_tx['valid']:
-            if txn_address.wallet:
-                if txn_address.wallet.wallet_type == 'slp':
-                    for tx_input in slp_tx['inputs']:
-                        if 'amount' in tx_input.keys():
-                            senders['slp'].append(
-                                (
-                                    tx_input['address'],
-                                    tx_input['amount']
-                                ) 
-                            )
-                if 'outputs' in slp_tx.keys():
-                    recipients['slp'] = [(i['address'], i['amount']) for i in slp_tx['outputs']]
-
-    # Parse BCH senders and recipients
-    bch_tx = bchd.get_transaction(txid)
-    if not bch_tx:
-        self.retry(countdown=5)
-        return
-    tx_fee = bch_tx['tx_fee']
-    if txn_address.wallet:
-        if txn_address.wallet.wallet_type == 'bch':
-            senders['bch'] = [(i['address'], i['value']) for i in bch_tx['inputs']]
-            if 'outputs' in bch_tx.keys():
-                recipients['bch'] = [(i['address'], i['value']) for i in bch_tx['outputs']]
-
-    if parse_slp:
-        if slp_tx is None:
-            slp_tx = bchd.get_transaction(txid, parse_slp=True)
-        spent_txids = []
-
-        # Mark SLP tx inputs as spent
-        for tx_input in slp_tx['inputs']:
-            try:
-                address = Address.objects.get(address=tx_input['address'])
-                if address.wallet:
-                    wallets.append('slp|' + address.wallet.wallet_hash)
-            except Address.DoesNotExist:
-                pass
-            spent_txids.append(tx_input['txid'])
-            txn_check = Transaction.objects.filter(
-                txid=tx_input['txid'],
-                index=tx_input['spent_index']
-            )
-            txn_check.update(
-                spent=True,
-                spending_txid=txid
-            )
-
-            if txn_check.exists():
-                txn_obj = txn_check.last()
-                if txn_obj.token.token_type == 65:
-                    wallet_nft_token = WalletNftToken.objects.get(
-                        acquisition_transaction=txn_obj
-                    )
-                    wallet_nft_token.date_dispensed = timezone.now()
-                    wallet_nft_token.dispensation_transaction = transaction
-                    wallet_nft_token.save()
+    def add_wallet(address, wallet_type):
+        address_obj = known_addresses.get(address)
+        if address_obj and address_obj.wallet:
+            wallets.append(wallet_type + '|' + address_obj.wallet.wallet_hash)
 
-        # Parse SLP tx outputs
-        if slp_tx['valid']:
-            for tx_output in slp_tx['outputs']:
-                try:
-                    address = Address.objects.get(address=tx_output['address'])
-                    if address.wallet:
-                        wallets.append('slp|' + address.wallet.wallet_hash)
-                except Address.DoesNotExist:
-                    pass
-                txn_check = Transaction.objects.filter(
-                    txid=slp_tx['txid'],
-                    address__address=tx_output['address'],
-                    index=tx_output['index']
-                )
-                if not txn_check.exists():
-                    blockheight_id = None
-                    if blockheight:
-                        blockheight_id = blockheight.id
-                    args = (
-                        slp_tx['token_id'],
-                        tx_output['address'],
-                        slp_tx['txid'],
-                        tx_output['amount'],
-                        'bchd-query',
-                        blockheight_id,
-                        tx_output['index']
-                    )
-                    obj_id, created = save_record(*args, spent_txids=spent_txids)
-                    if created:
-                        third_parties = client_acknowledgement(obj_id)
-                        for platform in third_parties:
-                            if 'telegram' in platform:
-                                message = platform[1]
-                                chat_id = platform[2]
-                                send_telegram_message(message, chat_id)
-
-    # Parse BCH inputs
-    if bch_tx is None:
-        bch_tx = bchd.get_transaction(txid)
-
-    spent_txids = []
-    
-    # Mark BCH tx inputs as spent
+    for tx_input in slp_inputs:
+        add_wallet(tx_input['address'], 'slp')
     for tx_input in bch_tx['inputs']:
-        try:
-            address = Address.objects.get(address=tx_input['address'])
-            if address.wallet:
-                wallets.append('bch|' + address.wallet.wallet_hash)
-        except Address.DoesNotExist:
-            pass
-
-        spent_txids.append(tx_input['txid'])
-        txn_check = Transaction.objects.filter(
-            txid=tx_input['txid'],
-            index=tx_input['spent_index']
-        )
-        txn_check.update(
-            spent=True,
-            spending_txid=txid
-        )
+        add_wallet(tx_input['address'], 'bch')
+
+    # Mark tx inputs as spent, the SLP parse also lists the BCH-only inputs
+    spent = _mark_inputs_spent(txid, slp_inputs + bch_tx['inputs'])
+    for txn_obj in spent:
+        if txn_obj.token.token_type == 65:
+            WalletNftToken.objects.filter(acquisition_transaction=txn_obj).update(
+                date_dispensed=timezone.now(),
+                dispensation_transaction=slp_record or records[0]
+            )
 
-    # Parse BCH tx outputs
+    # Save the tx outputs that are not yet recorded
+    spent_txids = list({x['txid'] for x in slp_inputs + bch_tx['inputs']})
+    saved = {(x.address.address, x.index) for x in records}
+    new_records = []
+    for tx_output in slp_outputs:
+        add_wallet(tx_output['address'], 'slp')
+        if (tx_output['address'], tx_output['index']) not in saved:
+            new_records.append({
+                'token': slp_tx['token_id'],
+                'address': tx_output['address'],
+                'txid': txid,
+                'amount': tx_output['amount'],
+                'index': tx_output['index'],
+                'spent_txids': spent_txids
+            })
     for tx_output in bch_tx['outputs']:
-        try:
-            address = Address.objects.get(address=tx_output['address'])
-            if address.wallet:
-                wallets.append('bch|' + address.wallet.wallet_hash)
-        except Address.DoesNotExist:
-            pass
-        txn_check = Transaction.objects.filter(
-            txid=bch_tx['txid'],
-            address__address=tx_output['address'],
-            index=tx_output['index']
-        )
-        if not txn_check.exists():
-            blockheight_id = None
-            if blockheight:
-                blockheight_id = blockheight.id
-            value = tx_output['value'] / 10 ** 8
-            args = (
-                'bch',
-                tx_output['address'],
-                bch_tx['txid'],
-                value,
-                'bchd-query',
-                blockheight_id,
-                tx_output['index']
-            )
-            obj_id, created = save_record(*args, spent_txids=spent_txids)
-            if created:
-                third_parties = client_acknowledgement(obj_id)
-                for platform in third_parties:
-                    if 'telegram' in platform:
-                        message = platform[1]
-                        chat_id = platform[2]
-                        send_telegram_message(message, chat_id)
+        add_wallet(tx_output['address'], 'bch')
+        if (tx_output['address'], tx_output['index']) not in saved:
+            new_records.append({
+                'token': 'bch',
+                'address': tx_output['address'],
+                'txid': txid,
+                'amount': tx_output['value'] / 10 ** 8,
+                'value': tx_output['value'],
+                'index': tx_output['index'],
+                'spent_txids': spent_txids
+            })
+
+    # This transaction is being processed right now, don't queue it again
+    save_records(new_records, 'bchd-query', blockheight_id=blockheight_id, post_save=False, notify=True)
 
     # Call task to parse wallet history
     for wallet_handle in set(wallets):
@@ -1006,6 +1446,58 @@ def transaction_post_save_task(self, address, transaction_id, blockheight_id=Non
                     senders['bch'],
                     recipients['bch']
                 )
+    return True
+
+
+@shared_task(queue='post_save_record')
+def process_pending_transactions():
+    # Let saves arriving from now on schedule the next flush
+    REDIS_STORAGE.delete(_REDIS_NAME__POST_SAVE_SCHEDULED)
+
+    txids = REDIS_STORAGE.spop(_REDIS_NAME__POST_SAVE_PENDING, POST_SAVE_BATCH_SIZE)
+    txids = [x.decode() for x in txids]
+    if not txids:
+        return 'NO PENDING TRANSACTIONS'
+
+    blockheight_ids = REDIS_STORAGE.hmget(_REDIS_NAME__POST_SAVE_BLOCKHEIGHTS, txids)
+    REDIS_STORAGE.hdel(_REDIS_NAME__POST_SAVE_BLOCKHEIGHTS, *txids)
+
+    failed = []
+    for txid, blockheight_id in zip(txids, blockheight_ids):
+        if blockheight_id:
+            blockheight_id = int(blockheight_id)
+        try:
+            processed = process_transaction(txid, blockheight_id)
+        except Exception as exc:
+            LOGGER.error(f'Post-processing of {txid} failed: {exc}')
+            processed = False
+
+        if processed:
+            REDIS_STORAGE.hdel(_REDIS_NAME__POST_SAVE_ATTEMPTS, txid)
+        else:
+            failed.append((txid, blockheight_id))
+
+    for txid, blockheight_id in failed:
+        attempts = REDIS_STORAGE.hincrby(_REDIS_NAME__POST_SAVE_ATTEMPTS, txid, 1)
+        if attempts < POST_SAVE_MAX_ATTEMPTS:
+            queue_transaction_post_save(txid, blockheight_id)
+        else:
+            LOGGER.error(f'Giving up post-processing of {txid} after {attempts} attempts')
+            REDIS_STORAGE.hdel(_REDIS_NAME__POST_SAVE_ATTEMPTS, txid)
+
+    if REDIS_STORAGE.scard(_REDIS_NAME__POST_SAVE_PENDING):
+        # Keep draining the backlog without waiting for a new window
+        _schedule_post_save_flush(countdown=0)
+
+    return f'PROCESSED {len(txids) - len(failed)} OF {len(txids)} TRANSACTIONS'
+
+
+@shared_task(bind=True, queue='post_save_record', max_retries=10)
+def transaction_post_save_task(self, address, transaction_id, blockheight_id=None):
+    # Kept for tasks queued before the switch to `queue_transaction_post_save`
+    transaction = Transaction.objects.get(id=transaction_id)
+    if not process_transaction(transaction.txid, blockheight_id):
+        self.retry(countdown=5)
 
 
 @shared_task(queue='celery_rebuild_history')
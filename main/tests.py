@@ -1,3 +1,604 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.db import connection
+from django.db.models import Q, Sum
+from django.test import TestCase, override_settings, tag
+from django.utils import timezone
+
+from main.models import Address, BlockHeight, Notification, Recipient, Subscription, Token, Transaction, Wallet, WalletHistory
+from main.utils import balance_ledger, outbox, presence, reorg, telegram_sender, watched_addresses, webhooks
+from main.tasks import dispatch_notifications, reconcile_utxos, save_records, send_webhook_notification
+from main.views.view_utxo import _get_bch_utxos
+
+
+class TransactionIndexesTestCase(TestCase):
+    """
+        Makes sure the hot queries on the transactions table keep using its indexes
+    """
+    WALLETS = 100
+    OUTPUTS_PER_WALLET = 200
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.token, _ = Token.objects.get_or_create(name='bch')
+        wallets = Wallet.objects.bulk_create([
+            Wallet(wallet_hash=f'wallet-{i}', wallet_type='bch', version=1)
+            for i in range(cls.WALLETS)
+        ])
+        addresses = Address.objects.bulk_create([
+            Address(address=f'bitcoincash:address-{i}', wallet=wallet, address_path='0/0')
+            for i, wallet in enumerate(wallets)
+        ])
+
+        transactions = []
+        for i in range(cls.OUTPUTS_PER_WALLET):
+            for address in addresses:
+                # Most outputs of a wallet end up spent
+                transactions.append(Transaction(
+                    txid=f'{i:032x}{address.id:032x}',
+                    address=address,
+                    wallet_id=address.wallet_id,
+                    token=cls.token,
+                    amount=0.001,
+                    value=100000,
+                    index=i % 4,
+                    source='test',
+                    spent=i % 10 != 0,
+                    spending_txid=f'{i + 1:032x}{address.id:032x}' if i % 10 else ''
+                ))
+        Transaction.objects.bulk_create(transactions, batch_size=5000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE main_transaction')
+
+        cls.wallet = wallets[0]
+        cls.address = addresses[0]
+
+    def assertUsesIndex(self, qs, index_name=None):
+        plan = qs.explain()
+        self.assertNotIn('Seq Scan on main_transaction', plan, plan)
+        self.assertIn('Index', plan, plan)
+        if index_name:
+            self.assertIn(index_name, plan, plan)
+
+    @tag("unit")
+    def test_wallet_unspent_outputs_use_partial_index(self):
+        qs = Transaction.objects.filter(wallet=self.wallet, spent=False, value__gt=546)
+        self.assertUsesIndex(qs, 'transaction_unspent_wallet_idx')
+
+    @tag("unit")
+    def test_wallet_token_unspent_outputs_use_partial_index(self):
+        qs = Transaction.objects.filter(wallet=self.wallet, spent=False, token=self.token)
+        self.assertUsesIndex(qs, 'transaction_unspent_wallet_idx')
+
+    @tag("unit")
+    def test_address_unspent_outputs_use_partial_index(self):
+        qs = Transaction.objects.filter(address=self.address, spent=False)
+        self.assertUsesIndex(qs, 'transaction_unspent_addr_idx')
+
+    @tag("unit")
+    def test_outpoint_lookup_uses_index(self):
+        txid = f'{10:032x}{self.address.id:032x}'
+        qs = Transaction.objects.filter(txid=txid, index=2)
+        self.assertUsesIndex(qs)
+
+    @tag("unit")
+    def test_spending_txid_lookup_uses_index(self):
+        spending_txid = f'{2:032x}{self.address.id:032x}'
+        qs = Transaction.objects.filter(spending_txid=spending_txid, wallet=self.wallet)
+        self.assertUsesIndex(qs)
+
+
+class WebhookDispatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.recipient = Recipient.objects.create(web_url='https://example.com/webhook/')
+        self.dispatcher = webhooks.WebhookDispatcher(max_concurrency=1)
+        webhooks.REDIS_STORAGE.delete(
+            webhooks._REDIS_NAME__FAILURES.format(recipient_id=self.recipient.id),
+            webhooks._REDIS_NAME__CIRCUIT.format(recipient_id=self.recipient.id)
+        )
+
+    @tag("unit")
+    def test_circuit_opens_after_failures(self):
+        with mock.patch.object(self.dispatcher.session, 'post', side_effect=requests.Timeout('timed out')) as post:
+            results = [
+                self.dispatcher.post(self.recipient, {})
+                for _ in range(webhooks.FAILURE_THRESHOLD + 1)
+            ]
+
+        self.assertEqual(results[:-1], [webhooks.FAILED] * webhooks.FAILURE_THRESHOLD)
+        # No more calls are made to the failing recipient
+        self.assertEqual(results[-1], webhooks.CIRCUIT_OPEN)
+        self.assertEqual(post.call_count, webhooks.FAILURE_THRESHOLD)
+
+    @tag("unit")
+    def test_invalid_recipient(self):
+        with mock.patch.object(self.dispatcher.session, 'post', return_value=mock.Mock(status_code=404)):
+            result = self.dispatcher.post(self.recipient, {})
+
+        self.assertEqual(result, webhooks.INVALID)
+        self.recipient.refresh_from_db()
+        self.assertFalse(self.recipient.valid)
+
+
+class NotificationOutboxTestCase(TestCase):
+
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(name='bch')
+        address = Address.objects.create(address='bitcoincash:outbox-test')
+        recipient = Recipient.objects.create(web_url='https://example.com/webhook/', telegram_id='12312')
+        Subscription.objects.create(address=address, recipient=recipient)
+        # Bulk created like the outputs saved by `save_records`
+        self.transaction, = Transaction.objects.bulk_create([
+            Transaction(
+                txid='a' * 64,
+                address=address,
+                token=token,
+                amount=0.001,
+                value=100000,
+                source='test'
+            )
+        ])
+
+    @tag("unit")
+    def test_queue_notifications_once_per_channel(self):
+        self.assertEqual(outbox.queue_notifications([self.transaction.id]), 2)
+        # Saving the same output again doesn't duplicate its notifications
+        self.assertEqual(outbox.queue_notifications([self.transaction.id]), 0)
+        self.assertEqual(
+            set(self.transaction.notifications.values_list('channel', flat=True)),
+            {Notification.WEBHOOK, Notification.TELEGRAM}
+        )
+
+    @tag("unit")
+    def test_claimed_notifications_are_not_handed_out_again(self):
+        outbox.queue_notifications([self.transaction.id])
+
+        claimed = outbox.claim_notifications()
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(outbox.claim_notifications(), [])
+
+        webhook = next(x for x in claimed if x.channel == Notification.WEBHOOK)
+        others = [x for x in claimed if x.channel != Notification.WEBHOOK]
+        outbox.complete_notifications(others, [(webhook, 'failed', True)])
+
+        webhook.refresh_from_db()
+        self.assertEqual(webhook.status, Notification.PENDING)
+        self.assertEqual(webhook.attempts, 1)
+        self.assertEqual(self.transaction.notifications.filter(status=Notification.SENT).count(), 1)
+
+    @tag("unit")
+    def test_queued_notifications_are_pending_until_confirmed(self):
+        outbox.queue_notifications([self.transaction.id])
+        telegram = next(x for x in outbox.claim_notifications() if x.channel == Notification.TELEGRAM)
+        outbox.complete_notifications([], [], queued=[telegram])
+
+        telegram.refresh_from_db()
+        self.assertEqual(telegram.status, Notification.PENDING)
+        self.transaction.refresh_from_db()
+        self.assertFalse(self.transaction.acknowledged)
+
+        self.assertEqual(outbox.confirm_notifications([outbox.get_claim(telegram)]), 1)
+        telegram.refresh_from_db()
+        self.assertEqual(telegram.status, Notification.SENT)
+        self.transaction.refresh_from_db()
+        self.assertTrue(self.transaction.acknowledged)
+        # Confirming again leaves it as it is
+        self.assertEqual(outbox.confirm_notifications([outbox.get_claim(telegram)], 'rejected'), 0)
+
+    @tag("unit")
+    def test_stale_holders_do_not_complete_notifications(self):
+        outbox.queue_notifications([self.transaction.id])
+        claimed = outbox.claim_notifications()
+
+        # Sent again while the first dispatcher still holds them
+        outbox.replay_notifications([self.transaction.id])
+        outbox.complete_notifications(claimed, [])
+        self.assertEqual(self.transaction.notifications.filter(status=Notification.PENDING).count(), 2)
+        self.assertIsNone(outbox.get_claimed_notification(outbox.get_claim(claimed[0])))
+
+    @tag("unit")
+    @mock.patch('main.tasks.send_telegram_message')
+    @mock.patch('main.tasks.send_webhook_notification.delay')
+    def test_dispatch_hands_notifications_over(self, delay, send_telegram_message):
+        outbox.queue_notifications([self.transaction.id])
+        dispatch_notifications()
+
+        webhook, telegram = self.transaction.notifications.order_by('-channel')
+        delay.assert_called_once_with(outbox.get_claim(webhook))
+        self.assertEqual(send_telegram_message.call_args[1]['claim'], outbox.get_claim(telegram))
+        # Held until the queues they were handed to complete them
+        self.assertEqual(webhook.status, Notification.PENDING)
+        self.assertGreater(webhook.next_attempt_at, timezone.now() + timedelta(seconds=outbox.LEASE))
+
+        with mock.patch.object(webhooks.WEBHOOK_DISPATCHER, 'post', return_value=webhooks.DELIVERED):
+            send_webhook_notification(outbox.get_claim(webhook))
+        webhook.refresh_from_db()
+        self.assertEqual(webhook.status, Notification.SENT)
+        self.transaction.refresh_from_db()
+        self.assertTrue(self.transaction.acknowledged)
+
+
+class TelegramSenderTestCase(TestCase):
+    CHAT_ID = '12312'
+
+    def setUp(self):
+        self.sender = telegram_sender.TelegramSender()
+        telegram_sender.REDIS_STORAGE.delete(
+            telegram_sender._REDIS_NAME__MESSAGES.format(chat_id=self.CHAT_ID),
+            telegram_sender._REDIS_NAME__BUCKET.format(name=self.CHAT_ID),
+            telegram_sender._REDIS_NAME__BUCKET.format(name='global'),
+            telegram_sender._REDIS_NAME__FLUSH_SCHEDULED
+        )
+        telegram_sender.REDIS_STORAGE.zrem(telegram_sender._REDIS_NAME__CHATS, self.CHAT_ID)
+
+    def _make_due(self):
+        telegram_sender.REDIS_STORAGE.zadd(telegram_sender._REDIS_NAME__CHATS, {self.CHAT_ID: 0})
+
+    @tag("unit")
+    def test_messages_for_a_chat_are_aggregated(self):
+        self.assertTrue(self.sender.queue(self.CHAT_ID, 'first'))
+        self.assertFalse(self.sender.queue(self.CHAT_ID, 'second'))
+        self._make_due()
+
+        with mock.patch.object(self.sender.session, 'post', return_value=mock.Mock(status_code=200)) as post:
+            self.sender.flush(time_limit=1)
+
+        post.assert_called_once()
+        self.assertEqual(post.call_args[1]['data']['text'], 'first' + telegram_sender.SEPARATOR + 'second')
+
+    @tag("unit")
+    def test_retry_after_is_honoured(self):
+        self.sender.queue(self.CHAT_ID, 'message')
+        self._make_due()
+
+        response = mock.Mock(status_code=429)
+        response.json.return_value = {'ok': False, 'parameters': {'retry_after': 120}}
+        with mock.patch.object(self.sender.session, 'post', return_value=response):
+            next_due = self.sender.flush(time_limit=1)
+
+        self.assertGreater(next_due, 100)
+        self.assertEqual(
+            telegram_sender.REDIS_STORAGE.lrange(telegram_sender._REDIS_NAME__MESSAGES.format(chat_id=self.CHAT_ID), 0, -1),
+            [b'message']
+        )
+
+    @tag("unit")
+    def test_queued_notifications_are_confirmed_once_sent(self):
+        self.sender.queue(self.CHAT_ID, 'message', claim='5:token')
+        self._make_due()
+
+        on_sent = mock.Mock()
+        with mock.patch.object(self.sender.session, 'post', return_value=mock.Mock(status_code=200)) as post:
+            self.sender.flush(time_limit=1, on_sent=on_sent)
+
+        self.assertEqual(post.call_args[1]['data']['text'], 'message')
+        on_sent.assert_called_once_with(['5:token'], None)
+
+    @tag("unit")
+    def test_rejected_notifications_are_confirmed_with_the_error(self):
+        self.sender.queue(self.CHAT_ID, 'message', claim='5:token')
+        self._make_due()
+
+        on_sent = mock.Mock()
+        response = mock.Mock(status_code=403, text='Forbidden')
+        with mock.patch.object(self.sender.session, 'post', return_value=response):
+            self.sender.flush(time_limit=1, on_sent=on_sent)
+
+        on_sent.assert_called_once_with(['5:token'], '403 Forbidden')
+
+    @tag("unit")
+    def test_one_flush_is_scheduled_at_a_time(self):
+        self.assertTrue(self.sender.claim_flush(1))
+        self.assertFalse(self.sender.claim_flush(1))
+        self.sender.release_flush()
+        self.assertTrue(self.sender.claim_flush(1))
+
+
+class PresenceTestCase(TestCase):
+    ROOM = 'bitcoincash_presence-test_'
+
+    def setUp(self):
+        presence.REDIS_STORAGE.delete(presence._REDIS_NAME__PRESENCE.format(room=self.ROOM))
+
+    @tag("unit")
+    def test_room_is_present_until_last_connection_leaves(self):
+        self.assertFalse(presence.PRESENCE.is_present(self.ROOM))
+
+        presence.PRESENCE.join(self.ROOM, 'channel-1')
+        presence.PRESENCE.join(self.ROOM, 'channel-2')
+        self.assertEqual(presence.PRESENCE.filter([self.ROOM, 'bitcoincash_other_']), {self.ROOM})
+
+        presence.PRESENCE.leave(self.ROOM, 'channel-1')
+        self.assertTrue(presence.PRESENCE.is_present(self.ROOM))
+        presence.PRESENCE.leave(self.ROOM, 'channel-2')
+        self.assertFalse(presence.PRESENCE.is_present(self.ROOM))
+
+    @tag("unit")
+    def test_room_names(self):
+        self.assertEqual(presence.get_address_rooms('bitcoincash:qabc'), ['bitcoincash_qabc_'])
+        self.assertEqual(
+            presence.get_address_rooms('simpleledger:qabc', 'token'),
+            ['simpleledger_qabc_', 'simpleledger_qabc_token']
+        )
+
+
+@override_settings(START_BLOCK=100)
+class UtxoReconciliationTestCase(TestCase):
+    ADDRESS = 'bitcoincash:reconcile-test'
+
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(name='bch')
+        address = Address.objects.create(address=self.ADDRESS)
+        Subscription.objects.create(address=address)
+        self.reported, self.stale = Transaction.objects.bulk_create([
+            Transaction(txid='a' * 64, address=address, token=token, amount=0.001, value=100000, source='test', spent=True),
+            Transaction(txid='b' * 64, address=address, token=token, amount=0.002, value=200000, source='test')
+        ])
+
+    def _utxo(self, txid, value, index=0):
+        return {
+            'token': 'bch',
+            'txid': txid,
+            'index': index,
+            'amount': value / (10 ** 8),
+            'value': value,
+            'block': 1
+        }
+
+    @tag("unit")
+    @mock.patch('main.tasks.queue_transaction_post_save')
+    def test_database_matches_utxo_set(self, queue_transaction_post_save):
+        utxos = [self._utxo('a' * 64, 100000), self._utxo('c' * 64, 300000, index=1)]
+        self.assertEqual(reconcile_utxos(self.ADDRESS, utxos), (1, 1, 1))
+
+        unspent = Transaction.objects.filter(address__address=self.ADDRESS, spent=False)
+        self.assertEqual(set(unspent.values_list('txid', 'index')), {('a' * 64, 0), ('c' * 64, 1)})
+
+        created = Transaction.objects.get(txid='c' * 64)
+        self.assertTrue(created.acknowledged)
+        self.assertEqual(created.source, 'bchd-query')
+        self.assertEqual(created.blockheight.number, 1)
+        self.assertTrue(BlockHeight.objects.get(number=1).processed)
+        queue_transaction_post_save.assert_called_once_with('c' * 64, created.blockheight_id)
+
+        # Nothing left to do the second time around
+        self.assertEqual(reconcile_utxos(self.ADDRESS, utxos), (0, 0, 0))
+
+
+class WatchedAddressIndexTestCase(TestCase):
+    ADDRESS = 'bitcoincash:watched-test'
+
+    def setUp(self):
+        watched_addresses.REDIS_STORAGE.delete(watched_addresses._REDIS_NAME__VERSION)
+
+    def tearDown(self):
+        # Other tests create addresses in transactions that are never committed, so they
+        # rely on the index not being built (see `WatchedAddressIndex.filter`)
+        watched_addresses.REDIS_STORAGE.delete(watched_addresses._REDIS_NAME__VERSION)
+
+    @tag("unit")
+    def test_added_address_is_seen_by_other_processes_right_away(self):
+        # Each instance stands in for the copy of another process
+        worker = watched_addresses.WatchedAddressIndex()
+        self.assertEqual(worker.filter([self.ADDRESS]), set())
+        bloom = worker._bloom
+
+        watched_addresses.WatchedAddressIndex().add(self.ADDRESS)
+        self.assertTrue(worker.contains(self.ADDRESS))
+        # Caught up from the change log instead of reloading the bloom filter
+        self.assertIs(worker._bloom, bloom)
+
+        watched_addresses.WatchedAddressIndex().remove(self.ADDRESS)
+        self.assertFalse(worker.contains(self.ADDRESS))
+
+    @tag("unit")
+    def test_addresses_added_during_a_rebuild_are_kept(self):
+        index = watched_addresses.WatchedAddressIndex()
+        index.rebuild()
+
+        def add_after_snapshot(addresses, size):
+            # Committed after the table was read, by an `add()` that didn't see the rebuild yet
+            pipe = watched_addresses.REDIS_STORAGE.pipeline()
+            pipe.sadd(watched_addresses._REDIS_NAME__ADDRESSES, self.ADDRESS)
+            index._publish_change(pipe, [self.ADDRESS])
+            pipe.execute()
+            return [addresses[i:i + size] for i in range(0, len(addresses), size)]
+
+        with mock.patch('main.utils.watched_addresses.chunks', side_effect=add_after_snapshot):
+            self.assertTrue(index.rebuild())
+
+        self.assertTrue(watched_addresses.WatchedAddressIndex().contains(self.ADDRESS))
+
+
+class SaveRecordsTestCase(TestCase):
+    ADDRESS = 'bitcoincash:save-records-test'
+
+    def setUp(self):
+        self.token, _ = Token.objects.get_or_create(name='bch')
+        self.address = Address.objects.create(address=self.ADDRESS)
+        Subscription.objects.create(address=self.address)
+
+    def _record(self, txid, value):
+        return {
+            'token': 'bch',
+            'address': self.ADDRESS,
+            'txid': txid,
+            'amount': 0.00001,
+            'value': value,
+            'index': 0
+        }
+
+    @tag("unit")
+    @mock.patch('main.tasks.queue_transaction_post_save')
+    def test_concurrently_saved_rows_are_not_reported_as_created(self, queue_transaction_post_save):
+        def save_concurrently(amount, decimals):
+            # Lands between the lookup of existing outputs and the insert
+            self.concurrent, = Transaction.objects.bulk_create([
+                Transaction(txid='a' * 64, address=self.address, token=self.token, amount=amount, source='test')
+            ])
+            return 1000
+
+        records = [self._record('a' * 64, 1000), self._record('b' * 64, None), self._record('c' * 64, 1000)]
+        with mock.patch('main.tasks.to_base_units', side_effect=save_concurrently):
+            results = save_records(records, 'test')
+
+        self.assertEqual(results, [
+            (self.concurrent.id, False),
+            (Transaction.objects.get(txid='b' * 64).id, True),
+            (Transaction.objects.get(txid='c' * 64).id, True)
+        ])
+        self.assertEqual(
+            {x[0][0] for x in queue_transaction_post_save.call_args_list},
+            {'b' * 64, 'c' * 64}
+        )
+
+
+class BalanceLedgerTestCase(TestCase):
+    """
+        The ledger is kept by a trigger, it has to match the unspent outputs after every change
+    """
+
+    def setUp(self):
+        self.token, _ = Token.objects.get_or_create(name='bch')
+        self.wallet = Wallet.objects.create(wallet_hash='ledger-test', wallet_type='bch', version=1)
+        self.address = Address.objects.create(address='bitcoincash:ledger-test', wallet=self.wallet, address_path='0/0')
+
+    def _create_outputs(self, *values):
+        return Transaction.objects.bulk_create([
+            Transaction(
+                txid=f'{i:064x}',
+                address=self.address,
+                wallet=self.wallet,
+                token=self.token,
+                amount=value / (10 ** 8),
+                value=value,
+                source='test'
+            )
+            for i, value in enumerate(values)
+        ])
+
+    def assertLedgerMatchesOutputs(self):
+        unspent = Transaction.objects.filter(address=self.address, spent=False, value__gt=546)
+        expected = unspent.aggregate(value=Sum('value'))['value'] or 0
+        for owner in ({'wallet': self.wallet}, {'address': self.address.address}):
+            _, value, utxo_count = balance_ledger.get_balance(**owner)
+            self.assertEqual(value, expected)
+            self.assertEqual(utxo_count, unspent.count())
+
+    @tag("unit")
+    def test_ledger_follows_inserts_spends_and_deletes(self):
+        # The dust output doesn't count towards the balance
+        first, second, _ = self._create_outputs(100000, 250000, 546)
+        self.assertLedgerMatchesOutputs()
+        self.assertEqual(balance_ledger.get_balance(wallet=self.wallet)[1], 350000)
+
+        Transaction.objects.filter(id=first.id).update(spent=True, spending_txid='f' * 64)
+        self.assertLedgerMatchesOutputs()
+
+        Transaction.objects.filter(id=first.id).update(spent=False, spending_txid='')
+        self.assertLedgerMatchesOutputs()
+
+        Transaction.objects.filter(id=second.id).delete()
+        self.assertLedgerMatchesOutputs()
+        self.assertEqual(balance_ledger.get_balance(wallet=self.wallet)[1], 100000)
+
+    @tag("unit")
+    def test_outputs_saved_without_a_value_count_towards_the_ledger(self):
+        output, = Transaction.objects.bulk_create([
+            Transaction(txid='e' * 64, address=self.address, wallet=self.wallet, token=self.token, amount=0.001, source='test')
+        ])
+        output.refresh_from_db()
+        self.assertEqual(output.value, 100000)
+        self.assertLedgerMatchesOutputs()
+
+
+class ReorgRollbackTestCase(TestCase):
+
+    def setUp(self):
+        token, _ = Token.objects.get_or_create(name='bch')
+        wallet = Wallet.objects.create(wallet_hash='reorg-test', wallet_type='bch', version=1)
+        self.address = Address.objects.create(address='bitcoincash:reorg-test', wallet=wallet, address_path='0/0')
+        self.stale_block, self.kept_block = BlockHeight.objects.bulk_create([
+            BlockHeight(number=11, block_hash='b' * 64, transactions_count=1, requires_full_scan=False),
+            BlockHeight(number=10, block_hash='a' * 64, transactions_count=1, requires_full_scan=False)
+        ])
+
+        def output(txid, block, **kwargs):
+            return Transaction(
+                txid=txid,
+                address=self.address,
+                wallet=wallet,
+                token=token,
+                amount=0.001,
+                value=100000,
+                blockheight=block,
+                source='test',
+                **kwargs
+            )
+
+        # `spending` was mined in the block that left the chain and spent `funding`
+        self.funding, self.spending = Transaction.objects.bulk_create([
+            output('1' * 64, self.kept_block, spent=True, spending_txid='2' * 64),
+            output('2' * 64, self.stale_block)
+        ])
+        WalletHistory.objects.create(wallet=wallet, txid='2' * 64, record_type=WalletHistory.INCOMING, amount=0.001)
+
+    @tag("unit")
+    @mock.patch('main.utils.reorg.block_scanner.requeue_blocks')
+    def test_rollback_unconfirms_and_unspends(self, requeue_blocks):
+        self.assertEqual(balance_ledger.get_balance(address=self.address.address)[1:], (100000, 1))
+
+        self.assertEqual(reorg.rollback_blocks([11]), ['2' * 64])
+        requeue_blocks.assert_called_once_with([11])
+
+        self.spending.refresh_from_db()
+        self.funding.refresh_from_db()
+        self.assertIsNone(self.spending.blockheight_id)
+        self.assertFalse(self.funding.spent)
+        self.assertEqual(self.funding.spending_txid, '')
+        # Outputs of blocks that are still in the chain are untouched
+        self.assertEqual(self.funding.blockheight_id, self.kept_block.id)
+        # The history of transactions that left the chain is parsed again if they come back
+        self.assertFalse(WalletHistory.objects.filter(txid='2' * 64).exists())
+
+    @tag("unit")
+    @mock.patch('main.utils.reorg.block_scanner.BLOCK_QUEUE')
+    @mock.patch('main.utils.reorg.block_scanner.requeue_blocks')
+    def test_blocks_above_a_shorter_chain_are_dropped(self, requeue_blocks, block_queue):
+        self.assertEqual(reorg.rollback_blocks([11], tip_number=10), ['2' * 64])
+
+        requeue_blocks.assert_not_called()
+        block_queue.remove.assert_called_once_with(11)
+        self.assertFalse(BlockHeight.objects.filter(number=11).exists())
+        self.spending.refresh_from_db()
+        self.assertIsNone(self.spending.blockheight_id)
+
+        self.stale_block.refresh_from_db()
+        self.assertIsNone(self.stale_block.block_hash)
+        self.assertEqual(self.stale_block.transactions_count, 0)
+
+        # Until the rolled back transaction is seen again, both outputs count
+        self.assertEqual(balance_ledger.get_balance(address=self.address.address)[1:], (200000, 2))
+
+
+class BchUtxosTestCase(TestCase):
+
+    @tag("unit")
+    def test_outputs_without_a_value_fall_back_to_the_amount(self):
+        token, _ = Token.objects.get_or_create(name='bch')
+        address = Address.objects.create(address='bitcoincash:utxos-test')
+        Transaction.objects.bulk_create([
+            Transaction(txid='a' * 64, address=address, token=token, amount=0.001, value=100000, source='test'),
+            Transaction(txid='b' * 64, address=address, token=token, amount=0.002, value=None, source='test'),
+            Transaction(txid='c' * 64, address=address, token=token, amount=0.00000546, value=None, source='test')
+        ])
+
+        utxos = _get_bch_utxos(Q(address=address, spent=False))
+        self.assertEqual(
+            sorted((x['txid'], x['value']) for x in utxos),
+            [('a' * 64, 100000), ('b' * 64, 200000)]
+        )
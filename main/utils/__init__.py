@@ -1 +0,0 @@
-from main.utils.redis_block_setter import *
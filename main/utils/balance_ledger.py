@@ -0,0 +1,104 @@
+import logging
+
+from django.db import connection, transaction as trans
+
+from main.models import BalanceLedger
+
+LOGGER = logging.getLogger(__name__)
+
+# SLP amounts have at most 9 decimals, anything below that is float noise from the running sums
+BALANCE_PRECISION = 9
+
+# Unspent outputs per wallet and per address, with the same dust rule as the ledger trigger
+_EXPECTED_BALANCES_SQL = """
+    SELECT t.wallet_id, NULL::integer, t.token_id, SUM(t.amount), COALESCE(SUM(t.value), 0), COUNT(*), MAX(b.number)
+    FROM main_transaction t
+    JOIN main_token tk ON tk.id = t.token_id
+    LEFT JOIN main_blockheight b ON b.id = t.blockheight_id
+    WHERE NOT t.spent AND t.wallet_id IS NOT NULL AND (tk.tokenid <> '' OR t.amount > 0.00000546)
+    GROUP BY t.wallet_id, t.token_id
+    UNION ALL
+    SELECT NULL::integer, t.address_id, t.token_id, SUM(t.amount), COALESCE(SUM(t.value), 0), COUNT(*), MAX(b.number)
+    FROM main_transaction t
+    JOIN main_token tk ON tk.id = t.token_id
+    LEFT JOIN main_blockheight b ON b.id = t.blockheight_id
+    WHERE NOT t.spent AND t.address_id IS NOT NULL AND (tk.tokenid <> '' OR t.amount > 0.00000546)
+    GROUP BY t.address_id, t.token_id
+"""
+
+
+def get_balance(tokenid='', wallet=None, address=None):
+    """
+        Returns the (balance, value, utxo_count) of a wallet or an address,
+        where `value` is the balance in base units. `tokenid` is left blank for BCH.
+    """
+    qs = BalanceLedger.objects.filter(token__tokenid=tokenid)
+    if wallet:
+        qs = qs.filter(wallet=wallet, address__isnull=True)
+    else:
+        qs = qs.filter(address__address=address, wallet__isnull=True)
+
+    row = qs.values_list('balance', 'value', 'utxo_count').first()
+    if not row:
+        return 0, 0, 0
+    balance, value, utxo_count = row
+    return max(round(balance, BALANCE_PRECISION), 0), value, utxo_count
+
+
+def rebuild():
+    """
+        Recomputes the whole ledger from the `Transaction` table
+    """
+    with trans.atomic():
+        with connection.cursor() as cursor:
+            # Hold off writes to the transactions while the ledger is recomputed
+            cursor.execute('LOCK TABLE main_transaction IN SHARE ROW EXCLUSIVE MODE')
+            cursor.execute('DELETE FROM main_balanceledger')
+            cursor.execute(f"""
+                INSERT INTO main_balanceledger (
+                    wallet_id, address_id, token_id, balance, value, utxo_count, last_updated_block, date_updated
+                )
+                SELECT x.*, now() FROM ({_EXPECTED_BALANCES_SQL}) x
+            """)
+            count = cursor.rowcount
+    LOGGER.info(f'Balance ledger rebuilt with {count} rows')
+    return count
+
+
+def verify():
+    """
+        Compares the ledger against the `Transaction` table,
+        returns a list of (wallet_id, address_id, token_id, expected, actual) mismatches
+        where expected and actual are (balance, value, utxo_count) tuples
+    """
+    with trans.atomic():
+        with connection.cursor() as cursor:
+            # Read both sides from the same snapshot
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute(_EXPECTED_BALANCES_SQL)
+            expected = {
+                (wallet_id, address_id, token_id): (balance, value, utxo_count)
+                for wallet_id, address_id, token_id, balance, value, utxo_count, _ in cursor.fetchall()
+            }
+            cursor.execute("""
+                SELECT wallet_id, address_id, token_id, balance, value, utxo_count
+                FROM main_balanceledger
+                WHERE utxo_count <> 0 OR balance <> 0 OR value <> 0
+            """)
+            actual = {
+                (wallet_id, address_id, token_id): (balance, value, utxo_count)
+                for wallet_id, address_id, token_id, balance, value, utxo_count in cursor.fetchall()
+            }
+
+    mismatches = []
+    for key in set(expected) | set(actual):
+        expected_balance, expected_value, expected_count = expected.get(key, (0, 0, 0))
+        actual_balance, actual_value, actual_count = actual.get(key, (0, 0, 0))
+        same_balance = round(expected_balance - actual_balance, BALANCE_PRECISION) == 0
+        if not same_balance or expected_value != actual_value or expected_count != actual_count:
+            mismatches.append((
+                *key,
+                (expected_balance, expected_value, expected_count),
+                (actual_balance, actual_value, actual_count)
+            ))
+    return mismatches
@@ -0,0 +1,268 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Max, Min
+from django.utils import timezone
+
+from main.models import BlockHeight
+
+LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__PENDING = 'blocks:pending'
+_REDIS_NAME__LEASES = 'blocks:leases'
+
+# Missing block heights created per `fill_gaps()` call
+GAP_FILL_LIMIT = 1000
+# Failed blocks are retried right away this many times, then only after the scan timeout
+QUICK_RETRIES = 3
+
+
+def _pending_blocks():
+    return BlockHeight.objects.filter(processed=False, requires_full_scan=True)
+
+
+# Returns the blocks leased and those whose lease expired, both in ascending order
+_CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, number in ipairs(expired) do
+    redis.call('ZADD', KEYS[1], number, number)
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+end
+
+local claimed = {}
+local limit = tonumber(ARGV[3]) - redis.call('ZCARD', KEYS[2])
+if limit > 0 then
+    local popped = redis.call('ZPOPMIN', KEYS[1], limit)
+    for i = 1, #popped, 2 do
+        redis.call('ZADD', KEYS[2], ARGV[2], popped[i])
+        table.insert(claimed, popped[i])
+    end
+end
+return {claimed, expired}
+"""
+
+# Leases the given blocks that aren't leased already, wherever they are in the queue
+_LEASE_SCRIPT = """
+local leased = {}
+for i = 2, #ARGV do
+    local number = ARGV[i]
+    if not redis.call('ZSCORE', KEYS[2], number) then
+        redis.call('ZREM', KEYS[1], number)
+        redis.call('ZADD', KEYS[2], ARGV[1], number)
+        table.insert(leased, number)
+    end
+end
+return leased
+"""
+
+
+class BlockQueue(object):
+    """
+        Work queue of block numbers to scan, kept in Redis.
+
+        Pending blocks are a sorted set scored by block number, so the lowest block
+        is always handed out first. Handed out blocks move to a second sorted set
+        scored by the expiry of their lease, and go back to the pending set if
+        they're not completed in time. Every operation is O(log n) and atomic
+        across workers.
+    """
+
+    def __init__(self):
+        self._claim = REDIS_STORAGE.register_script(_CLAIM_SCRIPT)
+        self._lease = REDIS_STORAGE.register_script(_LEASE_SCRIPT)
+
+    def add(self, *numbers):
+        numbers = {int(x): int(x) for x in numbers}
+        if numbers:
+            # Blocks already pending keep their place
+            REDIS_STORAGE.zadd(_REDIS_NAME__PENDING, numbers, nx=True)
+
+    def size(self):
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        pipe.zcard(_REDIS_NAME__PENDING)
+        pipe.zcard(_REDIS_NAME__LEASES)
+        return sum(pipe.execute())
+
+    def claim(self, window, lease):
+        """
+            Leases up to `window` blocks minus those already leased for `lease` seconds.
+            Returns the leased blocks and the blocks whose lease had expired.
+        """
+        now = time.time()
+        claimed, expired = self._claim(
+            keys=[_REDIS_NAME__PENDING, _REDIS_NAME__LEASES],
+            args=[now, now + lease, window]
+        )
+        return [int(x) for x in claimed], [int(x) for x in expired]
+
+    def lease(self, numbers, lease):
+        """
+            Leases the given blocks for `lease` seconds out of order, skipping those
+            already leased. Returns the leased blocks.
+        """
+        numbers = [int(x) for x in numbers]
+        if not numbers:
+            return []
+        leased = self._lease(
+            keys=[_REDIS_NAME__PENDING, _REDIS_NAME__LEASES],
+            args=[time.time() + lease, *numbers]
+        )
+        return [int(x) for x in leased]
+
+    def complete(self, number):
+        REDIS_STORAGE.zrem(_REDIS_NAME__LEASES, int(number))
+
+    def remove(self, *numbers):
+        numbers = [int(x) for x in numbers]
+        if numbers:
+            pipe = REDIS_STORAGE.pipeline()
+            pipe.zrem(_REDIS_NAME__PENDING, *numbers)
+            pipe.zrem(_REDIS_NAME__LEASES, *numbers)
+            pipe.execute()
+
+    def release(self, number):
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.zrem(_REDIS_NAME__LEASES, int(number))
+        pipe.zadd(_REDIS_NAME__PENDING, {int(number): int(number)})
+        pipe.execute()
+
+
+BLOCK_QUEUE = BlockQueue()
+
+
+def fill_gaps():
+    """
+        Creates the `BlockHeight` records missing between the start block and the latest
+        known block (e.g. heights skipped while the latest block poller was down),
+        so they get scanned like any other block. Returns the created block numbers.
+    """
+    bounds = BlockHeight.objects.filter(number__gte=settings.START_BLOCK).aggregate(
+        low=Min('number'),
+        high=Max('number')
+    )
+    low, high = bounds['low'], bounds['high']
+    if low is None:
+        return []
+
+    # Cheap check for the common case of no gaps
+    count = BlockHeight.objects.filter(number__gte=low, number__lte=high).count()
+    if count == high - low + 1:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+                SELECT s.number
+                FROM generate_series(%s, %s) AS s(number)
+                LEFT JOIN main_blockheight b ON b.number = s.number
+                WHERE b.id IS NULL
+                ORDER BY s.number
+                LIMIT %s
+            """,
+            [low, high, GAP_FILL_LIMIT]
+        )
+        missing = [row[0] for row in cursor.fetchall()]
+
+    now = timezone.now()
+    BlockHeight.objects.bulk_create(
+        [BlockHeight(number=x, created_datetime=now, requires_full_scan=True) for x in missing],
+        ignore_conflicts=True
+    )
+    BLOCK_QUEUE.add(*missing)
+    LOGGER.info(f'Found {len(missing)} missing blocks between {low} and {high}')
+    return missing
+
+
+def claim_blocks(window=None):
+    """
+        Leases the next pending blocks from `BLOCK_QUEUE`, up to `window` blocks in
+        progress at a time, checkpoints them as started and returns their numbers
+        in ascending order.
+
+        Blocks whose lease ran out (e.g. their task was lost) are handed out again.
+    """
+    if window is None:
+        window = settings.BLOCK_SCAN_WINDOW
+
+    if not BLOCK_QUEUE.size():
+        # Picks up blocks queued while Redis was unavailable or flushed
+        BLOCK_QUEUE.add(*_pending_blocks().values_list('number', flat=True))
+
+    numbers, expired = BLOCK_QUEUE.claim(window, settings.BLOCK_SCAN_TIMEOUT)
+    for number in expired:
+        LOGGER.warning(f'Block {number} stalled, scanning it again')
+    if not numbers:
+        return []
+
+    pending = set(_pending_blocks().filter(number__in=numbers).values_list('number', flat=True))
+    for number in set(numbers) - pending:
+        # Scanned or removed since it was queued
+        BLOCK_QUEUE.complete(number)
+
+    BlockHeight.objects.filter(number__in=pending).update(
+        scan_started=timezone.now(),
+        scan_attempts=F('scan_attempts') + 1
+    )
+    return sorted(pending)
+
+
+def lease_blocks(numbers, lease=None):
+    """
+        Leases specific blocks (e.g. for a backfill) so that the block scanner
+        doesn't pick them up in the meantime, and checkpoints them as started.
+        Blocks that are being scanned already are skipped.
+        Returns the numbers of the leased blocks.
+    """
+    if lease is None:
+        lease = settings.BLOCK_SCAN_TIMEOUT
+
+    numbers = BLOCK_QUEUE.lease(numbers, lease)
+    if numbers:
+        BlockHeight.objects.filter(number__in=numbers).update(
+            scan_started=timezone.now(),
+            scan_attempts=F('scan_attempts') + 1
+        )
+    return numbers
+
+
+def complete_block(number, transactions_count, block_hash=None):
+    BLOCK_QUEUE.complete(number)
+    BlockHeight.objects.filter(number=number).update(
+        processed=True,
+        transactions_count=transactions_count,
+        updated_datetime=timezone.now(),
+        scan_started=None,
+        block_hash=block_hash
+    )
+
+
+def release_block(number):
+    """
+        Clears the checkpoint of a failed block so that it's picked up on the next tick,
+        blocks that keep failing are only retried once their lease runs out
+    """
+    retry = BlockHeight.objects.filter(
+        number=number,
+        processed=False,
+        scan_attempts__lt=QUICK_RETRIES
+    ).update(scan_started=None)
+    if retry:
+        BLOCK_QUEUE.release(number)
+
+
+def requeue_blocks(numbers):
+    """
+        Marks already scanned blocks to be scanned again
+    """
+    numbers = list(numbers)
+    BlockHeight.objects.filter(number__in=numbers).update(
+        processed=False,
+        requires_full_scan=True,
+        scan_started=None
+    )
+    BLOCK_QUEUE.add(*numbers)
@@ -0,0 +1,40 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+
+from django.db.models import Func
+
+BCH_DECIMALS = 8
+
+
+class Round(Func):
+    function = "ROUND"
+    template = "%(function)s(%(expressions)s::numeric, 0)"
+
+
+def get_token_decimals(token):
+    """
+        Decimals of a token's base unit, BCH is the token without a tokenid.
+        Returns None for SLP tokens whose metadata hasn't been fetched yet.
+    """
+    if not token.tokenid:
+        return BCH_DECIMALS
+    return token.decimals
+
+
+def to_base_units(amount, decimals):
+    """
+        Converts an amount to an integer of base units (satoshis / raw SLP amount)
+    """
+    if amount is None or decimals is None:
+        return None
+    # Go through str() so that e.g. 0.1 BCH becomes exactly 10000000 satoshis
+    value = Decimal(str(amount)).scaleb(decimals)
+    return int(value.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_base_units(value, decimals):
+    """
+        Converts an integer of base units back to a Decimal amount
+    """
+    if value is None or decimals is None:
+        return None
+    return Decimal(value).scaleb(-decimals)
@@ -0,0 +1,251 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.db import connection
+from django.db import transaction as trans
+from django.db.models import F, Q
+from django.utils import timezone
+
+from main.models import Notification, Transaction
+from main.utils.presence import PRESENCE, get_address_rooms
+from main.utils.webhooks import get_retry_countdown
+
+LOGGER = logging.getLogger(__name__)
+
+# Notifications claimed by a dispatcher at a time
+BATCH_SIZE = 100
+# Seconds a claimed notification is held before it's handed out again (e.g. the dispatcher died)
+LEASE = 120
+# Seconds a notification handed to a sending queue is held before it's handed out again
+QUEUED_LEASE = 3600
+MAX_ATTEMPTS = 8
+
+
+# Deferred imports, tasks depend on the outbox utils
+def _dispatch():
+    from main.tasks import dispatch_notifications
+    dispatch_notifications.delay()
+
+
+def queue_notifications(transaction_ids):
+    """
+        Writes the pending notifications of the outputs `transaction_ids` to the outbox,
+        one per subscription of their address and channel of the subscription's recipient,
+        and queues the websocket updates of those with connections.
+        Meant to run in the database transaction that saves the outputs, so that an
+        output is never saved without its notifications or the other way around.
+
+        Notifications that already exist are left as they are.
+        Returns the number of notifications created.
+    """
+    transaction_ids = list(transaction_ids)
+    if not transaction_ids:
+        return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+                INSERT INTO main_notification
+                    (transaction_id, subscription_id, channel, status, attempts, next_attempt_at, date_created)
+                SELECT t.id, s.id, c.channel, %s, 0, NOW(), NOW()
+                FROM main_transaction t
+                JOIN main_subscription s ON s.address_id = t.address_id
+                LEFT JOIN main_recipient r ON r.id = s.recipient_id
+                CROSS JOIN LATERAL (VALUES
+                    (%s, r.valid AND COALESCE(r.web_url, '') <> ''),
+                    (%s, r.valid AND COALESCE(r.telegram_id, '') <> '')
+                ) AS c(channel, enabled)
+                WHERE t.id = ANY(%s) AND c.enabled
+                ON CONFLICT (transaction_id, subscription_id, channel) DO NOTHING
+            """,
+            [
+                Notification.PENDING,
+                Notification.WEBHOOK,
+                Notification.TELEGRAM,
+                transaction_ids
+            ]
+        )
+        created = cursor.rowcount
+
+    if created:
+        trans.on_commit(_dispatch)
+
+    # Websocket updates are only worth sending while someone is connected,
+    # they're pushed right away instead of going through the outbox
+    watched = _get_watched_transactions(transaction_ids)
+    if watched:
+        trans.on_commit(lambda: _send_websocket_updates(watched))
+    return created
+
+
+def _get_watched_transactions(transaction_ids):
+    rooms = {}
+    outputs = Transaction.objects.filter(id__in=transaction_ids).values_list(
+        'id',
+        'address__address',
+        'token__tokenid'
+    )
+    for obj_id, address, tokenid in outputs:
+        rooms[obj_id] = get_address_rooms(address, tokenid)
+
+    present = PRESENCE.filter({room for x in rooms.values() for room in x})
+    return [obj_id for obj_id, x in rooms.items() if present.intersection(x)]
+
+
+def _send_websocket_updates(transaction_ids):
+    from main.tasks import send_websocket_updates
+    send_websocket_updates.delay(transaction_ids)
+
+
+def replay_notifications(transaction_ids):
+    """
+        Sends the notifications of the outputs `transaction_ids` again, including
+        to subscriptions made after they were first sent
+    """
+    transaction_ids = list(transaction_ids)
+    with trans.atomic():
+        replayed = Notification.objects.filter(transaction_id__in=transaction_ids).update(
+            status=Notification.PENDING,
+            attempts=0,
+            next_attempt_at=timezone.now(),
+            last_error=None,
+            sent_at=None,
+            # Whoever holds them can no longer complete them
+            claim_token=None
+        )
+        queue_notifications(transaction_ids)
+        if replayed:
+            trans.on_commit(_dispatch)
+    return replayed
+
+
+def _with_related(queryset):
+    return queryset.select_related(
+        'transaction__address__wallet',
+        'transaction__token',
+        'transaction__blockheight',
+        'subscription__recipient',
+        'subscription__address'
+    )
+
+
+def claim_notifications(batch_size=BATCH_SIZE, lease=LEASE):
+    """
+        Leases up to `batch_size` due notifications to this dispatcher.
+
+        Rows are picked with `SELECT ... FOR UPDATE SKIP LOCKED`, so concurrent
+        dispatchers never wait on or claim each other's rows, and the lease is only
+        the short claiming transaction: deliveries happen outside of it.
+
+        The rows get a new claim token, only the holder of the token can complete
+        them (see `get_claim`), so a stale holder whose lease ran out can't.
+    """
+    now = timezone.now()
+    claim_token = uuid.uuid4()
+    with trans.atomic():
+        ids = list(
+            Notification.objects.select_for_update(skip_locked=True).filter(
+                status=Notification.PENDING,
+                next_attempt_at__lte=now
+            ).order_by('next_attempt_at').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        Notification.objects.filter(id__in=ids).update(
+            next_attempt_at=now + timedelta(seconds=lease),
+            attempts=F('attempts') + 1,
+            claim_token=claim_token
+        )
+
+    return list(_with_related(Notification.objects.filter(id__in=ids)).order_by('id'))
+
+
+def get_claim(notification):
+    """
+        Reference to a claimed notification for whoever completes it, e.g. a task it's handed to
+    """
+    return f'{notification.id}:{notification.claim_token}'
+
+
+def _parse_claim(claim):
+    notification_id, claim_token = claim.split(':', 1)
+    return int(notification_id), claim_token
+
+
+def get_claimed_notification(claim):
+    """
+        Returns the notification of `claim` if it's still pending under it, otherwise None
+    """
+    notification_id, claim_token = _parse_claim(claim)
+    return _with_related(_held([(notification_id, claim_token)])).first()
+
+
+def _held(claims):
+    """
+        The pending notifications still held under the given (id, claim token) pairs
+    """
+    held = Q(pk__in=[])
+    for notification_id, claim_token in claims:
+        held |= Q(id=notification_id, claim_token=claim_token)
+    return Notification.objects.filter(held, status=Notification.PENDING)
+
+
+def _mark_sent(held):
+    transaction_ids = list(held.select_for_update().values_list('transaction_id', flat=True))
+    if transaction_ids:
+        held.update(status=Notification.SENT, sent_at=timezone.now(), last_error=None, claim_token=None)
+        Transaction.objects.filter(id__in=transaction_ids).update(acknowledged=True)
+    return len(transaction_ids)
+
+
+def complete_notifications(sent, failed, queued=()):
+    """
+        Records the outcome of the claimed notifications, of those that are still
+        held under their claim. The outputs of those sent are marked as acknowledged.
+
+    Parameters
+    ------------
+    sent: list of `Notification`
+    failed: list of (`Notification`, error, retry) tuples
+        retried with backoff until `MAX_ATTEMPTS` if `retry` is set
+    queued: list of `Notification`
+        handed to a sending queue that completes them, held for `QUEUED_LEASE` meanwhile
+    """
+    now = timezone.now()
+    with trans.atomic():
+        if queued:
+            _held((x.id, x.claim_token) for x in queued).update(
+                next_attempt_at=now + timedelta(seconds=QUEUED_LEASE),
+                last_error=None
+            )
+
+        if sent:
+            _mark_sent(_held((x.id, x.claim_token) for x in sent))
+
+        for notification, error, retry in failed:
+            held = _held([(notification.id, notification.claim_token)])
+            if retry and notification.attempts < MAX_ATTEMPTS:
+                held.update(
+                    next_attempt_at=now + timedelta(seconds=get_retry_countdown(notification.attempts)),
+                    last_error=error,
+                    claim_token=None
+                )
+            elif held.update(status=Notification.FAILED, last_error=error, claim_token=None):
+                LOGGER.error(f'Giving up on {notification.channel} notification {notification.id}: {error}')
+
+
+def confirm_notifications(claims, error=None):
+    """
+        Completes the notifications queued under `claims` (see `get_claim`) once they're
+        sent, or fails them if they were rejected with `error`
+    """
+    held = _held(_parse_claim(x) for x in claims)
+    with trans.atomic():
+        if error is None:
+            return _mark_sent(held)
+
+        failed = held.update(status=Notification.FAILED, last_error=error, claim_token=None)
+        if failed:
+            LOGGER.error(f'Giving up on {failed} notifications: {error}')
+        return failed
@@ -0,0 +1,177 @@
+import base64
+import binascii
+import datetime
+import json
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework import pagination, response
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param
+
+
+class _CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder drops the microseconds, which would skip rows on ties
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+        Cursor pagination over a unique ordering, e.g. `('-date_created', '-id')`.
+
+        The cursor holds the ordering values of the last row of a page and the next
+        page is fetched with a `WHERE (ordering) < (cursor)` condition, so deep pages
+        cost the same as the first one. Total counts are only computed on request
+        (`?count=true`) since they need a full scan of the filtered rows.
+        The last ordering field must be unique and not nullable.
+    """
+    ordering = ('-id',)
+    page_size = 10
+    max_page_size = 50
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, values):
+        data = json.dumps(values, cls=_CursorEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def get_row_value(self, row, field):
+        if isinstance(row, dict):
+            return row[field]
+        value = row
+        for attr in field.split('__'):
+            if value is None:
+                break
+            value = getattr(value, attr)
+        return value
+
+    def _after(self, field, descending, value):
+        # Postgres puts nulls first in descending order and last in ascending order
+        if descending:
+            if value is None:
+                return Q(**{f'{field}__isnull': False})
+            return Q(**{f'{field}__lt': value})
+        if value is None:
+            return Q(pk__in=[])
+        return Q(**{f'{field}__gt': value}) | Q(**{f'{field}__isnull': True})
+
+    def _equal(self, field, value):
+        if value is None:
+            return Q(**{f'{field}__isnull': True})
+        return Q(**{field: value})
+
+    def _bound(self, field, descending, value):
+        if value is None:
+            return Q()
+        if descending:
+            return Q(**{f'{field}__lte': value})
+        return Q(**{f'{field}__gte': value}) | Q(**{f'{field}__isnull': True})
+
+    def get_keyset_filter(self, values):
+        """
+            Rows that come after `values` in the ordering:
+            (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+        """
+        keyset_filter = None
+        equal = Q()
+        for ordering, value in zip(self.ordering, values):
+            descending = ordering.startswith('-')
+            field = ordering.lstrip('-')
+            condition = equal & self._after(field, descending, value)
+            keyset_filter = condition if keyset_filter is None else keyset_filter | condition
+            equal &= self._equal(field, value)
+
+        # Redundant bound on the first column, the ORs alone don't let the database
+        # start a range scan of the index on the ordering at the cursor
+        first = self.ordering[0]
+        return self._bound(first.lstrip('-'), first.startswith('-'), values[0]) & keyset_filter
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_page_size(request)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() in ('1', 'true'):
+            self.count = queryset.count()
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            queryset = queryset.filter(self.get_keyset_filter(cursor))
+
+        rows = list(queryset[:self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        rows = rows[:self.limit]
+
+        self.next_cursor = None
+        if self.has_next:
+            last_row = rows[-1]
+            self.next_cursor = self.encode_cursor([
+                self.get_row_value(last_row, x.lstrip('-')) for x in self.ordering
+            ])
+        return rows
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return response.Response(OrderedDict([
+            ('count', self.count),
+            ('limit', self.limit),
+            ('cursor', self.next_cursor),
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'count': {
+                    'type': 'integer',
+                    'nullable': True,
+                    'example': 123,
+                },
+                'limit': {
+                    'type': 'integer',
+                    'example': 10,
+                },
+                'cursor': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'results': schema,
+            },
+        }
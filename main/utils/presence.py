@@ -0,0 +1,83 @@
+import time
+
+from django.conf import settings
+
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__PRESENCE = 'ws:presence:{room}'
+
+# Connections that miss their heartbeats for this long are dropped, along with
+# the whole room if none are left (e.g. the server holding them died)
+PRESENCE_TTL = 60 * 5
+HEARTBEAT_INTERVAL = 60 * 2
+
+
+def get_room_name(address, tokenid=''):
+    """
+        Channel layer group of the websocket connections watching `address` (and `tokenid`)
+    """
+    return address.replace(':', '_') + f'_{tokenid}'
+
+
+def get_address_rooms(address, tokenid=None):
+    """
+        Rooms that get the updates of an output of `address`
+    """
+    rooms = [get_room_name(address)]
+    if tokenid and address.startswith('simpleledger:'):
+        rooms.append(get_room_name(address, tokenid))
+    return rooms
+
+
+class Presence(object):
+    """
+        Tracks the websocket connections of each room in redis instead of the database.
+
+        A room is a hash of channel name to the connection's expiry, and the hash
+        itself expires `PRESENCE_TTL` seconds after the last heartbeat, so checking
+        for listeners is a single O(1) `EXISTS` and nothing has to clean up after
+        connections that were never closed properly.
+    """
+
+    def join(self, room, channel_name):
+        name = _REDIS_NAME__PRESENCE.format(room=room)
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.hset(name, channel_name, int(time.time()) + PRESENCE_TTL)
+        pipe.expire(name, PRESENCE_TTL)
+        pipe.execute()
+
+    def leave(self, room, channel_name):
+        # The room is gone once its last connection leaves
+        REDIS_STORAGE.hdel(_REDIS_NAME__PRESENCE.format(room=room), channel_name)
+
+    def heartbeat(self, room, channel_name):
+        self.join(room, channel_name)
+
+        # Also drops the connections of the room that stopped sending heartbeats
+        name = _REDIS_NAME__PRESENCE.format(room=room)
+        now = time.time()
+        expired = [
+            channel for channel, expiry in REDIS_STORAGE.hgetall(name).items()
+            if int(expiry) < now
+        ]
+        if expired:
+            REDIS_STORAGE.hdel(name, *expired)
+
+    def is_present(self, room):
+        return bool(REDIS_STORAGE.exists(_REDIS_NAME__PRESENCE.format(room=room)))
+
+    def filter(self, rooms):
+        """
+            Returns the rooms that have connections, in a single round trip
+        """
+        rooms = list(rooms)
+        if not rooms:
+            return set()
+
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        for room in rooms:
+            pipe.exists(_REDIS_NAME__PRESENCE.format(room=room))
+        return {room for room, exists in zip(rooms, pipe.execute()) if exists}
+
+
+PRESENCE = Presence()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import grpc
+import os
 import random
 import logging
+import threading
 from main.utils.bchd import bchrpc_pb2 as pb
 from main.utils.bchd import bchrpc_pb2_grpc as bchrpc
 from grpc._channel import _InactiveRpcError
@@ -10,15 +12,133 @@ import ssl
 
 LOGGER = logging.getLogger(__name__)
 
+BCHD_NODES = [
+    'bchd.imaginary.cash:8335',
+    # 'bchd.greyh.at:8335',
+    # 'bchd.fountainhead.cash:443'
+]
+
+# Number of long-lived HTTP/2 channels kept per node in each process
+CHANNEL_POOL_SIZE = 2
+CHANNEL_READY_TIMEOUT = 10
+RPC_TIMEOUT = 60
+
+CHANNEL_OPTIONS = (
+    ('grpc.enable_http_proxy', 0),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    # Blocks fetched with full transactions easily exceed the 4MB default
+    ('grpc.max_receive_message_length', 64 * 1024 * 1024),
+)
+
+
+class BCHDChannelPool(object):
+    """
+        Process-wide pool of secure gRPC channels to BCHD nodes.
+
+        Server certificates are fetched once per node and channels are reused
+        across calls. gRPC reconnects idle or broken channels on its own; a
+        channel that reports SHUTDOWN, or a node that keeps answering
+        UNAVAILABLE, is rebuilt from scratch through `reset()`.
+    """
+
+    def __init__(self, size=CHANNEL_POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self._pid = os.getpid()
+        self._credentials = {}
+        self._channels = {}
+        self._stubs = {}
+        self._states = {}
+        self._counter = 0
+
+    def _check_pid(self):
+        # Channels inherited through fork() (e.g. celery prefork workers) are unusable
+        if self._pid != os.getpid():
+            self._clear()
+
+    def get_credentials(self, node):
+        with self._lock:
+            self._check_pid()
+            if node not in self._credentials:
+                cert = ssl.get_server_certificate(node.split(':'))
+                self._credentials[node] = grpc.ssl_channel_credentials(
+                    root_certificates=str.encode(cert)
+                )
+            return self._credentials[node]
+
+    def _track_state(self, channel):
+        def callback(state):
+            self._states[id(channel)] = state
+        channel.subscribe(callback, try_to_connect=False)
+
+    def _create_channel(self, node):
+        creds = self.get_credentials(node)
+        channel = grpc.secure_channel(node, creds, options=CHANNEL_OPTIONS)
+        try:
+            grpc.channel_ready_future(channel).result(timeout=CHANNEL_READY_TIMEOUT)
+        except grpc.FutureTimeoutError:
+            channel.close()
+            raise ConnectionError(f'BCHD node {node} is not reachable')
+        self._track_state(channel)
+        return channel
+
+    def _is_healthy(self, channel):
+        state = self._states.get(id(channel))
+        return state != grpc.ChannelConnectivity.SHUTDOWN
+
+    def get_stub(self, node):
+        with self._lock:
+            self._check_pid()
+            channels = self._channels.setdefault(node, [])
+            self._counter += 1
+
+            if len(channels) >= self.size:
+                channel = channels[self._counter % len(channels)]
+                if self._is_healthy(channel):
+                    return self._stubs[id(channel)]
+                LOGGER.info(f'Replacing unhealthy BCHD channel to {node}')
+                channels.remove(channel)
+                self._stubs.pop(id(channel), None)
+                self._states.pop(id(channel), None)
+
+        channel = self._create_channel(node)
+        with self._lock:
+            self._check_pid()
+            # Another thread may have filled the pool, or `reset()` replaced it, in the meantime
+            channels = self._channels.setdefault(node, [])
+            if len(channels) < self.size:
+                channels.append(channel)
+                self._stubs[id(channel)] = bchrpc.bchrpcStub(channel)
+                return self._stubs[id(channel)]
+            stub = self._stubs[id(channels[self._counter % len(channels)])]
+
+        self._states.pop(id(channel), None)
+        channel.close()
+        return stub
+
+    def reset(self, node):
+        with self._lock:
+            channels = self._channels.pop(node, [])
+            self._credentials.pop(node, None)
+            for channel in channels:
+                self._stubs.pop(id(channel), None)
+                self._states.pop(id(channel), None)
+                channel.close()
+
+
+CHANNEL_POOL = BCHDChannelPool()
+
+
 class BCHDQuery(object):
 
     def __init__(self):
-        nodes = [
-            'bchd.imaginary.cash:8335',
-            # 'bchd.greyh.at:8335',
-            # 'bchd.fountainhead.cash:443'
-        ]
-        self.base_url = random.choice(nodes)
+        self.base_url = random.choice(BCHD_NODES)
 
         self._slp_action = {
             0: 'NON_SLP',
@@ -35,32 +155,50 @@ class BCHDQuery(object):
             11: 'SLP_V1_NFT1_UNIQUE_CHILD_SEND'
         }
 
-    def get_latest_block(self, include_transactions=True, full_transactions=False):
-        cert = ssl.get_server_certificate(self.base_url.split(':'))
-        creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
+    def _call(self, method, req, timeout=RPC_TIMEOUT):
+        """
+            Execute a unary RPC on a pooled channel, rebuilding the
+            node's channels and retrying once if the node is unavailable.
+        """
+        for attempt in range(2):
+            stub = CHANNEL_POOL.get_stub(self.base_url)
+            try:
+                return getattr(stub, method)(req, timeout=timeout)
+            except grpc.RpcError as exc:
+                if attempt == 0 and exc.code() == grpc.StatusCode.UNAVAILABLE:
+                    LOGGER.warning(f'BCHD {method} unavailable, reconnecting to {self.base_url}')
+                    CHANNEL_POOL.reset(self.base_url)
+                    continue
+                raise
 
-        with grpc.secure_channel(self.base_url, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-            stub = bchrpc.bchrpcStub(channel)
-            
-            req = pb.GetBlockchainInfoRequest()
-            resp = stub.GetBlockchainInfo(req)
-            latest_block = resp.best_height
+    def get_latest_block(self, include_transactions=True, full_transactions=False):
+        req = pb.GetBlockchainInfoRequest()
+        resp = self._call('GetBlockchainInfo', req)
+        latest_block = resp.best_height
 
-            return latest_block
+        return latest_block
 
-    def get_block(self, block, full_transactions=False):
-        cert = ssl.get_server_certificate(self.base_url.split(':'))
-        creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
+    def get_chain_tip(self):
+        """
+            Returns the height and hash of the node's best block
+        """
+        req = pb.GetBlockchainInfoRequest()
+        resp = self._call('GetBlockchainInfo', req)
+        return resp.best_height, resp.best_block_hash[::-1].hex()
 
-        with grpc.secure_channel(self.base_url, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-            stub = bchrpc.bchrpcStub(channel)
+    def get_block_hash(self, block):
+        req = pb.GetBlockInfoRequest()
+        req.height = block
+        resp = self._call('GetBlockInfo', req)
+        return resp.info.hash[::-1].hex()
 
-            req = pb.GetBlockRequest()
-            req.height = block
-            req.full_transactions = full_transactions
-            resp = stub.GetBlock(req)
+    def get_block(self, block, full_transactions=False):
+        req = pb.GetBlockRequest()
+        req.height = block
+        req.full_transactions = full_transactions
+        resp = self._call('GetBlock', req)
 
-            return resp.block.transaction_data
+        return resp.block.transaction_data
 
     def _parse_transaction(self, txn, parse_slp=False):
         tx_hash = bytearray(txn.hash[::-1]).hex()
@@ -182,67 +320,44 @@ class BCHDQuery(object):
         return transaction
 
     def _get_raw_transaction(self, transaction_hash):
-        cert = ssl.get_server_certificate(self.base_url.split(':'))
-        creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
+        try:
+            req = pb.GetTransactionRequest()
+            txn_bytes = bytes.fromhex(transaction_hash)[::-1]
+            req.hash = txn_bytes
+            req.include_token_metadata = True
 
-        with grpc.secure_channel(self.base_url, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-            stub = bchrpc.bchrpcStub(channel)
-            
-            try:
-                req = pb.GetTransactionRequest()
-                txn_bytes = bytes.fromhex(transaction_hash)[::-1]
-                req.hash = txn_bytes
-                req.include_token_metadata = True
-
-                resp = stub.GetTransaction(req)
-                return resp.transaction
-            except _InactiveRpcError as exc:
-                LOGGER.error(str(exc))
-                return None
+            resp = self._call('GetTransaction', req)
+            return resp.transaction
+        except _InactiveRpcError as exc:
+            LOGGER.error(str(exc))
+            return None
 
     def get_transaction(self, transaction_hash, parse_slp=False):
         txn = self._get_raw_transaction(transaction_hash)
         return self._parse_transaction(txn, parse_slp=parse_slp)
 
     def get_utxos(self, address):
-        cert = ssl.get_server_certificate(self.base_url.split(':'))
-        creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
-
-        with grpc.secure_channel(self.base_url, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-            stub = bchrpc.bchrpcStub(channel)
-
-            req = pb.GetAddressUnspentOutputsRequest()
-            req.address = address
-            req.include_mempool = True
-            resp = stub.GetAddressUnspentOutputs(req)
-            return resp.outputs
+        req = pb.GetAddressUnspentOutputsRequest()
+        req.address = address
+        req.include_mempool = True
+        resp = self._call('GetAddressUnspentOutputs', req)
+        return resp.outputs
 
     def get_transactions_count(self, blockheight):
-        cert = ssl.get_server_certificate(self.base_url.split(':'))
-        creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
-
-        with grpc.secure_channel(self.base_url, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-            stub = bchrpc.bchrpcStub(channel)
+        req = pb.GetBlockRequest()
+        req.height = blockheight
+        req.full_transactions = False
+        resp = self._call('GetBlock', req)
 
-            req = pb.GetBlockRequest()
-            req.height = blockheight
-            req.full_transactions = False
-            resp = stub.GetBlock(req)
-
-            trs = resp.block.transaction_data
-            return len(trs)
+        trs = resp.block.transaction_data
+        return len(trs)
 
     def broadcast_transaction(self, transaction):
         txn_bytes = bytes.fromhex(transaction)
-        cert = ssl.get_server_certificate(self.base_url.split(':'))
-        creds = grpc.ssl_channel_credentials(root_certificates=str.encode(cert))
-
-        with grpc.secure_channel(self.base_url, creds, options=(('grpc.enable_http_proxy', 0),)) as channel:
-            stub = bchrpc.bchrpcStub(channel)
 
-            req = pb.SubmitTransactionRequest()
-            req.transaction = txn_bytes
-            resp = stub.SubmitTransaction(req)
+        req = pb.SubmitTransactionRequest()
+        req.transaction = txn_bytes
+        resp = self._call('SubmitTransaction', req)
 
-            tx_hash = bytearray(resp.hash[::-1]).hex()
-            return tx_hash
+        tx_hash = bytearray(resp.hash[::-1]).hex()
+        return tx_hash
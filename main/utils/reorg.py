@@ -0,0 +1,97 @@
+import logging
+
+from django.db import transaction as trans
+
+from main.models import BlockHeight, Transaction, WalletHistory
+from main.utils import block_scanner
+from main.utils.response_cache import RESPONSE_CACHE
+
+LOGGER = logging.getLogger(__name__)
+
+# Deepest reorg looked for, anything deeper needs a manual rescan
+MAX_REORG_DEPTH = 100
+
+
+def find_reorged_blocks(bchd, tip_number):
+    """
+        Compares the hashes of the scanned blocks with the node's chain, from the top
+        down, and returns the numbers of the blocks that are no longer part of it.
+        Only the topmost scanned block is fetched when there's no reorg.
+    """
+    # The chain got shorter, everything above the new tip is gone
+    reorged = list(
+        BlockHeight.objects.filter(
+            number__gt=tip_number,
+            block_hash__isnull=False
+        ).values_list('number', flat=True)
+    )
+
+    scanned = BlockHeight.objects.filter(
+        number__lte=tip_number,
+        block_hash__isnull=False
+    ).order_by('-number').values_list('number', 'block_hash')[:MAX_REORG_DEPTH]
+
+    for number, block_hash in scanned:
+        if bchd.get_block_hash(number) == block_hash:
+            break
+        reorged.append(number)
+    return sorted(reorged)
+
+
+def rollback_blocks(numbers, tip_number=None):
+    """
+        Reverts what was recorded from blocks that left the chain:
+        their transactions go back to unconfirmed, the outputs they spent are
+        unspent again, their wallet history is removed, and the blocks up to
+        `tip_number` are queued to be scanned again. Blocks above it are deleted,
+        they're created again (see `block_scanner.fill_gaps`) once the chain grows
+        back to them.
+
+        The transactions are then post-processed again, which marks their inputs as
+        spent and re-parses the wallet history if the node still knows about them
+        (i.e. they're back in the mempool or in the new chain).
+    """
+    # Deferred import, tasks depend on the scanner utils
+    from main.tasks import queue_transaction_post_save
+
+    numbers = list(numbers)
+    if not numbers:
+        return []
+
+    with trans.atomic():
+        confirmed = Transaction.objects.filter(blockheight__number__in=numbers)
+        txids = set(confirmed.values_list('txid', flat=True))
+        affected = list(confirmed.select_related('address', 'wallet'))
+        confirmed.update(blockheight=None)
+
+        spent = list(
+            Transaction.objects.filter(spending_txid__in=txids).select_related('address', 'wallet')
+        )
+        if spent:
+            Transaction.objects.filter(id__in=[x.id for x in spent]).update(spent=False, spending_txid='')
+
+        history = WalletHistory.objects.filter(txid__in=txids)
+        wallet_hashes = set(history.values_list('wallet__wallet_hash', flat=True).distinct())
+        history.delete()
+
+        rescanned = [x for x in numbers if tip_number is None or x <= tip_number]
+        dropped = [x for x in numbers if x not in rescanned]
+        if rescanned:
+            BlockHeight.objects.filter(number__in=rescanned).update(block_hash=None, transactions_count=0)
+            block_scanner.requeue_blocks(rescanned)
+        if dropped:
+            BlockHeight.objects.filter(number__in=dropped).delete()
+            block_scanner.BLOCK_QUEUE.remove(*dropped)
+
+        RESPONSE_CACHE.invalidate_transactions(affected + spent)
+        RESPONSE_CACHE.invalidate(wallet_hashes=wallet_hashes)
+
+        for txid in txids:
+            trans.on_commit(lambda txid=txid: queue_transaction_post_save(txid))
+
+    LOGGER.warning(
+        f'Rolled back {len(numbers)} reorged blocks ({numbers[0]} to {numbers[-1]}): '
+        f'{len(txids)} transactions unconfirmed, {len(spent)} outputs unspent, '
+        f'{len(dropped)} blocks above the new tip dropped'
+    )
+    return sorted(txids)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction as trans
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__RESPONSES = 'response-cache:{scope}'
+_REDIS_NAME__VERSION = 'response-cache:{scope}:version'
+
+# Safety net only, entries are invalidated as soon as the underlying records change
+RESPONSE_TTL = 300
+VERSION_TTL = 60 * 60 * 24
+
+
+def _wallet_scope(wallet_hash):
+    return f'wallet:{wallet_hash}'
+
+
+def _address_scope(address):
+    return f'address:{address}'
+
+
+class ResponseCache(object):
+    """
+        Cache of API responses scoped to a wallet or an address.
+
+        Each scope has a version that is bumped whenever the scope's records change.
+        Responses are stored along with the version they were computed from, so a
+        response computed from data that changed in the meantime is never served.
+    """
+
+    def get(self, scope, key):
+        """
+            Returns the cached data (None on a miss) and the current version of the scope
+        """
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        pipe.get(_REDIS_NAME__VERSION.format(scope=scope))
+        pipe.hget(_REDIS_NAME__RESPONSES.format(scope=scope), key)
+        version, cached = pipe.execute()
+        version = int(version or 0)
+
+        if cached:
+            cached_version, data = cached.decode().split('|', 1)
+            if int(cached_version) == version:
+                return json.loads(data), version
+        return None, version
+
+    def set(self, scope, key, version, data):
+        name = _REDIS_NAME__RESPONSES.format(scope=scope)
+        value = f'{version}|' + json.dumps(data, cls=JSONEncoder)
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        pipe.hset(name, key, value)
+        pipe.expire(name, RESPONSE_TTL)
+        pipe.execute()
+
+    def _invalidate(self, scopes):
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        for scope in scopes:
+            version_name = _REDIS_NAME__VERSION.format(scope=scope)
+            pipe.incr(version_name)
+            pipe.expire(version_name, VERSION_TTL)
+            pipe.delete(_REDIS_NAME__RESPONSES.format(scope=scope))
+        pipe.execute()
+
+    def invalidate(self, wallet_hashes=(), addresses=()):
+        """
+            Drops the cached responses of the given wallets and addresses,
+            once the current database transaction (if any) is committed
+        """
+        scopes = {_wallet_scope(x) for x in wallet_hashes if x}
+        scopes.update(_address_scope(x) for x in addresses if x)
+        if scopes:
+            trans.on_commit(lambda: self._invalidate(scopes))
+
+    def invalidate_transactions(self, transactions):
+        """
+            Same as `invalidate()` for the owners of `Transaction` instances,
+            which need their `address` and `wallet` loaded
+        """
+        wallet_hashes = set()
+        addresses = set()
+        for transaction in transactions:
+            if transaction.address:
+                addresses.add(transaction.address.address)
+            if transaction.wallet:
+                wallet_hashes.add(transaction.wallet.wallet_hash)
+        self.invalidate(wallet_hashes=wallet_hashes, addresses=addresses)
+
+    def invalidate_outputs(self, queryset):
+        """
+            Same as `invalidate()` for the owners of the outputs in a `Transaction`
+            queryset, looked up in a single query. Meant to be called before a bulk
+            update that may move the outputs out of the queryset.
+        """
+        owners = set(queryset.values_list('address__address', 'wallet__wallet_hash').distinct())
+        self.invalidate(
+            wallet_hashes={wallet_hash for _, wallet_hash in owners},
+            addresses={address for address, _ in owners}
+        )
+
+
+RESPONSE_CACHE = ResponseCache()
+
+
+def cached_response(view_method):
+    """
+        Serves a view method from `RESPONSE_CACHE`, scoped by the
+        `wallethash`, `bchaddress` or `slpaddress` url kwarg
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if kwargs.get('wallethash'):
+            scope = _wallet_scope(kwargs['wallethash'])
+        elif kwargs.get('bchaddress') or kwargs.get('slpaddress'):
+            scope = _address_scope(kwargs.get('bchaddress') or kwargs.get('slpaddress'))
+        else:
+            return view_method(self, request, *args, **kwargs)
+
+        key = f'{request.method}:{request.get_full_path()}'
+        if request.body:
+            key += ':' + hashlib.sha1(request.body).hexdigest()
+
+        data, version = RESPONSE_CACHE.get(scope, key)
+        if data is not None:
+            return Response(data=data, status=200)
+
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            RESPONSE_CACHE.set(scope, key, version, response.data)
+        return response
+
+    return wrapper
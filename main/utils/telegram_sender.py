@@ -0,0 +1,270 @@
+import logging
+import time
+
+import requests
+from django.conf import settings
+
+LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__MESSAGES = 'telegram:messages:{chat_id}'
+_REDIS_NAME__CHATS = 'telegram:chats'
+_REDIS_NAME__BUCKET = 'telegram:bucket:{name}'
+_REDIS_NAME__FLUSH_SCHEDULED = 'telegram:flush-scheduled'
+
+API_URL = 'https://api.telegram.org/bot'
+TIMEOUT = (3.05, 10)
+
+# Events for the same chat within this many seconds are sent as one message
+AGGREGATION_WINDOW = 1
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = '\n\n'
+
+# Bot API limits: about 30 messages per second overall, 1 per second per chat
+# and 20 per minute per group (groups have negative chat ids)
+GLOBAL_RATE = (30, 30)
+CHAT_RATE = (1, 1)
+GROUP_RATE = (20 / 60, 3)
+
+# Chats flushed per round and how long a flush keeps sending
+FLUSH_BATCH_SIZE = 100
+FLUSH_TIME_LIMIT = 50
+SEND_RETRY_DELAY = 30
+# Seconds a scheduled flush holds the flag past its countdown, in case its task is lost
+FLUSH_SCHEDULED_MARGIN = FLUSH_TIME_LIMIT + 60
+
+# Queued messages of outbox notifications are prefixed with the notification's claim
+# between two of these, a character that never appears in a message
+_ID_MARKER = '\x1e'
+
+
+# Takes a token from both buckets (rate per second, capacity) only if both have one,
+# otherwise returns the seconds to wait
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i = 1, 2 do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    local tokens = tonumber(redis.call('HGET', KEYS[i], 'tokens') or capacity)
+    local updated = tonumber(redis.call('HGET', KEYS[i], 'updated') or now)
+    tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+for i = 1, 2 do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', KEYS[i], 'tokens', tostring(tokens), 'updated', ARGV[1])
+    redis.call('EXPIRE', KEYS[i], 3600)
+end
+return tostring(wait)
+"""
+
+# Pops as many of a chat's messages as fit in one message, and either reschedules
+# the chat if some are left or removes it
+_POP_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, 49)
+local taken = {}
+local length = 0
+for i, item in ipairs(items) do
+    local size = string.len(item)
+    if string.sub(item, 1, 1) == ARGV[5] then
+        size = size - string.find(item, ARGV[5], 2, true)
+    end
+    if i > 1 then
+        size = size + tonumber(ARGV[3])
+        if length + size > tonumber(ARGV[2]) then
+            break
+        end
+    end
+    length = length + size
+    table.insert(taken, item)
+end
+if #taken > 0 then
+    redis.call('LTRIM', KEYS[1], #taken, -1)
+end
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+else
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return taken
+"""
+
+
+class TelegramSender(object):
+    """
+        Sends Telegram messages in the background within the Bot API limits.
+
+        Messages are queued per chat in redis. Those for the same chat within
+        `AGGREGATION_WINDOW` seconds are joined into one message, and chats are
+        sent to as soon as both the global and the chat's token buckets allow it.
+        A chat that's told to back off (HTTP 429 with `retry_after`) is
+        rescheduled instead of blocking the others.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self._acquire = REDIS_STORAGE.register_script(_ACQUIRE_SCRIPT)
+        self._pop = REDIS_STORAGE.register_script(_POP_SCRIPT)
+
+    def queue(self, chat_id, message, claim=None):
+        """
+            Returns True if the chat had nothing pending, i.e. a flush should be scheduled.
+            The sending of the notification `claim` is confirmed through `flush`'s `on_sent`.
+        """
+        item = message[:MAX_MESSAGE_LENGTH]
+        if claim is not None:
+            item = f'{_ID_MARKER}{claim}{_ID_MARKER}{item}'
+
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.rpush(_REDIS_NAME__MESSAGES.format(chat_id=chat_id), item)
+        # Chats already pending keep their place
+        pipe.zadd(_REDIS_NAME__CHATS, {chat_id: time.time() + AGGREGATION_WINDOW}, nx=True)
+        _, added = pipe.execute()
+        return bool(added)
+
+    def claim_flush(self, delay, extend=False):
+        """
+            Returns True if no flush was scheduled, i.e. the caller should schedule one
+            in `delay` seconds. The one that is scheduled `extend`s its claim to reschedule itself.
+        """
+        expiry = int(delay) + 1 + FLUSH_SCHEDULED_MARGIN
+        return bool(REDIS_STORAGE.set(_REDIS_NAME__FLUSH_SCHEDULED, 1, nx=not extend, ex=expiry))
+
+    def release_flush(self):
+        """
+            Clears the flag of the scheduled flush once it found nothing to send.
+            Returns the seconds until the next chat is due in case some were queued meanwhile.
+        """
+        REDIS_STORAGE.delete(_REDIS_NAME__FLUSH_SCHEDULED)
+        return self._next_due()
+
+    def _next_due(self):
+        upcoming = REDIS_STORAGE.zrange(_REDIS_NAME__CHATS, 0, 0, withscores=True)
+        if not upcoming:
+            return None
+        return max(upcoming[0][1] - time.time(), 0)
+
+    def _reschedule(self, chat_id, delay):
+        REDIS_STORAGE.zadd(_REDIS_NAME__CHATS, {chat_id: time.time() + delay})
+
+    def _acquire_token(self, chat_id):
+        rate, capacity = GROUP_RATE if str(chat_id).startswith('-') else CHAT_RATE
+        wait = self._acquire(
+            keys=[
+                _REDIS_NAME__BUCKET.format(name='global'),
+                _REDIS_NAME__BUCKET.format(name=chat_id)
+            ],
+            args=[time.time(), GLOBAL_RATE[0], GLOBAL_RATE[1], rate, capacity]
+        )
+        return float(wait)
+
+    def _requeue(self, chat_id, messages, delay):
+        name = _REDIS_NAME__MESSAGES.format(chat_id=chat_id)
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.lpush(name, *reversed(messages))
+        pipe.zadd(_REDIS_NAME__CHATS, {chat_id: time.time() + delay})
+        pipe.execute()
+
+    def send(self, chat_id, text):
+        """
+            Returns (retry_after, error): the seconds to wait before retrying, or None once
+            sent or rejected for good, with the error it was rejected with
+        """
+        data = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": "HTML",
+            "disable_web_page_preview": True
+        }
+        try:
+            response = self.session.post(
+                f"{API_URL}{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
+                data=data,
+                timeout=TIMEOUT
+            )
+        except requests.RequestException as exc:
+            LOGGER.warning(f'Unable to send telegram message to {chat_id}: {exc}')
+            return SEND_RETRY_DELAY, None
+
+        if response.status_code == 429:
+            try:
+                return response.json()['parameters']['retry_after'], None
+            except (ValueError, KeyError, TypeError):
+                return SEND_RETRY_DELAY, None
+        if response.status_code >= 500:
+            return SEND_RETRY_DELAY, None
+        if response.status_code != 200:
+            # e.g. the bot was blocked or the chat doesn't exist
+            error = f'{response.status_code} {response.text}'
+            LOGGER.error(f'Telegram rejected message to {chat_id}: {error}')
+            return None, error
+        return None, None
+
+    def _confirm(self, on_sent, items, error):
+        claims = [x.split(_ID_MARKER, 2)[1] for x in items if x.startswith(_ID_MARKER)]
+        if not claims or on_sent is None:
+            return
+        try:
+            on_sent(claims, error)
+        except Exception as exc:
+            # Left to the outbox to send again
+            LOGGER.exception(f'Unable to confirm telegram notifications {claims}: {exc}')
+
+    def flush(self, time_limit=FLUSH_TIME_LIMIT, on_sent=None):
+        """
+            Sends to the chats that are due until none are left or `time_limit` runs out.
+            Returns the seconds until the next chat is due, or None if there are none.
+
+            `on_sent(claims, error)` is called with the claims the messages were
+            queued with once they're sent, or rejected for good with `error`.
+        """
+        started_at = time.monotonic()
+        sent = 0
+        while time.monotonic() - started_at < time_limit:
+            now = time.time()
+            chat_ids = REDIS_STORAGE.zrangebyscore(_REDIS_NAME__CHATS, '-inf', now, start=0, num=FLUSH_BATCH_SIZE)
+            if not chat_ids:
+                break
+
+            for chat_id in chat_ids:
+                chat_id = chat_id.decode() if isinstance(chat_id, bytes) else chat_id
+                wait = self._acquire_token(chat_id)
+                if wait > 0:
+                    self._reschedule(chat_id, wait)
+                    continue
+
+                messages = self._pop(
+                    keys=[_REDIS_NAME__MESSAGES.format(chat_id=chat_id), _REDIS_NAME__CHATS],
+                    args=[chat_id, MAX_MESSAGE_LENGTH, len(SEPARATOR), time.time() + 1, _ID_MARKER]
+                )
+                messages = [x.decode() if isinstance(x, bytes) else x for x in messages]
+                if not messages:
+                    continue
+
+                text = SEPARATOR.join(
+                    x.split(_ID_MARKER, 2)[2] if x.startswith(_ID_MARKER) else x
+                    for x in messages
+                )
+                retry_after, error = self.send(chat_id, text)
+                if retry_after is None:
+                    sent += 1
+                    self._confirm(on_sent, messages, error)
+                else:
+                    LOGGER.warning(f'Retrying telegram messages to {chat_id} in {retry_after}s')
+                    self._requeue(chat_id, messages, retry_after)
+
+        if sent:
+            LOGGER.info(f'Sent {sent} telegram messages')
+
+        return self._next_due()
+
+
+TELEGRAM_SENDER = TelegramSender()
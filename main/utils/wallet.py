@@ -1,5 +1,6 @@
 from main.models import Transaction
-from django.db.models import Sum
+from main.utils.money import from_base_units, get_token_decimals
+from django.db.models import Count, Q, Sum
 
 
 class HistoryParser(object):
@@ -22,21 +23,41 @@ class HistoryParser(object):
         )
         return outputs
 
+    def _aggregate(self, records):
+        return records.aggregate(
+            amount=Sum('amount'),
+            value=Sum('value'),
+            missing_values=Count('id', filter=Q(value__isnull=True))
+        )
+
     def parse(self):
-        total_outputs = 0
+        """
+            Returns the record type, the amount and the amount in base units (None
+            if some records don't have theirs yet) of the wallet's side of the tx
+        """
+        total_outputs = {'amount': 0, 'value': 0, 'missing_values': 0}
         outputs = self.get_relevant_outpus()
         if outputs.exists():
-            outputs_agg = outputs.aggregate(Sum('amount'))
-            total_outputs = outputs_agg['amount__sum']
+            total_outputs = self._aggregate(outputs)
 
-        total_inputs = 0
+        total_inputs = {'amount': 0, 'value': 0, 'missing_values': 0}
         inputs = self.get_relevant_inputs()
         if inputs.exists():
-            inputs_agg = inputs.aggregate(Sum('amount'))
-            total_inputs = inputs_agg['amount__sum']
+            total_inputs = self._aggregate(inputs)
+
+        value = None
+        diff = None
+        if not total_outputs['missing_values'] and not total_inputs['missing_values']:
+            record = outputs.select_related('token').first() or inputs.select_related('token').first()
+            decimals = get_token_decimals(record.token) if record else None
+            if decimals is not None:
+                value = (total_outputs['value'] or 0) - (total_inputs['value'] or 0)
+                diff = float(from_base_units(value, decimals))
+
+        if diff is None:
+            diff = (total_outputs['amount'] or 0) - (total_inputs['amount'] or 0)
+            diff = round(diff, 8)
 
-        diff = total_outputs - total_inputs
-        diff = round(diff, 8)
         if diff > 0:
             record_type = 'incoming'
         else:
@@ -55,4 +76,4 @@ class HistoryParser(object):
                     change_address = tx_output.address.address
                     break
 
-        return record_type, diff, change_address
+        return record_type, diff, change_address, value
@@ -0,0 +1,332 @@
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from main.models import Address
+from main.utils.chunk import chunks
+
+LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__ADDRESSES = 'watched-addresses'
+_REDIS_NAME__BLOOM = 'watched-addresses:bloom'
+_REDIS_NAME__VERSION = 'watched-addresses:version'
+_REDIS_NAME__CHANGES = 'watched-addresses:changes'
+_REDIS_NAME__REBUILD_LOCK = 'watched-addresses:rebuild-lock'
+_REDIS_NAME__ADDRESSES_TMP = 'watched-addresses:tmp'
+_REDIS_NAME__BLOOM_TMP = 'watched-addresses:bloom:tmp'
+
+# 2^23 bits (1MB) with 7 hashes keeps false positives around 1% up to ~800k addresses
+BLOOM_SIZE = 2 ** 23
+BLOOM_HASHES = 7
+
+# Changes kept for processes to catch up with, those further behind reload the whole bloom filter
+CHANGES_MAX_LENGTH = 10000
+
+
+# Bumps the version and logs the addresses added with it (if any)
+_PUBLISH_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', 'version', version, 'addresses', ARGV[1])
+return version
+"""
+
+
+class WatchedAddressIndex(object):
+    """
+        Index of the addresses known to watchtower (i.e. every `main.models.Address`),
+        used to discard outputs of unwatched addresses before touching the database.
+
+        The exact set and a bloom filter of it are kept in Redis. Each process mirrors
+        the bloom filter in memory, so an address we don't know about is rejected
+        without a database query; bloom positives are confirmed against the exact set
+        in Redis.
+
+        Every change bumps the index version and is appended to a stream of changes,
+        which processes apply to their own copy instead of downloading the whole bloom
+        filter again. Lookups check the version in the same round trip, and addresses
+        the local copy missed are checked again once it's caught up, so an address is
+        never rejected after it was added.
+
+        The index is a superset filter: callers that care about subscriptions still
+        have to check `Subscription` for the addresses that pass it.
+    """
+
+    def __init__(self):
+        self._bloom = bytearray()
+        self._version = None
+        self._change_id = '0-0'
+        self._lock = threading.Lock()
+
+    def _positions(self, address):
+        digest = hashlib.blake2b(address.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % BLOOM_SIZE for i in range(BLOOM_HASHES)]
+
+    def _bloom_contains(self, address):
+        bloom = self._bloom
+        for position in self._positions(address):
+            byte_index = position >> 3
+            if byte_index >= len(bloom):
+                return False
+            # Redis bitmaps are big-endian within each byte
+            if not (bloom[byte_index] >> (7 - (position & 7))) & 1:
+                return False
+        return True
+
+    def _bloom_add(self, address):
+        for position in self._positions(address):
+            byte_index = position >> 3
+            if byte_index >= len(self._bloom):
+                self._bloom.extend(bytes(byte_index + 1 - len(self._bloom)))
+            self._bloom[byte_index] |= 1 << (7 - (position & 7))
+
+    def _set_bits(self, pipe, key, address):
+        for position in self._positions(address):
+            pipe.setbit(key, position, 1)
+
+    def _load(self):
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.get(_REDIS_NAME__VERSION)
+        pipe.get(_REDIS_NAME__BLOOM)
+        pipe.xrevrange(_REDIS_NAME__CHANGES, count=1)
+        version, bloom, last_change = pipe.execute()
+
+        self._bloom = bytearray(bloom or b'')
+        self._version = int(version) if version is not None else None
+        self._change_id = last_change[0][0] if last_change else '0-0'
+
+    def _sync(self, version):
+        """
+            Brings the local bloom filter up to `version` (as read from Redis)
+        """
+        with self._lock:
+            if version is None:
+                # The index is gone (e.g. Redis was flushed), unless another process is already at it
+                self.rebuild()
+                self._load()
+                return
+
+            version = int(version)
+            if self._version == version:
+                return
+            if self._version is None or version < self._version:
+                self._load()
+                return
+
+            changes = REDIS_STORAGE.xread({_REDIS_NAME__CHANGES: self._change_id})
+            for change_id, fields in (changes[0][1] if changes else []):
+                change_version = int(fields[b'version'])
+                if change_version <= self._version:
+                    continue
+                if change_version != self._version + 1:
+                    # Missed changes that were trimmed, or the index was rebuilt
+                    self._load()
+                    return
+                for address in fields.get(b'addresses', b'').decode().split():
+                    self._bloom_add(address)
+                self._version = change_version
+                self._change_id = change_id
+
+            if self._version < version:
+                self._load()
+
+    def _check_members(self, addresses):
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        for address in addresses:
+            pipe.sismember(_REDIS_NAME__ADDRESSES, address)
+        return {x for x, is_member in zip(addresses, pipe.execute()) if is_member}
+
+    def filter(self, addresses):
+        """
+            Returns the subset of `addresses` that are watched
+        """
+        addresses = {x for x in addresses if x}
+        if not addresses:
+            return set()
+
+        if self._version is None:
+            self._sync(self.get_version())
+        if self._version is None:
+            # The index is being built by another process, fall back to the database
+            return set(
+                Address.objects.filter(address__in=addresses).values_list('address', flat=True)
+            )
+
+        candidates = [x for x in addresses if self._bloom_contains(x)]
+        pipe = REDIS_STORAGE.pipeline(transaction=False)
+        pipe.get(_REDIS_NAME__VERSION)
+        for address in candidates:
+            pipe.sismember(_REDIS_NAME__ADDRESSES, address)
+        version, *results = pipe.execute()
+        watched = {x for x, is_member in zip(candidates, results) if is_member}
+
+        if version is None or int(version) != self._version:
+            self._sync(version)
+            if self._version is None:
+                return set(
+                    Address.objects.filter(address__in=addresses).values_list('address', flat=True)
+                )
+            # Addresses added since the local copy was last synced
+            missed = [x for x in addresses if x not in candidates and self._bloom_contains(x)]
+            if missed:
+                watched.update(self._check_members(missed))
+        return watched
+
+    def contains(self, address):
+        return bool(self.filter([address]))
+
+    def get_version(self):
+        return REDIS_STORAGE.get(_REDIS_NAME__VERSION)
+
+    def members(self):
+        """
+            Returns the version of the index and the full set of watched addresses
+        """
+        for _ in range(2):
+            pipe = REDIS_STORAGE.pipeline()
+            pipe.get(_REDIS_NAME__VERSION)
+            pipe.smembers(_REDIS_NAME__ADDRESSES)
+            version, addresses = pipe.execute()
+            if version is not None:
+                return version, {x.decode() for x in addresses}
+            self.rebuild()
+        return None, set(Address.objects.values_list('address', flat=True))
+
+    def _publish_change(self, pipe, addresses=()):
+        # The version is bumped and the change logged atomically, so that processes
+        # applying the log end up at exactly that version
+        pipe.eval(
+            _PUBLISH_SCRIPT,
+            2,
+            _REDIS_NAME__VERSION,
+            _REDIS_NAME__CHANGES,
+            ' '.join(addresses),
+            CHANGES_MAX_LENGTH
+        )
+
+    def add(self, *addresses):
+        """
+            Only call once the addresses are committed (see `rebuild()`)
+        """
+        addresses = [x for x in addresses if x]
+        if not addresses:
+            return
+
+        targets = []
+        is_built = REDIS_STORAGE.exists(_REDIS_NAME__VERSION)
+        if is_built:
+            targets.append((_REDIS_NAME__ADDRESSES, _REDIS_NAME__BLOOM))
+        if REDIS_STORAGE.exists(_REDIS_NAME__REBUILD_LOCK):
+            # Don't lose addresses created while a rebuild is reading the table
+            targets.append((_REDIS_NAME__ADDRESSES_TMP, _REDIS_NAME__BLOOM_TMP))
+        if not targets:
+            # Nothing built yet, the first rebuild will pick these up from the database
+            return
+
+        pipe = REDIS_STORAGE.pipeline()
+        for addresses_key, bloom_key in targets:
+            pipe.sadd(addresses_key, *addresses)
+            for address in addresses:
+                self._set_bits(pipe, bloom_key, address)
+        if is_built:
+            self._publish_change(pipe, addresses)
+        pipe.execute()
+
+    def remove(self, *addresses):
+        """
+            Bloom filters can't forget, the stale bits go away on the next `rebuild()`
+        """
+        addresses = [x for x in addresses if x]
+        if not addresses:
+            return
+
+        if not REDIS_STORAGE.exists(_REDIS_NAME__VERSION):
+            # Nothing built yet, the version is only ever created by a rebuild
+            return
+
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.srem(_REDIS_NAME__ADDRESSES, *addresses)
+        self._publish_change(pipe)
+        pipe.execute()
+
+    def rebuild(self):
+        """
+            Rebuilds the Redis set and bloom filter from the `Address` table.
+
+            Addresses committed after the table was read are added by `add()` to the
+            index being replaced, so the changes logged since then are replayed onto
+            the new one as it replaces it.
+        """
+        acquired = REDIS_STORAGE.set(_REDIS_NAME__REBUILD_LOCK, 1, nx=True, ex=300)
+        if not acquired:
+            return False
+
+        LOGGER.info('Rebuilding the watched addresses index')
+        tmp_addresses = _REDIS_NAME__ADDRESSES_TMP
+        tmp_bloom = _REDIS_NAME__BLOOM_TMP
+        try:
+            REDIS_STORAGE.delete(tmp_addresses, tmp_bloom)
+            # Allocate the whole bitmap upfront
+            REDIS_STORAGE.setbit(tmp_bloom, BLOOM_SIZE - 1, 0)
+
+            last_change = REDIS_STORAGE.xrevrange(_REDIS_NAME__CHANGES, count=1)
+            since = last_change[0][0] if last_change else '0-0'
+            addresses = list(Address.objects.values_list('address', flat=True))
+            for chunk in chunks(addresses, 5000):
+                pipe = REDIS_STORAGE.pipeline(transaction=False)
+                pipe.sadd(tmp_addresses, *chunk)
+                for address in chunk:
+                    self._set_bits(pipe, tmp_bloom, address)
+                pipe.execute()
+
+            replayed = self._replace_index(since)
+            if replayed:
+                LOGGER.info(f'Replayed {replayed} watched addresses added during the rebuild')
+            LOGGER.info(f'Watched addresses index rebuilt with {len(addresses)} addresses')
+        finally:
+            REDIS_STORAGE.delete(_REDIS_NAME__REBUILD_LOCK)
+
+        return True
+
+    def _replace_index(self, since):
+        """
+            Replays the changes logged after `since` onto the temporary keys and renames
+            them over the index, retrying if another change is logged in between
+        """
+        with REDIS_STORAGE.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(_REDIS_NAME__VERSION)
+                    changes = pipe.xread({_REDIS_NAME__CHANGES: since})
+                    replayed = [
+                        address
+                        for _, fields in (changes[0][1] if changes else [])
+                        for address in fields.get(b'addresses', b'').decode().split()
+                    ]
+                    has_addresses = replayed or pipe.exists(_REDIS_NAME__ADDRESSES_TMP)
+
+                    pipe.multi()
+                    if replayed:
+                        pipe.sadd(_REDIS_NAME__ADDRESSES_TMP, *replayed)
+                        for address in replayed:
+                            self._set_bits(pipe, _REDIS_NAME__BLOOM_TMP, address)
+                    if has_addresses:
+                        pipe.rename(_REDIS_NAME__ADDRESSES_TMP, _REDIS_NAME__ADDRESSES)
+                    else:
+                        pipe.delete(_REDIS_NAME__ADDRESSES)
+                    pipe.rename(_REDIS_NAME__BLOOM_TMP, _REDIS_NAME__BLOOM)
+                    # Changes logged before the rebuild no longer apply, processes reload the bloom filter
+                    pipe.delete(_REDIS_NAME__CHANGES)
+                    pipe.incr(_REDIS_NAME__VERSION)
+                    pipe.execute()
+                    return len(replayed)
+                except WatchError:
+                    continue
+
+
+WATCHED_ADDRESSES = WatchedAddressIndex()
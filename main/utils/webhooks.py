@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+from main.models import Recipient
+
+LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__FAILURES = 'webhooks:failures:{recipient_id}'
+_REDIS_NAME__CIRCUIT = 'webhooks:circuit:{recipient_id}'
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 10)
+# Responses slower than this count as failures for the circuit breaker
+SLOW_RESPONSE = 5
+# Webhook calls in flight per process, also the connection pool size per host
+MAX_CONCURRENCY = 16
+# Hosts with a kept alive connection pool
+MAX_HOSTS = 100
+
+# Failures within the window that open a recipient's circuit, and for how long
+FAILURE_THRESHOLD = 5
+FAILURE_WINDOW = 60 * 10
+CIRCUIT_COOLDOWN = 60 * 5
+
+# Deliveries are retried after 10s, 20s, 40s... up to an hour apart
+MAX_ATTEMPTS = 8
+RETRY_BACKOFF = 10
+MAX_RETRY_BACKOFF = 60 * 60
+
+INVALID_STATUS_CODES = (404, 502, 522)
+
+DELIVERED = 'delivered'
+INVALID = 'invalid'
+FAILED = 'failed'
+CIRCUIT_OPEN = 'circuit_open'
+
+
+def get_retry_countdown(attempt):
+    return min(RETRY_BACKOFF * 2 ** (attempt - 1), MAX_RETRY_BACKOFF)
+
+
+class CircuitBreaker(object):
+    """
+        Tracks failing recipients in redis so that every worker stops calling them.
+
+        A recipient's circuit opens after `FAILURE_THRESHOLD` failed or slow calls
+        within `FAILURE_WINDOW` seconds and stays open for `CIRCUIT_COOLDOWN` seconds,
+        after which calls are let through again. A single success resets it.
+    """
+
+    def is_open(self, recipient_id):
+        return bool(REDIS_STORAGE.exists(_REDIS_NAME__CIRCUIT.format(recipient_id=recipient_id)))
+
+    def record_success(self, recipient_id):
+        REDIS_STORAGE.delete(_REDIS_NAME__FAILURES.format(recipient_id=recipient_id))
+
+    def record_failure(self, recipient_id):
+        name = _REDIS_NAME__FAILURES.format(recipient_id=recipient_id)
+        pipe = REDIS_STORAGE.pipeline()
+        pipe.incr(name)
+        pipe.expire(name, FAILURE_WINDOW)
+        failures, _ = pipe.execute()
+
+        if failures >= FAILURE_THRESHOLD:
+            REDIS_STORAGE.set(_REDIS_NAME__CIRCUIT.format(recipient_id=recipient_id), failures, ex=CIRCUIT_COOLDOWN)
+            LOGGER.warning(f'Webhook circuit opened for recipient {recipient_id} after {failures} failures')
+
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
+
+class WebhookDispatcher(object):
+    """
+        Posts webhooks over a keep-alive session with a connection pool per host,
+        with timeouts and at most `max_concurrency` calls in flight per process.
+
+        Each call is a single attempt, retries are scheduled per delivery by the
+        caller (see `main.tasks.send_webhook`) so that a failing recipient
+        doesn't hold up anyone else's notifications.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def post(self, recipient, data):
+        """
+            Returns one of `DELIVERED`, `INVALID` (the recipient was marked invalid),
+            `FAILED` or `CIRCUIT_OPEN`, the last two are worth retrying later
+        """
+        if CIRCUIT_BREAKER.is_open(recipient.id):
+            return CIRCUIT_OPEN
+
+        started_at = time.monotonic()
+        try:
+            with self._semaphore:
+                resp = self.session.post(recipient.web_url, data=data, timeout=self.timeout)
+        except requests.RequestException as exc:
+            LOGGER.warning(f'Webhook call to {recipient.web_url} failed: {exc}')
+            CIRCUIT_BREAKER.record_failure(recipient.id)
+            return FAILED
+        elapsed = time.monotonic() - started_at
+
+        if resp.status_code == 200:
+            if elapsed > SLOW_RESPONSE:
+                LOGGER.warning(f'Slow webhook response from {recipient.web_url}: {elapsed:.2f}s')
+                CIRCUIT_BREAKER.record_failure(recipient.id)
+            else:
+                CIRCUIT_BREAKER.record_success(recipient.id)
+            return DELIVERED
+
+        if resp.status_code in INVALID_STATUS_CODES:
+            Recipient.objects.filter(id=recipient.id).update(valid=False)
+            LOGGER.info(f"!!! ATTENTION !!! THIS IS AN INVALID DESTINATION URL: {recipient.web_url}")
+            return INVALID
+
+        LOGGER.error(f'Webhook call to {recipient.web_url} responded with {resp.status_code}')
+        CIRCUIT_BREAKER.record_failure(recipient.id)
+        return FAILED
+
+
+WEBHOOK_DISPATCHER = WebhookDispatcher()
@@ -1,81 +1,67 @@
 from drf_yasg.utils import swagger_auto_schema
-from main.models import Transaction, Wallet, Token
-from django.db.models import Q, Sum, F
-from django.db.models.functions import Coalesce
+from main.models import BalanceLedger, Wallet, Token
+from django.db.models import F
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
 from main import serializers
-from main.utils.tx_fee import (
-    get_tx_fee_sats,
-    bch_to_satoshi,
-    satoshi_to_bch
-)
-
-
-def _get_slp_balance(query, multiple_tokens=False):
-    qs = Transaction.objects.filter(query)
-    if multiple_tokens:
-        # TODO: This is not working as expected in PostgresModel manager
-        # I created a github issue for this here:
-        # https://github.com/SectorLabs/django-postgres-extra/issues/143
-        # Multiple tokens balance will be disabled til that issue is resolved
-        qs_balance = qs.annotate(
-            _token=F('token__tokenid'),
-            token_name=F('token__name'),
-            token_ticker=F('token__token_ticker'),
-            token_type=F('token__token_type')
-        ).rename_annotations(
-            _token='token_id'
-        ).values(
-            'token_id',
-            'token_name',
-            'token_ticker',
-            'token_type'
-        ).annotate(
-            balance=Coalesce(Sum('amount'), 0)
-        )
+from main.utils.balance_ledger import get_balance
+from main.utils.response_cache import cached_response
+from main.utils.money import BCH_DECIMALS, from_base_units, get_token_decimals
+from main.utils.tx_fee import get_tx_fee_sats
+
+
+def _get_slp_balance(tokenid=None, wallet=None, address=None):
+    if tokenid:
+        token = Token.objects.get(tokenid=tokenid)
+        balance, value, _ = get_balance(tokenid=tokenid, wallet=wallet, address=address)
+        decimals = get_token_decimals(token)
+        if decimals is not None:
+            balance = float(from_base_units(value, decimals))
+        return {'amount__sum': balance}
+
+    if wallet:
+        qs = BalanceLedger.objects.filter(wallet=wallet, address__isnull=True)
     else:
-        qs_balance = qs.aggregate(Sum('amount'))
+        qs = BalanceLedger.objects.filter(address__address=address, wallet__isnull=True)
+    # TODO: This is not working as expected in PostgresModel manager
+    # I created a github issue for this here:
+    # https://github.com/SectorLabs/django-postgres-extra/issues/143
+    # Multiple tokens balance will be disabled til that issue is resolved
+    qs_balance = qs.exclude(token__tokenid='').annotate(
+        _token=F('token__tokenid'),
+        token_name=F('token__name'),
+        token_ticker=F('token__token_ticker'),
+        token_type=F('token__token_type')
+    ).rename_annotations(
+        _token='token_id'
+    ).values(
+        'token_id',
+        'token_name',
+        'token_ticker',
+        'token_type',
+        'balance'
+    )
     return qs_balance
 
 
-def _get_bch_balance(query):
-    # Exclude dust amounts as they're likely to be SLP transactions
-    # TODO: Needs another more sure way to exclude SLP transactions
-    dust = 546 / (10 ** 8)
-    query = query & Q(amount__gt=dust)
-    qs = Transaction.objects.filter(query)
-    qs_count = qs.count()
-    qs_balance = qs.aggregate(
-        balance=Coalesce(Sum('amount'), 0)
-    )
-    return qs_balance, qs_count
+def _get_bch_balance(wallet=None, address=None):
+    """
+        Returns the balance in satoshis and the number of UTXOs
+    """
+    # The ledger already leaves out dust amounts as they're likely to be SLP transactions
+    _, value, count = get_balance(wallet=wallet, address=address)
+    return value, count
 
-class Balance(APIView):
 
-    def truncate(self, num, decimals):
-        """
-        Truncate instead of rounding off
-        Rounding off sometimes results to a value greater than the actual balance
-        """
-        # Preformat first if it it's in scientific notation form
-        if 'e-' in str(num):
-            num, power = str(num).split('e-')
-            power = int(power)
-            num = num.replace('.', '')
-            left_pad = (power - 1) * '0'
-            sp = '0.' + left_pad + num
-        else:
-            sp = str(num)
-        # Proceed to truncate
-        sp = sp.split('.')
-        if len(sp) == 2:
-            return float('.'.join([sp[0], sp[1][:decimals]]))
-        else:
-            return num
+def _to_bch(satoshis):
+    return float(from_base_units(satoshis, BCH_DECIMALS))
+
+
+class Balance(APIView):
 
     @swagger_auto_schema(responses={ 200: serializers.BalanceResponseSerializer })
+    @cached_response
     def get(self, request, *args, **kwargs):
         slpaddress = kwargs.get('slpaddress', '')
         bchaddress = kwargs.get('bchaddress', '')
@@ -88,33 +74,20 @@ class Balance(APIView):
 
         if slpaddress.startswith('simpleledger:'):
             data['address'] = slpaddress
-            if tokenid:
-                multiple = False
-                query = Q(address__address=data['address']) & Q(spent=False) & Q(token__tokenid=tokenid)
-            else:
-                multiple = True
-                query =  Q(address__address=data['address']) & Q(spent=False)
-            qs_balance = _get_slp_balance(query, multiple_tokens=multiple)
-            token = Token.objects.get(tokenid=tokenid)
+            qs_balance = _get_slp_balance(tokenid=tokenid, address=data['address'])
             balance = qs_balance['amount__sum'] or 0
-            if balance > 0 and token.decimals:
-                balance = self.truncate(balance, token.decimals)
             data['balance'] = balance
             data['spendable'] = balance
             data['valid'] = True
         
         if bchaddress.startswith('bitcoincash:'):
             data['address'] = bchaddress
-            query = Q(address__address=data['address']) & Q(spent=False)
-            qs_balance, qs_count = _get_bch_balance(query)
-            bch_balance = qs_balance['balance'] or 0
+            satoshis, qs_count = _get_bch_balance(address=data['address'])
 
-            data['spendable'] = int(bch_to_satoshi(bch_balance)) - get_tx_fee_sats(p2pkh_input_count=qs_count)
-            data['spendable'] = satoshi_to_bch(data['spendable'])
-            data['spendable'] = max(data['spendable'], 0)
-            data['spendable'] = self.truncate(data['spendable'], 8)
-
-            data['balance'] = self.truncate(bch_balance, 8)
+            # Round the fee up, never report more than what can actually be spent
+            spendable = int(satoshis - get_tx_fee_sats(p2pkh_input_count=qs_count))
+            data['spendable'] = _to_bch(max(spendable, 0))
+            data['balance'] = _to_bch(satoshis)
             data['valid'] = True
 
         if wallet_hash:
@@ -122,36 +95,22 @@ class Balance(APIView):
             data['wallet'] = wallet_hash
 
             if wallet.wallet_type == 'slp':
-                if tokenid:
-                    multiple = False
-                    query = Q(wallet=wallet) & Q(spent=False) & Q(token__tokenid=tokenid)
-                else:
-                    multiple = True
-                    query =  Q(wallet=wallet) & Q(spent=False)
-                qs_balance = _get_slp_balance(query, multiple_tokens=multiple)
-                if multiple:
+                qs_balance = _get_slp_balance(tokenid=tokenid, wallet=wallet)
+                if not tokenid:
                     pass
                 else:
-                    token = Token.objects.get(tokenid=tokenid)
                     balance = qs_balance['amount__sum'] or 0
-                    if balance > 0 and token.decimals:
-                        balance = self.truncate(balance, token.decimals)
                     data['balance'] = balance
                     data['spendable'] = balance
                     data['token_id'] = tokenid
                     data['valid'] = True
 
             elif wallet.wallet_type == 'bch':
-                query = Q(wallet=wallet) & Q(spent=False)
-                qs_balance, qs_count = _get_bch_balance(query)
-                bch_balance = qs_balance['balance']
-
-                data['spendable'] = int(bch_to_satoshi(bch_balance)) - get_tx_fee_sats(p2pkh_input_count=qs_count)
-                data['spendable'] = satoshi_to_bch(data['spendable'])
-                data['spendable'] = max(data['spendable'], 0)
-                data['spendable'] = self.truncate(data['spendable'], 8)
+                satoshis, qs_count = _get_bch_balance(wallet=wallet)
 
-                data['balance'] = self.truncate(qs_balance['balance'], 8)
+                spendable = int(satoshis - get_tx_fee_sats(p2pkh_input_count=qs_count))
+                data['spendable'] = _to_bch(max(spendable, 0))
+                data['balance'] = _to_bch(satoshis)
                 data['valid'] = True
 
         return Response(data=data, status=status.HTTP_200_OK)
@@ -162,6 +121,7 @@ class SpendableBalance(APIView):
         request_body=serializers.TxFeeCalculatorSerializer,
         responses={ 200: serializers.BalanceResponseSerializer },
     )
+    @cached_response
     def post(self, request, *args, **kwargs):
         bchaddress = kwargs.get('bchaddress', '')
         wallet_hash = kwargs.get('wallethash', '')
@@ -170,24 +130,18 @@ class SpendableBalance(APIView):
             'valid': True,
         }
 
-        qs_balance = 0
+        satoshis = 0
         qs_count = 0
         if bchaddress.startswith('bitcoincash:'):
             data['address'] = bchaddress
-            query = Q(address__address=bchaddress) & Q(spent=False)
-            qs_balance, qs_count = _get_bch_balance(query)
+            satoshis, qs_count = _get_bch_balance(address=bchaddress)
         elif wallet_hash:
             wallet = Wallet.objects.get(wallet_hash=wallet_hash)
             data['wallet'] = wallet_hash
             if wallet.wallet_type != 'bch':
                 return Response({ 'detail': 'Invalid wallet type' }, status=400)
 
-            query = Q(wallet=wallet) & Q(spent=False)
-            qs_balance, qs_count = _get_bch_balance(query)
-
-        qs_balance = qs_balance['balance'] or 0
-        bch_balance = qs_balance
-        qs_balance = round(qs_balance, 8)
+            satoshis, qs_count = _get_bch_balance(wallet=wallet)
 
         serializer = serializers.TxFeeCalculatorSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -200,10 +154,7 @@ class SpendableBalance(APIView):
         tx_fee = get_tx_fee_sats(**tx_fee_kwargs)
 
 
-        data['spendable'] = int(bch_to_satoshi(bch_balance)) - round(tx_fee)
-        data['spendable'] = satoshi_to_bch(data['spendable'])
-        data['spendable'] = max(data['spendable'], 0)
-
-        data['balance'] = qs_balance
+        data['spendable'] = _to_bch(max(satoshis - round(tx_fee), 0))
+        data['balance'] = _to_bch(satoshis)
 
         return Response(data, status=200)
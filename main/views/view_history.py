@@ -4,10 +4,17 @@ from django.db.models import F
 from rest_framework import status
 from main.models import Wallet, WalletHistory
 from django.core.paginator import Paginator
+from main.utils.response_cache import cached_response
+from main.utils.pagination import KeysetPagination
+
+
+class WalletHistoryPagination(KeysetPagination):
+    ordering = ('-date_created', '-id')
 
 
 class WalletHistoryView(APIView):
 
+    @cached_response
     def get(self, request, *args, **kwargs):
         wallet_hash = kwargs.get('wallethash', None)
         token_id = kwargs.get('tokenid', None)
@@ -18,12 +25,12 @@ class WalletHistoryView(APIView):
             qs = qs.filter(record_type=record_type)
         wallet = Wallet.objects.get(wallet_hash=wallet_hash)
         if wallet.wallet_type == 'slp':
-            qs = qs.filter(token__tokenid=token_id)
-            history = qs.annotate(
+            qs = qs.filter(token__tokenid=token_id).annotate(
                 _token=F('token__tokenid')
             ).rename_annotations(
                 _token='token_id'
-            ).values(
+            )
+            fields = [
                 'record_type',
                 'txid',
                 'amount',
@@ -32,9 +39,9 @@ class WalletHistoryView(APIView):
                 'senders',
                 'recipients',
                 'date_created'
-            )
+            ]
         elif wallet.wallet_type == 'bch':
-            history = qs.values(
+            fields = [
                 'record_type',
                 'txid',
                 'amount',
@@ -42,9 +49,24 @@ class WalletHistoryView(APIView):
                 'senders',
                 'recipients',
                 'date_created'
-            )
+            ]
+        history = qs.values(*fields)
+
         if wallet.version == 1:
             return Response(data=history, status=status.HTTP_200_OK)
+        elif WalletHistoryPagination.cursor_query_param in request.GET:
+            # Keyset pagination, `?cursor=` (empty) gives the first page
+            paginator = WalletHistoryPagination()
+            records = paginator.paginate_queryset(qs.values('id', *fields), request, view=self)
+            for record in records:
+                record.pop('id')
+            data = {
+                'history': records,
+                'count': paginator.count,
+                'cursor': paginator.next_cursor,
+                'has_next': paginator.has_next
+            }
+            return Response(data=data, status=status.HTTP_200_OK)
         else:
             pages = Paginator(history, 10)
             page_obj = pages.page(int(page))
@@ -2,12 +2,10 @@ from rest_framework.views import APIView
 from main.models import Transaction, Wallet, Token
 from rest_framework.response import Response
 from rest_framework import status
-from django.db.models import Q, F, Func
-
-
-class Round(Func):
-    function = "ROUND"
-    template = "%(function)s(%(expressions)s::numeric, 0)"
+from django.db.models import BigIntegerField, Q, F
+from django.db.models.functions import Cast, Coalesce
+from main.utils.money import Round
+from main.utils.response_cache import cached_response
 
 
 def _get_slp_utxos(query, show_address_index=False):
@@ -62,40 +60,49 @@ def _get_slp_utxos(query, show_address_index=False):
 def _get_bch_utxos(query, show_address_index=False):
     # Exclude dust amounts as they're likely to be SLP transactions
     # TODO: Needs another more sure way to exclude SLP transactions
-    dust = 546 / (10 ** 8)
-    query = query & Q(amount__gt=dust)
-    qs = Transaction.objects.filter(query)
+    dust = 546
+    # Rows saved before their value was known fall back to the float amount
+    query = query & (
+        Q(value__gt=dust) |
+        Q(value__isnull=True, amount__gt=dust / (10 ** 8))
+    )
+    qs = Transaction.objects.filter(query).annotate(
+        utxo_value=Coalesce(
+            F('value'),
+            Cast(Round(F('amount') * (10 ** 8)), BigIntegerField())
+        ),
+        vout=F('index'),
+        block=F('blockheight__number'),
+    )
     if show_address_index:
         utxos_values = qs.annotate(
-            value=Round(F('amount') * (10 ** 8)),
-            vout=F('index'),
-            block=F('blockheight__number'),
             wallet_index=F('address__wallet_index'),
             address_path=F('address__address_path')
         ).values(
             'txid',
             'vout',
-            'value',
+            'utxo_value',
             'block',
             'wallet_index',
             'address_path'
         )
     else:
-        utxos_values = qs.annotate(
-            value=Round(F('amount') * (10 ** 8)),
-            vout=F('index'),
-            block=F('blockheight__number'),
-        ).values(
+        utxos_values = qs.values(
             'txid',
             'vout',
-            'value',
+            'utxo_value',
             'block'
         )
-    return utxos_values
+    # The annotation can't be named after the `value` field it stands in for
+    return [
+        {('value' if key == 'utxo_value' else key): x[key] for key in x}
+        for x in utxos_values
+    ]
 
 
 class UTXO(APIView):
 
+    @cached_response
     def get(self, request, *args, **kwargs):
 
         slpaddress = kwargs.get('slpaddress', '')
@@ -27,6 +27,12 @@ default_settings = {
     "BLOCK_TO_PRELOAD": None,
     "BLOCKS_PER_TASK": 25,
     "JSON_RPC_PROVIDER_URL": "https://smartbch.fountainhead.cash/mainnet",
+    # Used in order when the endpoints before them fail
+    "JSON_RPC_FALLBACK_URLS": [],
+    # Calls in flight per process, also the size of the connection pool
+    "JSON_RPC_MAX_CONCURRENCY": 10,
+    "JSON_RPC_MAX_RETRIES": 3,
+    "JSON_RPC_TIMEOUT": 30,
 }
 
 # In case you need to read settings from the main project settings
@@ -1,89 +1,25 @@
+import asyncio
 import json
 import logging
 import web3
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 
-from django.conf import settings
-
-from main.models import Address, Subscription
+from main.utils.presence import PRESENCE, HEARTBEAT_INTERVAL
 
 
 LOGGER = logging.getLogger(__name__)
-REDIS_CLIENT = settings.REDISKV
-
-_REDIS_NAME__ADDRESS_CONNECTIONS_CTR = "smartbch:address_consumer-connections_ctr"
-
-
-class ConsumerAddressCounter:
-    @classmethod
-    def increment_address(cls, address):
-        """
-        Return
-        --------
-            count: int | None
-            None implies the address is invalid
-        """
-        if not web3.Web3.isAddress(address):
-            return
-
-        return REDIS_CLIENT.hincrby(_REDIS_NAME__ADDRESS_CONNECTIONS_CTR, address, 1)
-
-    @classmethod
-    def decrement_address(cls, address):
-        """
-        Return
-        --------
-            count: int | None
-            None implies the address is invalid
-        """
-        if not web3.Web3.isAddress(address):
-            return
-
-        count = REDIS_CLIENT.hincrby(_REDIS_NAME__ADDRESS_CONNECTIONS_CTR, address, -1)
-        if count <= 0:
-            REDIS_CLIENT.hdel(_REDIS_NAME__ADDRESS_CONNECTIONS_CTR, address)
 
-        return count
 
-    @classmethod
-    def get_address_count(cls, address):
-        """
-        Get the number connections listening to the address
-        
-        Return
-        --------
-            has_members: bool | None
-        """
-        if not web3.Web3.isAddress(address):
-            return
-        try:
-            value = REDIS_CLIENT.hget(_REDIS_NAME__ADDRESS_CONNECTIONS_CTR, address)
-            value = int(value)
-            return value
-        except (ValueError, TypeError):
-            REDIS_CLIENT.hdel(_REDIS_NAME__ADDRESS_CONNECTIONS_CTR, address)
-
-    @classmethod
-    def address_has_members(cls, address):
-        """
-        Checks if there are connections listening to the address
-        
-        Return
-        --------
-            has_members: bool | None
-        """
-        count = cls.get_address_count(address)
-        if count is None:
-            return
-
-        return count >= 1
-
-
-class TransactionTransferUpdatesConsumer(WebsocketConsumer):
+class TransactionTransferUpdatesConsumer(AsyncWebsocketConsumer):
+    """
+        Pushes the transfers of an address (and contract) to the client.
+        Connections are only tracked in redis (see `main.utils.presence`),
+        connecting and disconnecting doesn't touch the database.
+    """
     CONTRACT_ADDRESS_LOOKUP_NAME = "contract_address"
 
-    def connect(self):
+    async def connect(self):
         self.address = self.scope["url_route"]["kwargs"]["address"]
         self.contract_address = ""
         if self.CONTRACT_ADDRESS_LOOKUP_NAME in self.scope["url_route"]["kwargs"].keys():
@@ -91,7 +27,7 @@ class TransactionTransferUpdatesConsumer(WebsocketConsumer):
 
         if not web3.Web3.isAddress(self.address):
             LOGGER.info(f"Invalid address for websocket update connections: {self.address}")
-            self.close()
+            await self.close()
             return
 
         self.room_name = self.address
@@ -100,40 +36,43 @@ class TransactionTransferUpdatesConsumer(WebsocketConsumer):
                 LOGGER.info(
                     f"Provided contract address for websocket update connections but invalid: {self.contract_address}"
                 )
-                self.close()
+                await self.close()
                 return
 
             self.room_name += f"_{self.contract_address}"
 
-        count = ConsumerAddressCounter.increment_address(self.address)
-        LOGGER.info(f"address({self.address}) has {count} websocket connection/s")
-        LOGGER.info(f"updating subscriptions for address({self.address}), enabling websocket")
-        Subscription.objects.filter(address__address=self.address).update(websocket=True)
-
         LOGGER.info(f"ADDRESS {self.room_name} CONNECTED!")
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.room_name,
             self.channel_name
         )
-        self.accept()
+        await sync_to_async(PRESENCE.join, thread_sensitive=False)(self.room_name, self.channel_name)
+        self.heartbeat = asyncio.ensure_future(self.send_heartbeats())
+        await self.accept()
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await sync_to_async(PRESENCE.heartbeat, thread_sensitive=False)(self.room_name, self.channel_name)
+            except Exception as exc:
+                LOGGER.error(f"Unable to refresh presence of {self.room_name}: {exc}")
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, "heartbeat"):
+            # Closed before it was fully connected, e.g. invalid address
+            return
 
-    def disconnect(self, close_code):
         LOGGER.info(f"ADDRESS {self.room_name} DISCONNECTED!")
-        async_to_sync(self.channel_layer.group_discard)(
+        self.heartbeat.cancel()
+        await self.channel_layer.group_discard(
             self.room_name,
             self.channel_name
         )
+        await sync_to_async(PRESENCE.leave, thread_sensitive=False)(self.room_name, self.channel_name)
 
-        # need to maintain a counter for address in the event of
-        # multiple clients listening to the same address
-        count = ConsumerAddressCounter.decrement_address(self.address)
-        LOGGER.info(f"address({self.address}) has {count} websocket connection/s remaining")
-        if not ConsumerAddressCounter.address_has_members(self.address):
-            LOGGER.info(f"updating subscriptions for address({self.address}), disabling websocket")
-            Subscription.objects.filter(address__address=self.address).update(websocket=False)
-
-    def send_update(self, data):
+    async def send_update(self, data):
         logging.info(f"FOUND {data}")
         del data["type"]
         data = data["data"]
-        self.send(text_data=json.dumps(data))
+        await self.send(text_data=json.dumps(data))
@@ -4,3 +4,10 @@ class InvalidQueryParameterException(APIException):
     status_code = 400
     default_detail = "Invalid query parameter value"
     default_code = "invalid_query_parameter"
+
+
+class JSONRPCError(Exception):
+    def __init__(self, method, error):
+        self.method = method
+        self.error = error
+        super().__init__(f"{method}: {error}")
@@ -93,14 +93,14 @@ class TransactionTransferViewsetFilter(BaseFilterBackend, FilterBackendUtils):
         if before_block:
             try:
                 parsed_before_block = Decimal(before_block)
-                queryset = queryset.filter(transaction__block__block_number__lte=parsed_before_block)
+                queryset = queryset.filter(block_number__lte=parsed_before_block)
             except InvalidOperation:
                 raise InvalidQueryParameterException(f"Invalid value for {self.BEFORE_BLOCK_QUERY_NAME}: {before_block}")
 
         if after_block:
             try:
                 parsed_after_block = Decimal(after_block)
-                queryset = queryset.filter(transaction__block__block_number__gte=parsed_after_block)
+                queryset = queryset.filter(block_number__gte=parsed_after_block)
             except InvalidOperation:
                 raise InvalidQueryParameterException(f"Invalid value for {self.AFTER_BLOCK_QUERY_NAME}: {after_block}")
 
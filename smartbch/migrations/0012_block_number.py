@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+BACKFILL_BLOCK_NUMBERS_SQL = """
+UPDATE smartbch_transaction t
+SET block_number = b.block_number
+FROM smartbch_block b
+WHERE b.id = t.block_id AND t.block_number IS NULL;
+
+UPDATE smartbch_transactiontransfer tt
+SET block_number = t.block_number
+FROM smartbch_transaction t
+WHERE t.id = tt.transaction_id AND tt.block_number IS NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smartbch', '0011_auto_20220705_1054'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='block_number',
+            field=models.DecimalField(blank=True, decimal_places=0, max_digits=78, null=True),
+        ),
+        migrations.AddField(
+            model_name='transactiontransfer',
+            name='block_number',
+            field=models.DecimalField(blank=True, decimal_places=0, max_digits=78, null=True),
+        ),
+        migrations.RunSQL(BACKFILL_BLOCK_NUMBERS_SQL, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['block_number', 'id'], name='sbch_tx_block_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactiontransfer',
+            index=models.Index(fields=['block_number', 'log_index', 'id'], name='sbch_transfer_block_number_idx'),
+        ),
+    ]
@@ -6,6 +6,8 @@ from django.db import connection
 
 from django.apps import apps
 
+from main.utils.presence import PRESENCE
+
 class Block(PostgresModel):
     id = models.BigAutoField(primary_key=True)
 
@@ -132,6 +134,8 @@ class Transaction(PostgresModel):
         null=True,
         blank=True
     )
+    # Copy of `block.block_number`, so that listings can be paged on an index of this table
+    block_number = models.DecimalField(max_digits=78, decimal_places=0, null=True, blank=True)
 
     to_addr = models.CharField(max_length=64)
     from_addr = models.CharField(max_length=64)
@@ -147,15 +151,19 @@ class Transaction(PostgresModel):
 
     processed_transfers = models.BooleanField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the transactions list, see `TransactionKeysetPagination`
+            models.Index(fields=["block_number", "id"], name="sbch_tx_block_number_idx"),
+        ]
+
     def __str__(self):
         return f"{self.__class__.__name__}:{self.txid}"
 
-    @property
-    def block_number(self):
-        if "block_number" not in self.__dict__:
-            self.__dict__["block_number"] = self.block.block_number
-
-        return self.__dict__["block_number"]
+    def save(self, *args, **kwargs):
+        if self.block_id and self.block_number is None:
+            self.block_number = self.block.block_number
+        return super().save(*args, **kwargs)
 
     @property
     def normalized_value(self):
@@ -194,6 +202,20 @@ class TransactionTransfer(PostgresModel):
     amount = models.DecimalField(max_digits=36, decimal_places=18, null=True, blank=True)
     token_id = models.IntegerField(null=True, blank=True) # will be applicable to erc721
 
+    # Copy of `transaction.block_number`, so that listings can be paged on an index of this table
+    block_number = models.DecimalField(max_digits=78, decimal_places=0, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the transfers list, see `TransactionTransferKeysetPagination`
+            models.Index(fields=["block_number", "log_index", "id"], name="sbch_transfer_block_number_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.block_number is None:
+            self.block_number = self.transaction.block_number
+        return super().save(*args, **kwargs)
+
     @property
     def normalized_amount(self):
         # https://stackoverflow.com/questions/11227620/drop-trailing-zeros-from-decimal
@@ -239,13 +261,31 @@ class TransactionTransfer(PostgresModel):
             ],
         )
 
+    def get_websocket_rooms(self, address):
+        """
+            Rooms of the websocket connections (see `smartbch.consumer`) that get the
+            updates of this transfer for `address`: the address room, and the room of
+            the address and contract address for token transfers
+        """
+        rooms = [address]
+        if self.token_contract and self.token_contract.address:
+            rooms.append(f"{address}_{self.token_contract.address}")
+        return rooms
+
     def get_valid_subscriptions(self):
         subscriptions = self.get_subscriptions()
         if not subscriptions:
             return subscriptions
 
+        # Subscriptions without a valid recipient only matter while someone is connected
+        rooms = {
+            room: address
+            for address in {self.from_addr, self.to_addr} if address
+            for room in self.get_websocket_rooms(address)
+        }
+        connected = {rooms[room] for room in PRESENCE.filter(rooms)}
         return subscriptions.filter(
-            models.Q(recipient__valid=True) | models.Q(websocket=True)
+            models.Q(recipient__valid=True) | models.Q(address__address__in=connected)
         )
 
     def get_unsent_valid_subscriptions(self):
@@ -1,6 +1,8 @@
 from collections import OrderedDict
 from rest_framework import pagination, response
 
+from main.utils.pagination import KeysetPagination
+
 class CustomLimitOffsetPagination(pagination.LimitOffsetPagination):
     default_limit = 10
     max_limit = 50
@@ -42,3 +44,45 @@ class CustomLimitOffsetPagination(pagination.LimitOffsetPagination):
                 'results': schema,
             },
         }
+
+
+class TransactionKeysetPagination(KeysetPagination):
+    # Columns of the paged table itself, so that pages are read off an index
+    ordering = ('-block_number', '-id')
+
+
+class TransactionTransferKeysetPagination(KeysetPagination):
+    ordering = ('-block_number', '-log_index', '-id')
+
+
+class CursorOrLimitOffsetPagination(pagination.BasePagination):
+    """
+        Keyset pagination when the request has a `cursor` query param (empty for
+        the first page), `CustomLimitOffsetPagination` otherwise for older clients
+    """
+    keyset_pagination_class = KeysetPagination
+    limit_offset_pagination_class = CustomLimitOffsetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.keyset_pagination_class.cursor_query_param in request.query_params:
+            self.paginator = self.keyset_pagination_class()
+        else:
+            self.paginator = self.limit_offset_pagination_class()
+        return self.paginator.paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def get_paginated_response_schema(self, schema):
+        return self.limit_offset_pagination_class().get_paginated_response_schema(schema)
+
+    def get_schema_fields(self, view):
+        return self.limit_offset_pagination_class().get_schema_fields(view)
+
+
+class TransactionPagination(CursorOrLimitOffsetPagination):
+    keyset_pagination_class = TransactionKeysetPagination
+
+
+class TransactionTransferPagination(CursorOrLimitOffsetPagination):
+    keyset_pagination_class = TransactionTransferKeysetPagination
@@ -38,6 +38,8 @@ _QUEUE_TRANSACTIONS_PARSER = "sbch__transactions_parser_queue"
 _QUEUE_ADDRESS_PARSER = "sbch__address_parser_queue"
 _QUEUE_TRANSACTION_TRANSFER_NOTIFICATION = "sbch__transaction_transfer_notification_queue"
 
+_MAX_BLOCKS_PER_RANGE = 25
+
 @shared_task(queue=_QUEUE_BLOCKS_PARSER, time_limit=_TASK_TIME_LIMIT)
 def preload_new_blocks_task():
     LOGGER.info("Preloading new blocks to db")
@@ -142,10 +144,44 @@ def parse_blocks_task():
         '-block_number'
     )[:block_count]
 
-    LOGGER.info(f"Queueing blocks for parsing: {blocks.values_list('block_number', flat=True)}")
-    for block_obj in blocks:
-        parse_block_task.delay(block_obj.block_number, send_notifications=True)
-    
+    block_numbers = sorted(int(x) for x in blocks.values_list('block_number', flat=True))
+    LOGGER.info(f"Queueing blocks for parsing: {block_numbers}")
+
+    # Contiguous blocks are parsed together with batched requests
+    ranges = []
+    for block_number in block_numbers:
+        if ranges and ranges[-1][1] == block_number - 1 and block_number - ranges[-1][0] < _MAX_BLOCKS_PER_RANGE:
+            ranges[-1][1] = block_number
+        else:
+            ranges.append([block_number, block_number])
+
+    for start_block, end_block in ranges:
+        parse_block_range_task.delay(start_block, end_block, send_notifications=True)
+
+
+@shared_task(queue=_QUEUE_BLOCKS_PARSER, time_limit=_TASK_TIME_LIMIT)
+def parse_block_range_task(start_block, end_block, send_notifications=False):
+    block_numbers = [str(x) for x in range(int(start_block), int(end_block) + 1)]
+    active_blocks = {x.decode() for x in REDIS_CLIENT.smembers(_REDIS_NAME__BLOCKS_BEING_PARSED)}
+    if active_blocks.intersection(block_numbers):
+        LOGGER.info(f"Blocks {start_block} to {end_block} are being parsed by another task, will stop task")
+        return f"blocks_are_being_parsed {start_block}-{end_block}"
+
+    LOGGER.info(f"Parsing blocks: {start_block} to {end_block}")
+    REDIS_CLIENT.sadd(_REDIS_NAME__BLOCKS_BEING_PARSED, *block_numbers)
+    REDIS_CLIENT.expire(_REDIS_NAME__BLOCKS_BEING_PARSED, _REDIS_KEY_TTL)
+    try:
+        blocks, txids = block_utils.parse_block_range(start_block, end_block)
+        LOGGER.info(f"Parsed {len(blocks)} blocks successfully, saved {len(txids)} transactions")
+
+        for txid in txids:
+            save_transaction_transfers_task.delay(txid, send_notifications=send_notifications)
+        return f"parsed blocks {start_block} to {end_block}: {len(txids)} transactions"
+    except Exception as e:
+        return f"parse_block_range_task({start_block}, {end_block}) error: {str(e)}"
+    finally:
+        REDIS_CLIENT.srem(_REDIS_NAME__BLOCKS_BEING_PARSED, *block_numbers)
+
 
 @shared_task(queue=_QUEUE_BLOCKS_PARSER, time_limit=_TASK_TIME_LIMIT)
 def parse_block_task(block_number, send_notifications=False):
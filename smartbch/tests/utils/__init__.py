@@ -1,6 +1,8 @@
 from .block import BlockUtilsTestCase
+from .cache import CacheUtilsTestCase
 from .subscription import (
     SubscriptionUtilsTestCase,
     TransactionTransferSubscriptionTestCase,
 )
 from .transaction import TransactionUtilsTestCase
+from .web3 import Web3UtilsTestCase
@@ -155,7 +155,8 @@ class BlockUtilsTestCase(TestCase):
             address=mock_responses.test_block_response.transactions[0]['from'],
         )
         with mock.patch("web3.eth.Eth.get_block", return_value=mock_responses.test_block_response) as block_patch:
-            with mock.patch("web3.eth.Eth.get_logs", return_value=mock_responses.test_block_logs):
+            with mock.patch("web3.eth.Eth.get_logs", return_value=mock_responses.test_block_logs), \
+                    mock.patch("smartbch.utils.block.cache_transaction_receipts") as cache_patch:
                 block_obj = block_utils.parse_block(mock_responses.test_block_response.number, save_transactions=True)
                 self.assertIsInstance(block_obj, Block)
                 self.assertTrue(block_obj.processed)
@@ -164,3 +165,63 @@ class BlockUtilsTestCase(TestCase):
                     len(block_patch.return_value.transactions),
                     f"Expected {block_obj} to have {len(block_patch.return_value.transactions)} transactions but got {block_obj.transactions.count()}",
                 )
+                # Receipts of the saved transactions are fetched in one batch for transfer parsing
+                cache_patch.assert_called_once_with(
+                    [tx.hash.hex() for tx in block_patch.return_value.transactions]
+                )
+
+    def _mock_block_range_response(self):
+        block = mock_responses.test_block_response
+        block_data = {
+            "number": hex(block.number),
+            "timestamp": hex(block.timestamp),
+            "transactions": [
+                {
+                    "hash": tx.hash.hex(),
+                    "from": tx["from"].lower(),
+                    "to": tx.to.lower(),
+                    "value": hex(tx.value),
+                    "input": tx.input,
+                    "gas": hex(tx.gas),
+                    "gasPrice": hex(tx.gasPrice),
+                }
+                for tx in block.transactions
+            ],
+        }
+        logs = [
+            {
+                "transactionHash": log.transactionHash.hex(),
+                "topics": [topic.hex() for topic in log.topics],
+            }
+            for log in mock_responses.test_block_logs
+        ]
+        return [block_data, logs]
+
+    @tag("unit")
+    def test_parse_block_range(self):
+        block_number = mock_responses.test_block_response.number
+        with mock.patch("smartbch.utils.block.get_batch_client") as client_patch:
+            client_patch.return_value.call_batch.return_value = self._mock_block_range_response()
+            blocks, txids = block_utils.parse_block_range(block_number, block_number)
+
+            self.assertEqual(len(blocks), 1)
+            self.assertTrue(blocks[0].processed)
+            self.assertEqual(blocks[0].transactions_count, len(mock_responses.test_block_response.transactions))
+            self.assertEqual(txids, [])
+
+    @tag("unit")
+    def test_parse_block_range_with_tracked_addresses(self):
+        block_number = mock_responses.test_block_response.number
+        # Only involved through the Transfer event logs
+        Address.objects.get_or_create(address="0x659F04F36e90143fCaC202D4BC36C699C078fC98")
+        expected_txids = [tx.hash.hex() for tx in mock_responses.test_block_response.transactions]
+        receipts = [{"transactionHash": txid} for txid in expected_txids]
+        with mock.patch("smartbch.utils.block.get_batch_client") as client_patch, \
+                mock.patch("smartbch.utils.block.cache_receipts") as cache_patch:
+            client_patch.return_value.call_batch.side_effect = [self._mock_block_range_response(), receipts]
+            blocks, txids = block_utils.parse_block_range(block_number, block_number)
+
+            self.assertEqual(txids, expected_txids)
+            self.assertEqual(blocks[0].transactions.count(), len(expected_txids))
+            # Receipts of the saved transactions are fetched in one batch for transfer parsing
+            cache_patch.assert_called_once_with(dict(zip(expected_txids, receipts)))
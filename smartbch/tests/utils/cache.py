@@ -0,0 +1,27 @@
+from unittest import mock
+from django.test import TestCase, tag
+
+from smartbch.utils import cache as cache_utils
+
+class CacheUtilsTestCase(TestCase):
+    @tag("unit")
+    def test_lru_cache_eviction(self):
+        lru = cache_utils.LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        self.assertEqual(lru.get("a"), 1)
+        self.assertIsNone(lru.get("b"), "Expected least recently used key to be evicted")
+        self.assertEqual(lru.get("c"), 3)
+
+    @tag("unit")
+    @mock.patch("smartbch.utils.contract.get_token_decimals", return_value=8)
+    def test_get_token_decimals(self, mock_get_token_decimals):
+        address = "0x0000000000000000000000000000000000000001"
+        cache_utils.REDIS_CLIENT.delete(cache_utils._REDIS_NAME__TOKEN_DECIMALS.format(address=address))
+
+        self.assertEqual(cache_utils.get_token_decimals(address), 8)
+        self.assertEqual(cache_utils.get_token_decimals(address), 8)
+        mock_get_token_decimals.assert_called_once_with(address)
@@ -8,6 +8,7 @@ from django.utils import timezone
 
 from main.models import Subscription
 from main.utils import subscription as subscription_utils_main
+from main.utils.presence import PRESENCE
 
 from smartbch.models import TransactionTransferReceipientLog
 from smartbch.utils import subscription as subscription_utils
@@ -38,8 +39,13 @@ class SubscriptionUtilsTestCase(TestCase):
         self.assertTrue(self.tx_transfer_obj.get_valid_subscriptions().exists())
         self.assertTrue(self.tx_transfer_obj.get_unsent_valid_subscriptions().exists())
 
+    def _connect(self, room):
+        # Stands in for a websocket connection, see smartbch.consumer
+        PRESENCE.join(room, "test-channel")
+        self.addCleanup(PRESENCE.leave, room, "test-channel")
+
     @tag("unit")
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_send_subscription_web_url(self, mock_post_request):
         mock_post_request.return_value.ok = True
         mock_post_request.return_value.status_code = 200
@@ -59,6 +65,29 @@ class SubscriptionUtilsTestCase(TestCase):
         self.assertIsInstance(log, TransactionTransferReceipientLog)
         self.assertIsNotNone(log.sent_at)
 
+    @tag("unit")
+    @mock.patch("smartbch.utils.subscription.send_webhook")
+    @mock.patch("requests.Session.post")
+    def test_send_subscription_web_url_queued(self, mock_post_request, mock_send_webhook):
+        mock_post_request.return_value.ok = False
+        mock_post_request.return_value.status_code = 500
+
+        subscription = self.tx_transfer_obj.get_unsent_valid_subscriptions().first()
+        subscription.recipient.telegram_id = None
+        subscription.recipient.web_url = "https://example.com/webhook/receiver/"
+        subscription.recipient.save()
+        subscription.refresh_from_db()
+
+        log, error = subscription_utils.send_transaction_transfer_notification_to_subscriber(
+            subscription,
+            self.tx_transfer_obj,
+        )
+
+        # Not delivered yet, the queued webhook stamps the log once it is
+        self.assertIsNotNone(log)
+        self.assertIsNone(log.sent_at)
+        self.assertEqual(mock_send_webhook.apply_async.call_args[1]["kwargs"]["log_id"], log.id)
+
     @tag("unit")
     @mock.patch("main.tasks.send_telegram_message", return_value="send notification to 12312")
     def test_send_subscription_telegram(self, mock_send_tg_msg):
@@ -78,9 +107,9 @@ class SubscriptionUtilsTestCase(TestCase):
     def test_send_subscription_websocket(self, mock_async_to_sync):
         subscription = self.tx_transfer_obj.get_unsent_valid_subscriptions().first()
         subscription.receiver = None
-        subscription.websocket = True
         subscription.save()
         subscription.refresh_from_db()
+        self._connect(subscription.address.address)
 
         log, error = subscription_utils.send_transaction_transfer_notification_to_subscriber(
             subscription,
@@ -190,8 +219,8 @@ class TransactionTransferSubscriptionTestCase(TestCase):
         # 3rd part no recipient but is websocket
         subscription.refresh_from_db()
         subscription.recipient = None
-        subscription.websocket = True
         subscription.save()
+        self._connect(subscription.address.address)
 
         subscriptions = self.tx_transfer_obj.get_valid_subscriptions()
         self.assertIsNotNone(
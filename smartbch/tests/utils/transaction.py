@@ -18,6 +18,11 @@ class TransactionUtilsTestCase(TestCase):
             f"Expected to have {Block} record with block_number={block_number}"
         )
         self.assertIsInstance(tx_obj, Transaction)
+        self.assertEqual(
+            tx_obj.block_number,
+            block_number,
+            f"Expected {Transaction} to have the block_number of its block"
+        )
 
     @tag("unit")
     @mock.patch("smartbch.utils.contract.get_token_decimals", return_value=18)
@@ -42,6 +47,10 @@ class TransactionUtilsTestCase(TestCase):
             TokenContract.objects.filter(address=token_contract_address).exists(),
             f"Expected to have {TokenContract} record with address={token_contract_address}"
         )
+        self.assertFalse(
+            tx_obj.transfers.exclude(block_number=mock_tx.return_value.blockNumber).exists(),
+            f"Expected transfer records to have the block_number of their transaction"
+        )
 
     @tag("unit")
     @mock.patch("smartbch.utils.web3.SmartBCHModule.query_transfer_events", return_value=mock_responses.test_sbch_query_transfer_events)
@@ -0,0 +1,61 @@
+from unittest import mock
+import requests
+from django.test import TestCase, tag
+
+from smartbch.utils import web3 as web3_utils
+
+class Web3UtilsTestCase(TestCase):
+    def _mock_response(self, status_code=200, content=b'{"jsonrpc": "2.0", "id": 0, "result": "0x1"}'):
+        response = mock.Mock(status_code=status_code, content=content)
+        if status_code >= 400:
+            response.raise_for_status.side_effect = requests.HTTPError(f"{status_code} error")
+        return response
+
+    @tag("unit")
+    @mock.patch("smartbch.utils.web3.time.sleep")
+    def test_provider_failover(self, mock_sleep):
+        session = mock.Mock()
+        session.post.side_effect = [
+            requests.ConnectionError("connection refused"),
+            self._mock_response(),
+        ]
+        provider = web3_utils.FailoverHTTPProvider(
+            ["http://primary", "http://fallback"],
+            session=session,
+            max_concurrency=1,
+            max_retries=1,
+            timeout=1,
+        )
+
+        response = provider.make_request("eth_blockNumber", [])
+        self.assertEqual(response["result"], "0x1")
+        self.assertEqual([call[0][0] for call in session.post.call_args_list], ["http://primary", "http://fallback"])
+        # Calls stay on the fallback while the primary endpoint cools down
+        self.assertEqual(provider.get_endpoint(), "http://fallback")
+
+    @tag("unit")
+    @mock.patch("smartbch.utils.web3.time.sleep")
+    def test_provider_gives_up_after_retries(self, mock_sleep):
+        session = mock.Mock()
+        session.post.return_value = self._mock_response(status_code=503)
+        provider = web3_utils.FailoverHTTPProvider(
+            ["http://primary"],
+            session=session,
+            max_concurrency=1,
+            max_retries=2,
+            timeout=1,
+        )
+
+        with self.assertRaises(requests.HTTPError):
+            provider.make_request("eth_blockNumber", [])
+        self.assertEqual(session.post.call_count, 3)
+
+    @tag("unit")
+    def test_web3_client_is_shared(self):
+        self.assertIs(web3_utils.create_web3_client(), web3_utils.create_web3_client())
+
+    @tag("unit")
+    def test_web3_client_is_not_shared_across_forks(self):
+        client = web3_utils.get_web3_client()
+        with mock.patch("smartbch.utils.web3.os.getpid", return_value=web3_utils._CLIENT_PID + 1):
+            self.assertIsNot(web3_utils.get_web3_client(), client)
@@ -1,6 +1,8 @@
 import decimal
 import datetime
-from django.db import models
+import web3
+from django.db import connection, models
+from django.db import transaction as trans
 from django.utils.timezone import make_aware
 from web3.datastructures import AttributeDict
 from web3.exceptions import (
@@ -9,15 +11,22 @@ from web3.exceptions import (
     MismatchedABI,
 )
 
-from main.models import Address
+from psqlextra.query import ConflictAction
+
+from main.utils.watched_addresses import WATCHED_ADDRESSES
 
 from smartbch.conf import settings as app_settings
 from smartbch.models import Block, Transaction
 
+from .cache import cache_receipts
 from .contract import abi
-from .formatters import format_block_number
+from .formatters import format_block_number, hex_to_int
+from .json_rpc import get_batch_client
 from .web3 import create_web3_client
 
+# ERC20 and ERC721 Transfer event topic, apparenlty share the same topic in hex string
+TRANSFER_EVENT_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+
 
 def range_with_exclude(*args, to_exclude=[], **kwargs):
     # This should work with new 
@@ -42,25 +51,22 @@ def preload_block_range(start_block, end_block):
             new blocks created, i.e. blocks within the specified range that have already existed are not included here
     """
     print(f"Pre saving blocks from {start_block} to {end_block}")
-    existing_block_numbers = Block.objects.filter(
-        block_number__gte=start_block, block_number__lte=end_block
-    ).order_by(
-        "block_number",
-    ).values_list(
-        "block_number", flat=True,
-    )
 
-    created_blocks = []
-    # blocks_to_create = []
-    for block_number in range(int(start_block), int(end_block)+1):
-        block, created = Block.objects.get_or_create(
-            block_number=decimal.Decimal(block_number),
+    # A single set-based insert, blocks that already exist are skipped by the unique constraint
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+                INSERT INTO {Block._meta.db_table} (block_number, transactions_count, processed, created_at)
+                SELECT block_number, 0, false, now()
+                FROM generate_series(%s::numeric, %s::numeric) AS block_number
+                ON CONFLICT (block_number) DO NOTHING
+                RETURNING id
+            """,
+            [decimal.Decimal(int(start_block)), decimal.Decimal(int(end_block))],
         )
-        if created:
-            created_blocks.append(block)
-    
-    # if len(blocks_to_create):
-    #     created_blocks = Block.objects.bulk_create(blocks_to_create)
+        created_ids = [row[0] for row in cursor.fetchall()]
+
+    created_blocks = list(Block.objects.filter(id__in=created_ids).order_by("block_number"))
 
     return (start_block, end_block, created_blocks)
 
@@ -133,6 +139,7 @@ def parse_block(block_number, save_transactions=True, save_all_transactions=Fals
         "topics": [event_topic],
     })
 
+    txids = []
     if save_transactions:
         tx_log_addresses_map = {}
         if not save_all_transactions:
@@ -173,8 +180,8 @@ def parse_block(block_number, save_transactions=True, save_all_transactions=Fals
                         *tx_log_addresses_map[transaction.hash.hex()],
                     ]
 
-                tracked_addresses = Address.objects.filter(address__in=tx_addresses_list)
-                if not tracked_addresses.exists():
+                tracked_addresses = WATCHED_ADDRESSES.filter(tx_addresses_list)
+                if not tracked_addresses:
                     continue
 
             tx, created = Transaction.objects.get_or_create(
@@ -190,5 +197,170 @@ def parse_block(block_number, save_transactions=True, save_all_transactions=Fals
                     "is_mined": True,
                 }
             )
+            txids.append(tx.txid)
 
+    cache_transaction_receipts(txids)
     return block_obj
+
+
+def cache_transaction_receipts(txids):
+    """
+        Fetches the receipts of `txids` in a single JSON-RPC batch for `save_transaction_transfers`,
+        which needs their status and gas used on top of the Transfer logs
+    """
+    txids = list(txids)
+    if not txids:
+        return
+    receipts = get_batch_client().call_batch([
+        ("eth_getTransactionReceipt", [txid]) for txid in txids
+    ])
+    cache_receipts(dict(zip(txids, receipts)))
+
+
+def _topic_to_address(topic):
+    # Indexed address params are left padded to 32 bytes
+    return web3.Web3.toChecksumAddress("0x" + topic[-40:])
+
+
+def _to_checksum_address(address):
+    if not address:
+        return address
+    return web3.Web3.toChecksumAddress(address)
+
+
+def get_transfer_log_addresses(logs):
+    """
+        Maps the transaction hashes of Transfer event logs to the addresses involved.
+        ERC20 and ERC721 Transfer events both index `from` and `to`, so they're read
+        straight from the topics.
+    """
+    tx_log_addresses_map = {}
+    for log in logs:
+        topics = log.get("topics") or []
+        if len(topics) < 3 or topics[0] != TRANSFER_EVENT_TOPIC:
+            continue
+        addresses = tx_log_addresses_map.setdefault(log["transactionHash"], set())
+        addresses.add(_topic_to_address(topics[1]))
+        addresses.add(_topic_to_address(topics[2]))
+    return tx_log_addresses_map
+
+
+def parse_block_range(start_block, end_block, save_all_transactions=False):
+    """
+        Batched version of `parse_block`, fetches all the blocks in the range with their
+        transactions and the range's Transfer logs in a single JSON-RPC batch, and
+        saves the blocks and tracked transactions with bulk queries.
+
+    Parameters
+    ------------
+    start_block: int | decimal.Decimal
+    end_block: int | decimal.Decimal
+        The range is inclusive
+
+    save_all_transactions: boolean
+        Save transactions even if no address is subscribed.
+
+    Returns
+    ------------
+    (blocks, txids)
+        blocks: list(smartbch.models.Block) parsed, in ascending order
+        txids: list of the hashes of the transactions saved
+    """
+    start_block, end_block = int(start_block), int(end_block)
+    block_numbers = list(range(start_block, end_block + 1))
+
+    calls = [
+        ("eth_getBlockByNumber", [format_block_number(number), True])
+        for number in block_numbers
+    ]
+    calls.append(("eth_getLogs", [{
+        "fromBlock": format_block_number(start_block),
+        "toBlock": format_block_number(end_block),
+        "topics": [TRANSFER_EVENT_TOPIC],
+    }]))
+    *blocks_data, logs = get_batch_client().call_batch(calls)
+
+    tx_log_addresses_map = get_transfer_log_addresses(logs or [])
+
+    transactions = []
+    for number, block_data in zip(block_numbers, blocks_data):
+        if block_data is None:
+            raise ValueError(f"Block {number} is not available yet")
+        for transaction in block_data["transactions"]:
+            transactions.append((number, transaction))
+
+    # Checking the whole range against the watched addresses at once
+    tracked_addresses = set()
+    if not save_all_transactions:
+        addresses = set()
+        for _, transaction in transactions:
+            addresses.add(_to_checksum_address(transaction["from"]))
+            addresses.add(_to_checksum_address(transaction["to"]))
+            addresses.update(tx_log_addresses_map.get(transaction["hash"], []))
+        tracked_addresses = WATCHED_ADDRESSES.filter(addresses)
+
+    existing_blocks = {
+        int(block.block_number): block
+        for block in Block.objects.filter(block_number__gte=start_block, block_number__lte=end_block)
+    }
+    block_objs = []
+    for number, block_data in zip(block_numbers, blocks_data):
+        block_obj = existing_blocks.get(number) or Block(block_number=decimal.Decimal(number))
+        block_obj.timestamp = make_aware(datetime.datetime.fromtimestamp(hex_to_int(block_data["timestamp"])))
+        block_obj.transactions_count = len(block_data["transactions"])
+        block_obj.processed = True
+        block_objs.append(block_obj)
+
+    with trans.atomic():
+        Block.objects.bulk_create([x for x in block_objs if x.pk is None], ignore_conflicts=True)
+        Block.objects.bulk_update(
+            [x for x in block_objs if x.pk is not None],
+            ["timestamp", "transactions_count", "processed"],
+        )
+        # ignore_conflicts leaves the ids of the new blocks unset
+        block_ids = dict(
+            Block.objects.filter(
+                block_number__gte=start_block,
+                block_number__lte=end_block,
+            ).values_list("block_number", "id")
+        )
+
+        rows = []
+        for number, transaction in transactions:
+            if not save_all_transactions:
+                tx_addresses = {
+                    _to_checksum_address(transaction["from"]),
+                    _to_checksum_address(transaction["to"]),
+                    *tx_log_addresses_map.get(transaction["hash"], []),
+                }
+                if not tracked_addresses.intersection(tx_addresses):
+                    continue
+
+            rows.append({
+                "txid": transaction["hash"],
+                "block_id": block_ids[decimal.Decimal(number)],
+                "block_number": decimal.Decimal(number),
+                "to_addr": _to_checksum_address(transaction["to"]) or "",
+                "from_addr": _to_checksum_address(transaction["from"]),
+                "value": web3.Web3.fromWei(hex_to_int(transaction["value"]), "ether"),
+                "data": transaction["input"],
+                "gas": hex_to_int(transaction["gas"]),
+                "gas_price": hex_to_int(transaction["gasPrice"]),
+                "is_mined": True,
+            })
+
+        if rows:
+            Transaction.objects.on_conflict(["txid"], ConflictAction.NOTHING).bulk_insert(rows)
+
+    # The transfers of the saved transactions are parsed from their receipts next,
+    # fetching them here saves a round trip per transaction
+    txids = [row["txid"] for row in rows]
+    cache_transaction_receipts(txids)
+
+    blocks = list(
+        Block.objects.filter(
+            block_number__gte=start_block,
+            block_number__lte=end_block,
+        ).order_by("block_number")
+    )
+    return blocks, txids
@@ -0,0 +1,109 @@
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from web3._utils.method_formatters import receipt_formatter
+from web3.datastructures import AttributeDict
+
+from smartbch.utils import contract as contract_utils
+
+REDIS_CLIENT = settings.REDISKV
+
+_REDIS_NAME__RECEIPT = 'smartbch:receipt:{txid}'
+_REDIS_NAME__TOKEN_DECIMALS = 'smartbch:token-decimals:{address}'
+
+# Receipts are only needed until the transfers of a block are saved
+RECEIPT_TTL = 60 * 60
+TOKEN_DECIMALS_TTL = 60 * 60 * 24
+# Contracts without `decimals()` are asked again after a while
+NO_DECIMALS_TTL = 60 * 10
+
+
+class LRUCache:
+    """
+        Bounded in-process cache in front of the Redis caches
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+_MISSING = object()
+_RECEIPTS = LRUCache(1024)
+_TOKEN_DECIMALS = LRUCache(4096)
+
+
+def cache_receipts(receipts):
+    """
+        Stores raw (i.e. as returned by the JSON-RPC) transaction receipts
+
+    Parameters
+    ------------
+    receipts: dict of txid to receipt
+    """
+    receipts = {txid: receipt for txid, receipt in receipts.items() if receipt}
+    if not receipts:
+        return
+
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for txid, receipt in receipts.items():
+        _RECEIPTS.set(txid, receipt)
+        pipe.setex(_REDIS_NAME__RECEIPT.format(txid=txid), RECEIPT_TTL, json.dumps(receipt))
+    pipe.execute()
+
+
+def get_cached_receipt(txid):
+    """
+        Returns the cached receipt of `txid` formatted like web3's `get_transaction_receipt()`,
+        or None if it's not cached
+    """
+    receipt = _RECEIPTS.get(txid)
+    if receipt is None:
+        cached = REDIS_CLIENT.get(_REDIS_NAME__RECEIPT.format(txid=txid))
+        if cached is None:
+            return None
+        receipt = json.loads(cached)
+        _RECEIPTS.set(txid, receipt)
+
+    return AttributeDict.recursive(receipt_formatter(receipt))
+
+
+def get_token_decimals(address):
+    """
+        Cached version of `smartbch.utils.contract.get_token_decimals`
+    """
+    decimals = _TOKEN_DECIMALS.get(address, _MISSING)
+    if decimals is not _MISSING:
+        return decimals
+
+    name = _REDIS_NAME__TOKEN_DECIMALS.format(address=address)
+    cached = REDIS_CLIENT.get(name)
+    if cached is not None:
+        decimals = json.loads(cached)
+        _TOKEN_DECIMALS.set(address, decimals)
+        return decimals
+
+    decimals = contract_utils.get_token_decimals(address)
+    if not isinstance(decimals, int):
+        decimals = None
+    REDIS_CLIENT.setex(name, TOKEN_DECIMALS_TTL if decimals is not None else NO_DECIMALS_TTL, json.dumps(decimals))
+    if decimals is not None:
+        _TOKEN_DECIMALS.set(address, decimals)
+    return decimals
@@ -0,0 +1,89 @@
+import itertools
+import json
+import threading
+
+from smartbch.exceptions import JSONRPCError
+
+from .web3 import get_provider
+
+# Calls sent per HTTP request
+MAX_BATCH_SIZE = 100
+
+
+class JSONRPCBatchClient:
+    """
+        Minimal JSON-RPC client that sends calls in batches (a JSON array of requests)
+        for bulk reads where web3's one request per call is the bottleneck.
+        Requests go through the web3 client's provider by default, sharing its
+        session, retries and endpoint failover.
+
+        Results are returned raw, i.e. quantities are still hex strings.
+    """
+
+    def __init__(self, provider=None, max_batch_size=MAX_BATCH_SIZE):
+        self.provider = provider
+        self.max_batch_size = max_batch_size
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def _post(self, payload):
+        provider = self.provider or get_provider()
+        methods = {request["method"] for request in payload}
+        method = f"batch:{methods.pop()}" if len(methods) == 1 else "batch"
+        return json.loads(provider.post(json.dumps(payload), method=method))
+
+    def call(self, method, params=None):
+        return self.call_batch([(method, params)])[0]
+
+    def call_batch(self, calls):
+        """
+            Parameters
+            ------------
+            calls: list of (method, params) tuples
+
+            Returns
+            ------------
+            results: list of results in the same order as `calls`,
+                raises `JSONRPCError` if any of the calls failed
+        """
+        results = []
+        calls = list(calls)
+        for start in range(0, len(calls), self.max_batch_size):
+            chunk = calls[start:start + self.max_batch_size]
+            payload = [
+                {"jsonrpc": "2.0", "id": self._next_id(), "method": method, "params": params or []}
+                for method, params in chunk
+            ]
+
+            data = self._post(payload)
+            # A malformed batch is answered with a single error object
+            if isinstance(data, dict):
+                raise JSONRPCError("batch", data.get("error", data))
+
+            # Responses may come in any order
+            responses = {response.get("id"): response for response in data}
+            for request in payload:
+                response = responses.get(request["id"])
+                if response is None:
+                    raise JSONRPCError(request["method"], "missing response")
+                if response.get("error"):
+                    raise JSONRPCError(request["method"], response["error"])
+                results.append(response.get("result"))
+        return results
+
+
+_CLIENT = None
+
+
+def get_batch_client():
+    """
+        Process-wide client, see `smartbch.utils.web3.get_web3_client`
+    """
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = JSONRPCBatchClient()
+    return _CLIENT
@@ -1,12 +1,13 @@
 import logging
-import requests
 import typing
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from django.utils import timezone
 
 from main.models import Subscription
-from main.tasks import send_telegram_message
+from main.tasks import send_telegram_message, send_webhook
+from main.utils import webhooks
+from main.utils.presence import PRESENCE
 
 from smartbch.models import (
     TransactionTransfer,
@@ -48,7 +49,6 @@ def send_transaction_transfer_notification_to_subscriber(
     __assert_instance(tx_transfer_obj, TransactionTransfer)
 
     recipient = subscription.recipient
-    websocket = subscription.websocket
 
     # check if already sent successfully
     notification_log = TransactionTransferReceipientLog.objects.filter(
@@ -62,13 +62,14 @@ def send_transaction_transfer_notification_to_subscriber(
     data = tx_transfer_obj.get_subscription_data()
 
     remarks = []
+    webhook_queued = False
     if recipient and recipient.valid:
         if recipient.web_url:
             LOGGER.info(f"Webhook call to be sent to: {recipient.web_url}")
             LOGGER.info(f"Data: {str(data)}")
 
-            resp = requests.post(recipient.web_url, data=data)
-            if resp.status_code == 200:
+            result = webhooks.WEBHOOK_DISPATCHER.post(recipient, data)
+            if result == webhooks.DELIVERED:
                 remarks.append("Sent to web url.")
                 LOGGER.info(
                     "ACKNOWLEDGEMENT SENT TX TRANSFER INFO : {0} TO: {1} DATA: {2}".format(
@@ -77,12 +78,10 @@ def send_transaction_transfer_notification_to_subscriber(
                         str(data),
                     )
                 )
-            elif resp.status_code == 404 or resp.status_code == 522 or resp.status_code == 502:
-                recipient.valid = False
-                recipient.save()
-                LOGGER.info(f"!!! ATTENTION !!! THIS IS AN INVALID DESTINATION URL: {recipient.web_url}")
-            else:
-                return f"unknown_web_url_response_status_code: {resp.status_code}", None
+            elif result in (webhooks.FAILED, webhooks.CIRCUIT_OPEN):
+                # Retried on its own with backoff below instead of retrying every subscriber's notification
+                webhook_queued = True
+                remarks.append("Queued to web url.")
 
         if recipient.telegram_id:
             LOGGER.info(f"Sending telegram message for {tx_transfer_obj} to telegram({recipient.telegram_id})")
@@ -106,26 +105,13 @@ def send_transaction_transfer_notification_to_subscriber(
             remarks.append("Sent to telegram.")
 
 
-    if websocket:
-        room_name = f"{subscription.address.address}"
-
-        # send to websocket connections subscribed to address 
+    # only rooms with connections, see main.utils.presence
+    rooms = PRESENCE.filter(tx_transfer_obj.get_websocket_rooms(subscription.address.address))
+    if rooms:
         channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"{room_name}", 
-            {
-                "type": "send_update",
-                "data": data
-            }
-        )
-
-        # send to websocket token connections subscribed to address and contract address
-        if tx_transfer_obj.token_contract and tx_transfer_obj.token_contract.address:
-            room_name += f"_{tx_transfer_obj.token_contract.address}"
-
-            channel_layer = get_channel_layer()
+        for room in rooms:
             async_to_sync(channel_layer.group_send)(
-                f"{room_name}", 
+                room,
                 {
                     "type": "send_update",
                     "data": data
@@ -133,13 +119,21 @@ def send_transaction_transfer_notification_to_subscriber(
             )
         remarks.append("Sent to websocket.")
 
+    # A queued webhook isn't delivered yet, `send_webhook` stamps the log once it is
     log, _ = TransactionTransferReceipientLog.objects.update_or_create(
         transaction_transfer=tx_transfer_obj,
         subscription=subscription,
         defaults={
-            "sent_at": timezone.now(),
+            "sent_at": None if webhook_queued else timezone.now(),
             "remarks": " ".join(remarks),
         }
     )
 
+    if webhook_queued:
+        send_webhook.apply_async(
+            (recipient.id, data),
+            kwargs={"attempt": 2, "log_id": log.id},
+            countdown=webhooks.get_retry_countdown(1),
+        )
+
     return log, None
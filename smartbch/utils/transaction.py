@@ -5,7 +5,8 @@ from django.utils.timezone import make_aware
 from web3.datastructures import AttributeDict
 from smartbch.models import Block, Transaction, TokenContract
 
-from .contract import abi, get_token_decimals
+from .cache import get_cached_receipt, get_token_decimals
+from .contract import abi
 from .formatters import format_block_number
 from .web3 import create_web3_client
 
@@ -51,7 +52,10 @@ def save_transaction_transfers(txid, parse_block_timestamp=False):
             }
         )
 
-    receipt = w3.eth.get_transaction_receipt(instance.txid)
+    # Receipts of transactions found by the block range parser are already cached
+    receipt = get_cached_receipt(instance.txid)
+    if receipt is None:
+        receipt = w3.eth.get_transaction_receipt(instance.txid)
 
     erc20 = w3.eth.contract('', abi=abi.get_token_abi(20))
     erc721 = w3.eth.contract('', abi=abi.get_token_abi(721))
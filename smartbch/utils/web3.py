@@ -1,5 +1,14 @@
+import logging
+import os
 import re
+import threading
+import time
+
+import requests
 import web3
+from django.conf import settings
+from django.test.signals import setting_changed
+from web3.providers.base import JSONBaseProvider
 
 from smartbch.conf import settings as app_settings
 
@@ -8,16 +17,219 @@ from .formatters import (
     pad_hex_string,
 )
 
+LOGGER = logging.getLogger(__name__)
+REDIS_STORAGE = settings.REDISKV
+
+_REDIS_NAME__METRICS = 'smartbch:rpc-metrics'
+
+# Seconds between flushes of the latency metrics to redis
+METRICS_INTERVAL = 30
+# Seconds a failed endpoint is skipped before it's tried again
+ENDPOINT_COOLDOWN = 30
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 8
+
+
+class RPCMetrics(object):
+    """
+        Per JSON-RPC method call counts, errors and latency, accumulated in memory and
+        added to a redis hash (`<method>:<stat>` fields) every `METRICS_INTERVAL` seconds
+        so that the numbers of every worker process end up in one place.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, method, elapsed, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(method, {'calls': 0, 'errors': 0, 'total_ms': 0, 'max_ms': 0})
+            elapsed_ms = int(elapsed * 1000)
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+            if time.monotonic() - self._flushed_at < METRICS_INTERVAL:
+                return
+            stats, self._stats = self._stats, {}
+            self._flushed_at = time.monotonic()
+
+        self.flush(stats)
+
+    def snapshot(self):
+        with self._lock:
+            return {method: dict(stats) for method, stats in self._stats.items()}
+
+    def flush(self, stats):
+        try:
+            pipe = REDIS_STORAGE.pipeline(transaction=False)
+            for method, values in stats.items():
+                pipe.hincrby(_REDIS_NAME__METRICS, f'{method}:calls', values['calls'])
+                pipe.hincrby(_REDIS_NAME__METRICS, f'{method}:errors', values['errors'])
+                pipe.hincrby(_REDIS_NAME__METRICS, f'{method}:total_ms', values['total_ms'])
+                pipe.hset(_REDIS_NAME__METRICS, f'{method}:last_max_ms', values['max_ms'])
+            pipe.execute()
+        except Exception as exc:
+            LOGGER.error(f'Unable to store JSON-RPC metrics: {exc}')
+
+
+RPC_METRICS = RPCMetrics()
+
+
+def get_endpoints():
+    return [app_settings.JSON_RPC_PROVIDER_URL, *app_settings.JSON_RPC_FALLBACK_URLS]
+
+
+def create_session(pool_size=None):
+    """
+        Keep-alive session with a connection pool per endpoint big enough for the
+        allowed number of concurrent calls
+    """
+    if pool_size is None:
+        pool_size = app_settings.JSON_RPC_MAX_CONCURRENCY
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(get_endpoints()), pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class FailoverHTTPProvider(JSONBaseProvider):
+    """
+        HTTP provider over a shared session that spreads calls across several
+        endpoints: the first endpoint is used while it works, and connection errors,
+        timeouts and 5xx responses move calls to the next one for `ENDPOINT_COOLDOWN`
+        seconds, retrying with exponential backoff.
+
+        At most `max_concurrency` calls are in flight per process.
+        JSON-RPC errors are not retried, they're returned to web3 as usual.
+    """
+
+    def __init__(self, endpoints, session=None, max_concurrency=None, max_retries=None, timeout=None):
+        super().__init__()
+        if max_concurrency is None:
+            max_concurrency = app_settings.JSON_RPC_MAX_CONCURRENCY
+        if max_retries is None:
+            max_retries = app_settings.JSON_RPC_MAX_RETRIES
+        if timeout is None:
+            timeout = app_settings.JSON_RPC_TIMEOUT
+
+        self.endpoints = list(endpoints)
+        self.session = session or create_session(max_concurrency)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._failed_at = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'Failover HTTP connection {self.endpoints}'
+
+    def get_endpoint(self):
+        """
+            First endpoint that's not cooling down, or the one that failed longest ago
+        """
+        now = time.monotonic()
+        with self._lock:
+            for endpoint in self.endpoints:
+                if now - self._failed_at.get(endpoint, -ENDPOINT_COOLDOWN) >= ENDPOINT_COOLDOWN:
+                    return endpoint
+            return min(self.endpoints, key=lambda x: self._failed_at.get(x, 0))
+
+    def mark_failed(self, endpoint):
+        with self._lock:
+            self._failed_at[endpoint] = time.monotonic()
+
+    def post(self, data, method='batch'):
+        """
+            Posts a JSON-RPC payload with retries and failover, returns the response body
+        """
+        last_exc = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(RETRY_BACKOFF * 2 ** (attempt - 1), MAX_RETRY_BACKOFF))
+
+            endpoint = self.get_endpoint()
+            started_at = time.monotonic()
+            try:
+                with self._semaphore:
+                    response = self.session.post(
+                        endpoint,
+                        data=data,
+                        headers={'Content-Type': 'application/json'},
+                        timeout=self.timeout,
+                    )
+                if response.status_code >= 500:
+                    response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as exc:
+                RPC_METRICS.record(method, time.monotonic() - started_at, error=True)
+                LOGGER.warning(f'JSON-RPC {method} call to {endpoint} failed (attempt {attempt + 1}): {exc}')
+                self.mark_failed(endpoint)
+                last_exc = exc
+                continue
+
+            RPC_METRICS.record(method, time.monotonic() - started_at)
+            response.raise_for_status()
+            return response.content
+
+        raise last_exc
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self.post(request_data, method=method))
+
+    def isConnected(self):
+        try:
+            response = self.make_request('web3_clientVersion', [])
+        except (IOError, ValueError):
+            return False
+        return 'error' not in response
+
+
+_CLIENT = None
+_CLIENT_PID = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_provider():
+    return get_web3_client().provider
+
+
+def get_web3_client():
+    """
+        Process-wide web3 client, the provider's session and middlewares are set up once.
+        Processes forked after it was created (e.g. celery prefork workers) get their own,
+        the pooled connections of the parent's session can't be shared.
+    """
+    global _CLIENT, _CLIENT_PID
+    pid = os.getpid()
+    if _CLIENT is None or _CLIENT_PID != pid:
+        with _CLIENT_LOCK:
+            if _CLIENT is None or _CLIENT_PID != pid:
+                _CLIENT = web3.Web3(
+                    FailoverHTTPProvider(get_endpoints()),
+                    external_modules={
+                        "sbch": SmartBCHModule,
+                    }
+                )
+                _CLIENT_PID = pid
+    return _CLIENT
+
 
 def create_web3_client():
-    provider = web3.providers.rpc.HTTPProvider(app_settings.JSON_RPC_PROVIDER_URL)
-    w3 = web3.Web3(
-        provider,
-        external_modules={
-            "sbch": SmartBCHModule,
-        }
-    )
-    return w3
+    return get_web3_client()
+
+
+def reset_web3_client(*args, **kwargs):
+    global _CLIENT
+    if kwargs.get("setting") in (None, "SMARTBCH"):
+        _CLIENT = None
+
+
+setting_changed.connect(reset_web3_client)
 
 
 # munger is needed for methods that use params, check web3.method.Method docs
@@ -13,13 +13,16 @@ from smartbch.serializers import (
     TransactionTransferSerializer,
 )
 from smartbch.filters import TransactionTransferViewsetFilter
-from smartbch.pagination import CustomLimitOffsetPagination
+from smartbch.pagination import (
+    TransactionPagination,
+    TransactionTransferPagination,
+)
 
 
 class TransactionViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
     lookup_field = "txid"
     serializer_class = TransactionSerializer
-    pagination_class = CustomLimitOffsetPagination
+    pagination_class = TransactionPagination
 
     def get_object(self):
         Model = self.serializer_class.Meta.model
@@ -44,7 +47,8 @@ class TransactionViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.
             "transfers__transaction",
             "transfers__transaction__block",
         ).order_by(
-            "-block__block_number",
+            "-block_number",
+            "-id",
         ).all()
 
     @swagger_auto_schema(responses={ 200: TransactionTransferSerializer(many=True) })
@@ -58,7 +62,7 @@ class TransactionViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.
 
 class TransactionTransferViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
     serializer_class = TransactionTransferSerializer
-    pagination_class = CustomLimitOffsetPagination
+    pagination_class = TransactionTransferPagination
 
     filter_backends = [
         TransactionTransferViewsetFilter,
@@ -70,5 +74,7 @@ class TransactionTransferViewSet(viewsets.GenericViewSet, mixins.ListModelMixin)
             "transaction",
             "transaction__block",
         ).order_by(
-            "-transaction__block__block_number"
+            "-block_number",
+            "-log_index",
+            "-id",
         ).all()
@@ -215,6 +215,20 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'main.tasks.manage_blocks',
         'schedule': 7
     },
+    'process_pending_transactions': {
+        'task': 'main.tasks.process_pending_transactions',
+        'schedule': 30
+    },
+    # Picks up notifications due for a retry, new ones also queue a dispatch on commit
+    'dispatch_notifications': {
+        'task': 'main.tasks.dispatch_notifications',
+        'schedule': 10
+    },
+    # Flushes are otherwise scheduled as messages come in, this is a safety net
+    'flush_telegram_messages': {
+        'task': 'main.tasks.flush_telegram_messages',
+        'schedule': 30
+    },
     'preload_smartbch_blocks': {
         'task': 'smartbch.tasks.preload_new_blocks_task',
         'schedule': 20,
@@ -342,6 +356,10 @@ CHANNEL_LAYERS = {
 WATCH_ROOM = 'watch_room'
 
 START_BLOCK = int(decipher(config('START_BLOCK')))
+# Number of BCH blocks scanned concurrently and how long (in seconds) a block
+# can be in progress before it's considered stalled and handed out again
+BLOCK_SCAN_WINDOW = safe_cast(decipher(config('BLOCK_SCAN_WINDOW', 4)), var_type=int, default=4)
+BLOCK_SCAN_TIMEOUT = safe_cast(decipher(config('BLOCK_SCAN_TIMEOUT', 900)), var_type=int, default=900)
 
 
 SMARTBCH = {
@@ -360,4 +378,19 @@ SMARTBCH = {
         var_type=int,
         default=50,
     ),
+    "JSON_RPC_FALLBACK_URLS": [
+        url.strip()
+        for url in decipher(config('SBCH_JSON_RPC_FALLBACK_URLS', '')).split(',')
+        if url.strip()
+    ],
+    "JSON_RPC_MAX_CONCURRENCY": safe_cast(
+        decipher(config('SBCH_JSON_RPC_MAX_CONCURRENCY', 10)),
+        var_type=int,
+        default=10,
+    ),
+    "JSON_RPC_MAX_RETRIES": safe_cast(
+        decipher(config('SBCH_JSON_RPC_MAX_RETRIES', 3)),
+        var_type=int,
+        default=3,
+    ),
 }